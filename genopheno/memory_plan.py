@@ -0,0 +1,188 @@
+"""
+Plans the chunk sizes, block sizes and worker counts of a stage so that its working set stays under a memory budget.
+The working set is estimated from the input dimensions with the per element costs below, which are upper estimates
+of the arrays and copies the stages hold at the same time. The settings of a stage are only lowered, never raised,
+and the plan is logged. If the smallest settings do not fit, the plan is logged as a warning and the stage runs with
+them anyway.
+"""
+from models.snp_selectors.interaction_screen import BLOCK_PAIRS
+
+import logging
+logger = logging.getLogger('root')
+
+MB = 1024 * 1024
+
+# The bytes of a genotype (SNP and user) while the users of a phenotype are merged: the float32 user columns and their
+# concatenation, the float64 data frame and its copy and the genotypes read to count the mutations
+MERGE_CELL_BYTES = 32
+# The bytes of a genotype while a preprocessed file is written: the CSV text ("2.0,") and its lines
+TEXT_CELL_BYTES = 8
+# The bytes of a preprocessed or model data set value, which are float64
+VALUE_BYTES = 8
+# The memory of a parsed user genome relative to the size of the user file
+GENOME_FILE_FACTOR = 3
+# The bytes of the interaction screening, four float64 score arrays and two int64 position arrays for each pair
+SCREEN_PAIR_BYTES = 48
+# The copies of a user's mutations while a block is predicted: the data frame, the columns in model order and the
+# imputed data
+PREDICT_COPIES = 3
+
+
+class MemoryBudget:
+    """
+    A memory budget, of which part is already used by data that is held for the whole stage
+    """
+
+    def __init__(self, max_memory, base_bytes=0):
+        """
+        Creates a budget
+        :param max_memory: The budget in megabytes
+        :param base_bytes: The bytes that are already used
+        """
+        self.max_bytes = max_memory * MB
+        self.base_bytes = base_bytes
+
+    def available(self):
+        return max(self.max_bytes - self.base_bytes, 0)
+
+    def fit_count(self, item_bytes, count, fixed_bytes=0):
+        """
+        Finds the largest number of items that fit in the budget
+        :param item_bytes: The bytes of each item
+        :param count: The maximum number of items
+        :param fixed_bytes: The bytes used besides the items
+        :return: The number of items, at least 1 and at most count
+        """
+        if item_bytes <= 0:
+            return count
+        return int(max(1, min(count, (self.available() - fixed_bytes) // item_bytes)))
+
+    def log_plan(self, stage, working_set, settings):
+        """
+        Logs the settings of a stage and its estimated working set
+        :param stage: The stage name
+        :param working_set: The estimated working set in bytes
+        :param settings: A list of (name, value) tuples
+        """
+        message = 'Memory plan for {}: estimated working set {} MB of the {} MB budget ({} MB already used). {}'\
+            .format(stage, _megabytes(self.base_bytes + working_set), _megabytes(self.max_bytes),
+                    _megabytes(self.base_bytes), ', '.join('{}: {}'.format(name, value) for name, value in settings))
+        if self.base_bytes + working_set > self.max_bytes:
+            logger.warning(message + '. The smallest settings do not fit the budget.')
+        else:
+            logger.info(message)
+
+
+def plan_preprocess(max_memory, n_snps, n_users, base_bytes, chunk_rows, workers=1, shard_snps=None,
+                    batch_size=None):
+    """
+    Plans the preprocessing of the users of a phenotype
+    :param max_memory: The budget in megabytes
+    :param n_snps: The number of SNPs in the SNP database
+    :param n_users: The largest number of users of a phenotype
+    :param base_bytes: The bytes of the SNP database
+    :param chunk_rows: The maximum number of rows formatted at once when a preprocessed file is written
+    :param workers: The maximum number of shards preprocessed in parallel
+    :param shard_snps: The number of SNPs of the largest shard, if the SNPs are sharded
+    :param batch_size: The maximum number of users in each work queue task, if the users are distributed
+    :return: A dictionary with the chunk_rows, workers and batch_size settings
+    """
+    budget = MemoryBudget(max_memory, base_bytes)
+    merge_bytes = n_snps * n_users * MERGE_CELL_BYTES
+
+    # the preprocessed file is written while the merged data is held
+    chunk_rows = budget.fit_count(n_users * TEXT_CELL_BYTES, chunk_rows, merge_bytes)
+    working_set = merge_bytes + chunk_rows * n_users * TEXT_CELL_BYTES
+    settings = [('rows written at once', chunk_rows)]
+
+    if shard_snps is not None:
+        shard_bytes = shard_snps * n_users * MERGE_CELL_BYTES
+        workers = budget.fit_count(shard_bytes, workers)
+        working_set = max(working_set, workers * shard_bytes)
+        settings.append(('shard workers', workers))
+
+    if batch_size is not None:
+        batch_size = budget.fit_count(n_snps * MERGE_CELL_BYTES, batch_size)
+        settings.append(('users in each task', batch_size))
+
+    budget.log_plan('preprocessing', working_set, settings)
+    return {'chunk_rows': chunk_rows, 'workers': workers, 'batch_size': batch_size}
+
+
+def plan_model(max_memory, n_train, n_test, n_snps, base_bytes, no_interactions, interactions, float32, n_jobs,
+               cross_validation, n_models=1):
+    """
+    Plans the feature expansion and training of the models. The settings are lowered in order until the working set
+    fits: float32 design matrices, which do not change the predictions, fewer grid search processes and fewer screened
+    interactions.
+    :param max_memory: The budget in megabytes
+    :param n_train: The number of training users
+    :param n_test: The number of testing users
+    :param n_snps: The number of model SNPs
+    :param base_bytes: The bytes of the preprocessed and prepared data
+    :param no_interactions: If True the models have no interactions
+    :param interactions: The maximum number of screened interactions. If None all pairs are included.
+    :param float32: If True the design matrices are already float32
+    :param n_jobs: The maximum number of grid search processes, for all models
+    :param cross_validation: The number of folds for k-fold cross validation
+    :param n_models: The number of models trained concurrently
+    :return: A dictionary with the float32, n_jobs and interactions settings
+    """
+    budget = MemoryBudget(max_memory, base_bytes)
+    n_pairs = 0 if no_interactions else n_snps * (n_snps - 1) // 2
+    if interactions is not None:
+        n_pairs = min(n_pairs, interactions)
+    screen_bytes = 0 if no_interactions or interactions is None else BLOCK_PAIRS * SCREEN_PAIR_BYTES
+    fold_rows = n_train * (cross_validation - 1) // max(cross_validation, 1)
+
+    def term_bytes(use_float32, jobs):
+        # The design matrices and the shared copy of the training matrix of each model, and a float64 copy of the
+        # training folds in each grid search process
+        value_bytes = 4 if use_float32 else VALUE_BYTES
+        return n_models * ((n_train * 2 + n_test) * value_bytes + max(1, jobs // n_models) * fold_rows * VALUE_BYTES)
+
+    def working_set(use_float32, jobs, pairs):
+        return (n_snps + pairs) * term_bytes(use_float32, jobs) + screen_bytes
+
+    if working_set(float32, n_jobs, n_pairs) > budget.available():
+        float32 = True
+    while n_jobs > 1 and working_set(float32, n_jobs, n_pairs) > budget.available():
+        n_jobs -= 1
+    if n_pairs > 0 and working_set(float32, n_jobs, n_pairs) > budget.available():
+        # the pairs are screened, which adds the screening blocks
+        screen_bytes = BLOCK_PAIRS * SCREEN_PAIR_BYTES
+        n_terms = budget.fit_count(term_bytes(float32, n_jobs), n_snps + n_pairs, screen_bytes)
+        n_pairs = max(n_terms - n_snps, 0)
+        interactions = n_pairs
+
+    budget.log_plan('model training', working_set(float32, n_jobs, n_pairs), [
+        ('float32', float32), ('grid search processes', n_jobs),
+        ('interactions', 'all pairs' if interactions is None else interactions)])
+    return {'float32': float32, 'n_jobs': n_jobs, 'interactions': interactions}
+
+
+def plan_predict(max_memory, n_snps, n_terms, base_bytes, genome_bytes, block_size, workers):
+    """
+    Plans the prediction of the users. The block size is lowered before the number of workers.
+    :param max_memory: The budget in megabytes
+    :param n_snps: The number of model SNPs
+    :param n_terms: The number of model terms
+    :param base_bytes: The bytes of the model and the SNP data
+    :param genome_bytes: The bytes of the largest parsed user genome
+    :param block_size: The maximum number of users predicted at once
+    :param workers: The maximum number of processes parsing the user files
+    :return: A dictionary with the block_size and workers settings
+    """
+    budget = MemoryBudget(max_memory, base_bytes)
+    user_bytes = (n_snps * PREDICT_COPIES + n_terms) * VALUE_BYTES
+
+    block_size = budget.fit_count(user_bytes, block_size, workers * genome_bytes)
+    workers = budget.fit_count(genome_bytes, workers, block_size * user_bytes)
+
+    budget.log_plan('prediction', block_size * user_bytes + workers * genome_bytes, [
+        ('users predicted at once', block_size), ('workers', workers)])
+    return {'block_size': block_size, 'workers': workers}
+
+
+def _megabytes(n_bytes):
+    return int(round(float(n_bytes) / MB))
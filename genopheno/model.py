@@ -1,14 +1,23 @@
 import argparse
+import math
 import os
 import re
+import time
+import traceback
+from multiprocessing import Process, Queue
+from Queue import Empty
 
+import numpy as np
 import pandas as pd
 import logging
 import logging.config
 
 from models.snp_selectors import mutation_difference
-from models import elastic_net, decision_tree, random_forest
-from util import timed_invoke, expand_path, clean_output, setup_logger
+from preprocessing.genotype_matrix import PackedPhenotype
+from models import common, elastic_net, decision_tree, random_forest
+from util import timed_invoke, expand_path, clean_output, setup_logger, setup_profiler, setup_worker_profiler
+from stage_cache import StageCache
+import memory_plan
 
 logger = logging.getLogger('root')
 
@@ -18,12 +27,21 @@ MODELS = {
     'rf': random_forest.build_model,
 }
 
+COMPARISON_FILE = 'model_comparison.csv'
+COMPARISON_COLUMNS = ['model', 'accuracy', 'sensitivity', 'specificity', 'auc', 'training_seconds', 'best_params']
+
+# State shared with the model training processes. It is set before the processes are forked so the prepared data set
+# is inherited by the processes instead of being copied to each of them.
+__shared = {}
+
 
 def __read_phenotype_input(input_dir):
     """
-    Reads the preprocessed phenotype files from the initialization steps and creates data frames from each file.
+    Reads the preprocessed phenotype files from the initialization steps. The user genotypes are bit-packed while the
+    files are read, so the preprocessed data is never held as float data frames.
     :param input_dir: The directory containing the preprocessed files.
-    :return: A map of phenotypes where the key is the phenotype ID and the value is the phenotype data frame.
+    :return: A map of phenotypes where the key is the phenotype ID and the value is the packed phenotype, see
+             PackedPhenotype.
     """
     # read preprocessed files
     file_prefix = 'preprocessed_'
@@ -32,14 +50,13 @@ def __read_phenotype_input(input_dir):
 
     phenotypes = {}
     for f in filter(file_name_regex.match, files):
-        # create data frame from preprocessed files
-        df = pd.read_csv(os.path.join(input_dir, f), compression='gzip')
-        df.set_index('Rsid', inplace=True)
+        # pack the user genotypes of the preprocessed file
+        packed = PackedPhenotype.read_csv(os.path.join(input_dir, f))
 
-        # add the data frame to the collection of preprocessed phenotypes
+        # add the packed data to the collection of preprocessed phenotypes
         phenotype = f[len(file_prefix):len(f) - len('.csv.gz')]
-        phenotypes[phenotype] = df
-        logger.info("{} users and {} SNPs for phenotype '{}'".format(len(df.columns)-4, df.shape[0], phenotype))
+        phenotypes[phenotype] = packed
+        logger.info("{} users and {} SNPs for phenotype '{}'".format(len(packed.users), len(packed.snps), phenotype))
 
     if len(phenotypes) == 0:
         raise ValueError('No preprocessed files in directory "{}". '
@@ -48,8 +65,213 @@ def __read_phenotype_input(input_dir):
     return phenotypes
 
 
+def __read_genotype_input(genotypes_file, phenotypes_file):
+    """
+    Creates the packed phenotypes from the cohort genotype matrix of the preprocess step and a phenotype file. Only
+    the columns of the users with a known phenotype are read, so the users do not need to be preprocessed again for
+    each phenotype.
+    :param genotypes_file: The cohort genotype matrix file
+    :param phenotypes_file: The CSV file with the user_id and phenotype columns
+    :return: A map of phenotypes where the key is the phenotype and the value is the packed phenotype, the same as
+             when the phenotypes are read from the preprocessed files
+    """
+    known_phenotypes = pd.read_csv(phenotypes_file).dropna(subset=['phenotype'])
+    known_phenotypes = known_phenotypes.drop_duplicates(['user_id', 'phenotype'])
+    multi_pheno = known_phenotypes['user_id'].duplicated(keep=False)
+    if multi_pheno.any():
+        logger.warning('Multiple phenotypes found for {} users: {}.'.format(
+            known_phenotypes['user_id'][multi_pheno].nunique(),
+            sorted(known_phenotypes['user_id'][multi_pheno].unique())))
+        known_phenotypes = known_phenotypes[~multi_pheno]
+    labels = dict(zip(known_phenotypes['user_id'].astype(str), known_phenotypes['phenotype'].astype(str)))
+
+    # the users are in the order of the genotype matrix, which is the order of the preprocessed files
+    header = pd.read_csv(genotypes_file, compression='gzip', nrows=0).columns
+    user_columns = [column for column in header[2:] if column in labels]
+    logger.info('{} of {} users with a known phenotype are in the genotype matrix'
+                .format(len(user_columns), len(labels)))
+
+    # the matrix is read once for each phenotype, so only the packed genotypes of the phenotypes are held
+    phenotypes = {}
+    for phenotype in sorted(set(labels[column] for column in user_columns)):
+        columns = [column for column in user_columns if labels[column] == phenotype]
+        phenotypes[phenotype] = PackedPhenotype.read_csv(genotypes_file, columns)
+        logger.info("{} users and {} SNPs for phenotype '{}'".format(len(columns), len(phenotypes[phenotype].snps),
+                                                                     phenotype))
+
+    if len(phenotypes) == 0:
+        raise ValueError('No users of the phenotype file "{}" are in the genotype matrix "{}"'
+                         .format(phenotypes_file, genotypes_file))
+
+    return phenotypes
+
+
+def prepare_data(phenotypes, invalid_thresh, invalid_user_thresh, relative_diff_thresh, data_split, negative,
+                 max_snps, output_dir=None, float32=False, plan=None):
+    """
+    Selects the model SNPs and prepares the training and testing data. The packed phenotypes are modified.
+    :param phenotypes: A map of phenotypes where the key is the phenotype ID and the value is the packed phenotype, see
+                       PackedPhenotype
+    :param invalid_thresh: The acceptable percentage of missing data before a SNP is discarded
+    :param invalid_user_thresh: The acceptable percentage of missing data before a user is discarded
+    :param relative_diff_thresh: The relative difference in mutation percent, calculated as a percent of the
+                                larger mutation percent value.
+    :param data_split: The percent data used for testing.
+    :param negative: The negative phenotype label
+    :param max_snps: The maximum number of SNPs to include in the model
+    :param output_dir: The directory to write the data summary in. If None the summary is only logged.
+    :param float32: If True the imputed data and the design matrices are float32 instead of float64
+    :param plan: An optional function that decides if the data is float32 before it is imputed. It is called with the
+                 number of training users, testing users and model SNPs and returns True for float32.
+    :return: The prepared data set, see common.prepare_data_set
+    """
+    data_set = timed_invoke('creating model data set', lambda: mutation_difference.create_dataset(
+                               phenotypes, invalid_thresh, invalid_user_thresh, relative_diff_thresh)
+                            )
+    if plan is not None:
+        # the same split sizes as the training and testing split
+        n_snps = len(data_set.columns) - 1 if max_snps is None else min(len(data_set.columns) - 1, max_snps)
+        n_test = int(math.ceil(len(data_set) * data_split / 100.0))
+        float32 = plan(len(data_set) - n_test, n_test, n_snps)
+
+    return timed_invoke('preparing training and testing data', lambda: common.prepare_data_set(
+                            data_set, data_split, negative, max_snps, output_dir, float32)
+                        )
+
+
+def train_model(model_data, model_id, no_interactions, cross_validation, output_dir=None, n_jobs=1,
+                estimator_jobs=-1, oob=False, interactions=None, compact=False):
+    """
+    Trains and tests a model on a prepared data set
+    :param model_data: The prepared data set, see prepare_data
+    :param model_id: The id of the model
+    :param no_interactions: If True the model will not contain interactions
+    :param cross_validation: number of folds for cross validation
+    :param output_dir: The directory to write the model in. If None nothing is written.
+    :param n_jobs: The number of processes used for the cross validation grid search
+    :param estimator_jobs: The number of threads the estimator may use
+    :param oob: If True the random forest parameters are selected with out-of-bag scores instead of cross validation
+    :param interactions: The number of screened SNP pairs the elastic net includes as interactions. If None all pairs
+                         are included.
+    :param compact: If True the model configuration only has the compiled scorer of the model instead of the fitted
+                    model, if the model can be compiled
+    :return: A tuple of the model configuration and the testing data metrics
+    """
+    if model_id not in MODELS:
+        raise ValueError('Model Id "{}" is not valid'.format(model_id))
+
+    # out-of-bag parameter selection is only supported by the random forest
+    options = {'oob': oob} if model_id == 'rf' else {}
+    options['compact'] = compact
+    # only the elastic net has interaction terms
+    if model_id == 'en':
+        options['interactions'] = interactions
+    return MODELS[model_id](model_data, no_interactions, cross_validation, output_dir, n_jobs, estimator_jobs,
+                            **options)
+
+
+def __train_model(model_id, output_dir, n_jobs, estimator_jobs):
+    """
+    Trains and tests a model on the shared prepared data set
+    :param model_id: The id of the model
+    :param output_dir: The directory to write the model in
+    :param n_jobs: The number of processes used for the cross validation grid search
+    :param estimator_jobs: The number of threads the estimator may use
+    :return: The testing data metrics and the training time
+    """
+    start = time.time()
+    _, metrics = train_model(__shared['model_data'], model_id, __shared['no_interactions'],
+                             __shared['cross_validation'], output_dir, n_jobs, estimator_jobs, __shared['oob'],
+                             __shared['interactions'], __shared['compact'])
+    metrics['model'] = model_id
+    metrics['training_seconds'] = round(time.time() - start, 1)
+    return metrics
+
+
+def __train_model_process(model_id, output_dir, n_jobs, estimator_jobs, results):
+    """
+    Trains a model in a child process and puts the metrics, or the error, in the results queue
+    """
+    setup_worker_profiler()
+    try:
+        results.put((model_id, __train_model(model_id, output_dir, n_jobs, estimator_jobs), None))
+    except Exception:
+        results.put((model_id, None, traceback.format_exc()))
+
+
+def __run_tournament(model_ids, output_dir, n_jobs):
+    """
+    Trains several models on the same prepared data set. The models are trained concurrently in separate processes,
+    dividing the CPU budget between them. Each model is written to a sub directory of the output directory.
+    :param model_ids: The ids of the models to train
+    :param output_dir: The directory to write the models in
+    :param n_jobs: The CPU budget for training all models
+    :return: A data frame comparing the testing data metrics of the models
+    """
+    concurrency = max(1, min(len(model_ids), n_jobs))
+    jobs_per_model = max(1, n_jobs // concurrency)
+    # the estimators are only multi-threaded when the CPU budget is not limited, as for a single model
+    estimator_jobs = -1 if n_jobs == 1 else 1
+    logger.info('Training {} models, {} at a time with {} grid search processes each'
+                .format(len(model_ids), concurrency, jobs_per_model))
+
+    model_dirs = {}
+    for model_id in model_ids:
+        model_dirs[model_id] = os.path.join(output_dir, model_id)
+        os.makedirs(model_dirs[model_id])
+
+    results = {}
+    errors = {}
+    if concurrency == 1:
+        for model_id in model_ids:
+            results[model_id] = __train_model(model_id, model_dirs[model_id], jobs_per_model, estimator_jobs)
+    else:
+        # The processes are not daemonic so that the grid searches can start their own worker processes
+        queue = Queue()
+        pending = list(model_ids)
+        running = {}
+        while pending or running:
+            while pending and len(running) < concurrency:
+                model_id = pending.pop(0)
+                process = Process(target=__train_model_process,
+                                  args=(model_id, model_dirs[model_id], jobs_per_model, estimator_jobs, queue))
+                process.start()
+                running[model_id] = process
+
+            try:
+                model_id, metrics, error = queue.get(timeout=1)
+            except Empty:
+                # a process that was killed never reports back
+                for model_id, process in running.items():
+                    if not process.is_alive() and process.exitcode != 0:
+                        running.pop(model_id)
+                        errors[model_id] = 'The process exited with code {}'.format(process.exitcode)
+                continue
+
+            running.pop(model_id).join()
+            if error is None:
+                results[model_id] = metrics
+            else:
+                errors[model_id] = error
+
+    comparison = pd.DataFrame([results[model_id] for model_id in model_ids if model_id in results],
+                              columns=COMPARISON_COLUMNS)
+    comparison.sort_values(by=['accuracy', 'auc'], ascending=False, inplace=True)
+    comparison.to_csv(os.path.join(output_dir, COMPARISON_FILE), index=False)
+    logger.info('Model comparison (testing data):{}{}'.format(os.linesep, comparison.to_string(index=False)))
+
+    if errors:
+        for model_id, error in errors.items():
+            logger.error('Model "{}" failed: {}'.format(model_id, error))
+        raise RuntimeError('{} of {} models failed: {}'.format(len(errors), len(model_ids), ', '.join(sorted(errors))))
+
+    return comparison
+
+
 def run(preprocessed_dir, invalid_thresh, invalid_user_thresh, relative_diff_thresh, data_split,
-        no_interactions, negative, max_snps, model_id, cross_validation, output_dir):
+        no_interactions, negative, max_snps, model_id, cross_validation, output_dir, n_jobs=1, oob=False,
+        interactions=None, float32=False, max_memory=None, genotypes_file=None, phenotypes_file=None, compact=False,
+        cache_dir=None, profile=False, profile_memory=False):
     """
     Builds a model to predict phenotype
     :param preprocessed_dir: The directory containing the preprocessed data
@@ -60,30 +282,115 @@ def run(preprocessed_dir, invalid_thresh, invalid_user_thresh, relative_diff_thr
     :param data_split: The percent data used for testing.
     :param no_interactions: If True the model will not contain interactions
     :param negative: The negative phenotype label
-    :param model_id: The id for the model to use
+    :param model_id: The id for the model to use, or a comma separated list of ids to train and compare several models
+                     on the same data set
     :param cross_validation: number of folds for cross validation
     :param output_dir: The directory to write the model in
+    :param n_jobs: The number of processes used for the cross validation grid search. When several models are trained
+                   this is the CPU budget for all of them.
+    :param oob: If True the random forest parameters are selected with out-of-bag scores instead of cross validation
+    :param interactions: The number of SNP pairs the elastic net includes as interactions. The pairs with the strongest
+                         interaction with the phenotype in the training data are selected. If None all pairs are
+                         included.
+    :param float32: If True the imputed data and the design matrices are float32 instead of float64. The values are
+                    small integers, so they are exact and the predictions do not change.
+    :param max_memory: The memory budget in megabytes. The float32 mode, the number of grid search processes and the
+                       number of interactions are chosen from the data dimensions so that training fits the budget.
+                       If None the settings are used as given.
+    :param genotypes_file: The cohort genotype matrix written by the preprocess step. If set the data set is created
+                           for the phenotypes of phenotypes_file by selecting the columns of their users, instead of
+                           reading the preprocessed files.
+    :param phenotypes_file: The CSV file with the user_id and phenotype columns of the users, used with genotypes_file
+    :param compact: If True the saved model configuration only has the compiled scorer of each model instead of the
+                    fitted model, which makes it much smaller and faster to load
+    :param cache_dir: The stage cache directory. If the preprocessed files, the parameters and the code did not change
+                      since a run with the same cache directory, the outputs of that run are linked into the output
+                      directory instead of building the model again. If None nothing is cached.
+    :param profile: If True each stage is profiled and the reports are written to the output directory
+    :param profile_memory: If True the memory allocations of each profiled stage are traced
     """
     # Expand file paths
     preprocessed_dir = expand_path(preprocessed_dir)
+    if (genotypes_file is None) != (phenotypes_file is None):
+        raise ValueError('The genotypes and phenotypes files must be used together')
+    inputs = [preprocessed_dir]
+    if genotypes_file is not None:
+        genotypes_file = expand_path(genotypes_file)
+        phenotypes_file = expand_path(phenotypes_file)
+        inputs = [genotypes_file, phenotypes_file]
+
+    model_ids = [m.strip() for m in model_id.split(',')]
+    cache = None
+    if cache_dir is not None:
+        cache = StageCache(expand_path(cache_dir))
+        params = {'invalid_thresh': invalid_thresh, 'invalid_user_thresh': invalid_user_thresh,
+                  'relative_diff_thresh': relative_diff_thresh, 'data_split': data_split,
+                  'no_interactions': no_interactions, 'negative': negative, 'max_snps': max_snps,
+                  'model_ids': model_ids, 'cross_validation': cross_validation, 'oob': oob,
+                  'interactions': interactions, 'float32': float32, 'max_memory': max_memory,
+                  'compact': compact}
+        fingerprint = cache.fingerprint('model', params, inputs)
+        if cache.restore(fingerprint, output_dir):
+            setup_logger(output_dir, '_'.join(model_ids) + "_model")
+            logger.info('The preprocessed files and parameters are unchanged, the model was restored from the stage '
+                        'cache "{}"'.format(cache.cache_dir))
+            logger.info('Output written to "{}"'.format(output_dir))
+            return
 
     # Make sure output directory exists before doing work
     clean_output(output_dir)
 
-    setup_logger(output_dir, model_id + "_model")
-
-    # Get model
-    build_model = MODELS.get(model_id)
-    if not build_model:
-        raise ValueError('Model Id "{}" is not valid'.format(model_id))
-
-    phenotypes = timed_invoke('reading the preprocessed files', lambda: __read_phenotype_input(preprocessed_dir))
-
-    data_set = timed_invoke('creating model data set', lambda: mutation_difference.create_dataset(
-                               phenotypes, invalid_thresh, invalid_user_thresh, relative_diff_thresh)
-                            )
-    timed_invoke('building model', lambda: build_model(data_set, data_split, no_interactions, negative, max_snps,
-                                                       cross_validation, output_dir))
+    setup_logger(output_dir, '_'.join(model_ids) + "_model")
+    setup_profiler(output_dir, profile, profile_memory)
+
+    # Get models
+    for m in model_ids:
+        if m not in MODELS:
+            raise ValueError('Model Id "{}" is not valid'.format(m))
+    if len(set(model_ids)) != len(model_ids):
+        raise ValueError('Model Ids "{}" contain duplicates'.format(model_id))
+
+    if genotypes_file is not None:
+        phenotypes = timed_invoke('reading the genotype matrix', lambda: __read_genotype_input(
+            genotypes_file, phenotypes_file))
+    else:
+        phenotypes = timed_invoke('reading the preprocessed files', lambda: __read_phenotype_input(preprocessed_dir))
+
+    settings = {'n_jobs': n_jobs, 'interactions': interactions}
+
+    def plan_model(n_train, n_test, n_snps):
+        # the phenotype data frames and the prepared data are held while the models are trained
+        base_bytes = sum(phenotype.nbytes for phenotype in phenotypes.values()) + \
+            (n_train + n_test) * n_snps * memory_plan.VALUE_BYTES
+        plan = memory_plan.plan_model(
+            max_memory, n_train, n_test, n_snps, base_bytes, no_interactions or 'en' not in model_ids, interactions,
+            float32, n_jobs, cross_validation, len(model_ids))
+        settings.update(plan)
+        return plan['float32']
+
+    model_data = prepare_data(phenotypes, invalid_thresh, invalid_user_thresh, relative_diff_thresh, data_split,
+                              negative, max_snps, output_dir, float32, None if max_memory is None else plan_model)
+    n_jobs = settings['n_jobs']
+    interactions = settings['interactions']
+
+    __shared['model_data'] = model_data
+    __shared['no_interactions'] = no_interactions
+    __shared['cross_validation'] = cross_validation
+    __shared['oob'] = oob
+    if oob and 'rf' not in model_ids:
+        logger.warning('Out-of-bag evaluation is only used for the random forest model')
+    __shared['interactions'] = interactions
+    __shared['compact'] = compact
+    if interactions is not None and (no_interactions or 'en' not in model_ids):
+        logger.warning('Interaction screening is only used for the elastic net model with interactions')
+    if len(model_ids) == 1:
+        timed_invoke('building model', lambda: __train_model(model_ids[0], output_dir, n_jobs,
+                                                             -1 if n_jobs == 1 else 1))
+    else:
+        timed_invoke('building models', lambda: __run_tournament(model_ids, output_dir, n_jobs))
+
+    if cache is not None:
+        timed_invoke('adding the model to the stage cache', lambda: cache.store(fingerprint, output_dir))
     logger.info('Output written to "{}"'.format(output_dir))
 
 
@@ -178,6 +485,9 @@ if __name__ == '__main__':
              "\nen = Elastic net"
              "\ndt = Decision tree"
              "\nrf = Random Forest"
+             "\nSeveral comma separated models (i.e. en,dt,rf) are trained concurrently on the same training and "
+             "testing data. Each model is written to a sub directory of the output directory and the models are "
+             "compared in model_comparison.csv."
              "\n\n Default: rf"
     )
 
@@ -200,8 +510,123 @@ if __name__ == '__main__':
              "\n\nDefault: resources/data/model"
     )
 
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        type=int,
+        default=1,
+        help="The number of processes used for the cross validation grid search. The training data is shared with "
+             "the processes through a memory-mapped file, so memory use does not grow with the number of jobs. "
+             "When several models are trained this is the CPU budget that is divided between them."
+             "\n\nDefault: 1"
+    )
+
+    parser.add_argument(
+        "--oob",
+        "-oob",
+        default=False,
+        action='store_true',
+        help="If set then the random forest parameters are selected with out-of-bag scores instead of k-fold cross "
+             "validation. The forest grows until the out-of-bag score stops improving, up to n_estimators trees."
+             "\n\nDefault: False"
+    )
+
+    parser.add_argument(
+        "--interactions",
+        "-int",
+        type=int,
+        metavar="pairs",
+        help="The number of SNP pairs included as interactions in the elastic net model. All pairs are scored on the "
+             "training data by the correlation of their product with the phenotype and only the best pairs are "
+             "included, so the model has far fewer terms. The selected pairs are saved with the model."
+             "\n\nDefault: all pairs"
+    )
+
+    parser.add_argument(
+        "--float32",
+        "-f32",
+        default=False,
+        action='store_true',
+        help="If set then the imputed data and the model design matrices are stored as float32 instead of float64, "
+             "which halves the memory of the largest training arrays. The values are exact in float32, which is "
+             "checked before the design matrices are built, and the model predicts with float64 data if the float32 "
+             "test predictions differ."
+             "\n\nDefault: False"
+    )
+
+    parser.add_argument(
+        "--max-memory",
+        "-mm",
+        type=int,
+        metavar="<megabytes>",
+        help="The memory budget in megabytes. The working set of training is estimated from the number of users, "
+             "SNPs and interactions, and float32 design matrices, fewer grid search processes and fewer screened "
+             "interactions are used, in that order, until it fits. The plan is logged."
+             "\n\nDefault: no limit"
+    )
+
+    parser.add_argument(
+        "--genotypes",
+        "-g",
+        metavar="<file path>",
+        help="The cohort genotype matrix (genotypes.csv.gz) written by the preprocess step with --cohort. If set with "
+             "--phenotypes then the data set is created by selecting the users of the phenotype file from the matrix, "
+             "instead of reading the preprocessed files, so a new phenotype does not need to be preprocessed."
+    )
+
+    parser.add_argument(
+        "--phenotypes",
+        "-ph",
+        metavar="<file path>",
+        help="The known phenotypes CSV file with the user_id and phenotype columns, used with --genotypes. It has the "
+             "same format as the preprocess --known-phenos file."
+    )
+
+    parser.add_argument(
+        "--compact",
+        "-c",
+        default=False,
+        action='store_true',
+        help="If set then the fitted scikit-learn model is not saved in model_config.pkl, only the scorer it is "
+             "compiled into: the node arrays of the trees or the coefficients of the elastic net. Predictions are the "
+             "same, and the model is much smaller and faster to load. The model can not be used with scikit-learn."
+             "\n\nDefault: False"
+    )
+
+    parser.add_argument(
+        "--cache-dir",
+        "-cd",
+        metavar="<directory path>",
+        help="The stage cache directory. The outputs of each run are stored in the cache by the hash of the "
+             "preprocessed files, the parameters and the code. When they did not change the cached outputs are linked "
+             "into the output directory instead of building the model again."
+             "\n\nDefault: no cache"
+    )
+
+    parser.add_argument(
+        "--profile",
+        "-pf",
+        default=False,
+        action='store_true',
+        help="If set then each stage is profiled with cProfile. The pstats files and a summary of the slowest "
+             "functions for each stage are written to the output directory."
+             "\n\nDefault: False"
+    )
+
+    parser.add_argument(
+        "--profile-memory",
+        "-pm",
+        default=False,
+        action='store_true',
+        help="If set with --profile then the memory allocations of each stage are also traced with tracemalloc and "
+             "the top allocations are written to the output directory. Requires Python 3.4 or later, older "
+             "versions log a warning and only profile the time."
+             "\n\nDefault: False"
+    )
+
     args = parser.parse_args()
 
     run(args.preprocessed, args.invalid_snp_thresh, args.invalid_user_thresh, args.relative_diff_thresh,
         args.split, args.no_interactions, args.negative, args.max_snps, args.model, args.cross_validation,
-        args.output)
+        args.output, args.jobs, args.oob, args.interactions, args.float32, args.max_memory, args.genotypes,
+        args.phenotypes, args.compact, args.cache_dir, args.profile, args.profile_memory)
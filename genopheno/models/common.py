@@ -5,34 +5,38 @@ mp.use('Agg')
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
+import os
 import pickle
-from patsy import ModelDesc, EvalFactor, Term, dmatrix
+import shutil
+import tempfile
+from patsy import ModelDesc, EvalFactor, Term
 from os import linesep, path
-from sklearn.preprocessing import Imputer
+from imputer import GenotypeImputer
+import scorers
+from snp_selectors.interaction_screen import screen_interactions
 from sklearn.model_selection import train_test_split, GridSearchCV
 from sklearn.metrics import roc_curve, auc
 
 import logging
 logger = logging.getLogger("root")
 
+# Integers up to this magnitude and their pairwise products are exact in float32, which has a 24 bit significand
+FLOAT32_EXACT_MAX = 2 ** 12
 
-def build_model(data_set, data_split, no_interactions, negative, model, cross_validation, max_snps, output_dir,
-                param_grid={}, model_eval={}):
+
+def prepare_data_set(data_set, data_split, negative, max_snps, output_dir, float32=False):
     """
-    Builds a model for the data set
+    Splits the data set into training and testing data and fills in the missing data. The prepared data is shared by
+    all models trained on the data set.
     :param data_set: The data set (training and testing)
     :param data_split: The percentage of data that should be used for testing
-    :param no_interactions: If false interactions aren't included in the model
     :param negative: The negative phenotype label
-    :param model: The model to use for training and testing the data
-    :param cross_validation: The number of folds for k-fold cross validation
     :param max_snps: The maximum number of SNPs for the model to include
-    :param output_dir: The directory to write the model artifacts in
-    :param param_grid: The parameter matrix for the model
-    :param model_eval: A dictionary of optional model evaluation methods
+    :param output_dir: The directory to write the data summary in. If None the summary is only logged.
+    :param float32: If True the imputed data is stored as float32, which halves its memory
+    :return: A dictionary with the SNP columns, phenotype mapping, imputer fill values and the imputed training and
+             testing data
     """
-    model_config = {}
-
     # Split the data into testing and training data
     x = data_set.drop(labels=['phenotype'], axis=1)
     snp_columns = x.columns.values
@@ -41,7 +45,6 @@ def build_model(data_set, data_split, no_interactions, negative, model, cross_va
                        .format(len(snp_columns), max_snps))
         snp_columns = snp_columns[:max_snps]
         x = x[snp_columns]
-    model_config['snps'] = snp_columns
     y = data_set['phenotype']
     x_train, x_test, y_train, y_test = train_test_split(
         x, y, test_size=data_split/float(100), random_state=1, stratify=y
@@ -53,52 +56,199 @@ def build_model(data_set, data_split, no_interactions, negative, model, cross_va
     # rows are chosen based on which phenotype is assigned a 0 and 1. Do this after the split means consistent rows
     # will be selected regardless of which phenotype is assigned as the negative.
     pheno_map = __pheno_to_binary(y_train, y_test, negative)
-    model_config['pheno_map'] = pheno_map
 
     # Replace nan values
-    imputer, x_train, x_test = __impute_data(x_train, x_test)
-    model_config['imputer'] = imputer
+    imputer, x_train, x_test = __impute_data(x_train, x_test, np.float32 if float32 else np.float64)
 
     # print data counts
     __save_data_summary(pheno_map, y_train, y_test, len(snp_columns), output_dir)
 
-    # Define model
-    model_config['no_interactions'] = no_interactions
-    model_desc = build_model_desc(snp_columns, no_interactions)
-    x_train = dmatrix(model_desc, pd.DataFrame(x_train, columns=snp_columns))
-    x_test = dmatrix(model_desc, pd.DataFrame(x_test, columns=snp_columns))
+    return {
+        'snps': snp_columns,
+        'pheno_map': pheno_map,
+        'imputer': imputer.fill_values,
+        'x_train': x_train,
+        'x_test': x_test,
+        'y_train': y_train,
+        'y_test': y_test
+    }
 
-    # Fit training data to model
-    grid = GridSearchCV(model, param_grid=param_grid, cv=cross_validation, verbose=5)
-    grid.fit(x_train, y_train)
-    best_model = grid.best_estimator_
-    model_config['model'] = best_model
-    __save_model(model_config, output_dir)
-    logger.info('Best estimator params found during grid search: {}'.format(grid.best_params_))
 
-    # Test model
-    y_pred = best_model.predict(x_test)
-    __save_confusion_matrix(y_test, y_pred, output_dir, 'testing_data')
-    __save_confusion_matrix(y_train, best_model.predict(x_train), output_dir, 'training_data')
+def build_model(model_data, no_interactions, model, cross_validation, output_dir, param_grid={}, model_eval={},
+                n_jobs=1, search=None, interactions=None, compile_scorer=None, compact=False):
+    """
+    Builds a model for the data set
+    :param model_data: The prepared training and testing data, see prepare_data_set
+    :param no_interactions: If false interactions aren't included in the model
+    :param model: The model to use for training and testing the data
+    :param cross_validation: The number of folds for k-fold cross validation
+    :param output_dir: The directory to write the model artifacts in. If None nothing is written.
+    :param param_grid: The parameter matrix for the model
+    :param model_eval: A dictionary of optional model evaluation methods
+    :param n_jobs: The number of processes used for the cross validation grid search
+    :param search: An optional function that selects the model parameters instead of the cross validation grid
+                   search. It has the same arguments as grid_search and returns the fitted model and its parameters.
+    :param interactions: The number of SNP pairs to include as interactions. The pairs are screened on the training
+                         data. If None all pairs are included.
+    :param compile_scorer: An optional function that compiles the fitted model into a scorer, see scorers. It is called
+                           with the fitted model, the SNP labels, no_interactions and the interaction pairs. The scorer
+                           is saved in the model configuration if it predicts the same as the model.
+    :param compact: If True the fitted model is not saved in the model configuration when it is compiled into a
+                    scorer, which makes the configuration much smaller and faster to load
+    :return: A tuple of the model configuration, which contains everything needed to make predictions, and a
+             dictionary of the testing data metrics (accuracy, sensitivity, specificity and AUC if the model supports
+             an ROC curve) and the best parameters found in the grid search
+    """
+    snp_columns = model_data['snps']
+    y_train = model_data['y_train']
+    y_test = model_data['y_test']
+
+    # Keep only the strongest interactions. The pairs are saved in the model so predictions use the same terms.
+    pairs = None
+    n_pairs = len(snp_columns) * (len(snp_columns) - 1) // 2
+    if not no_interactions and interactions is not None and interactions < n_pairs:
+        pairs, _ = screen_interactions(model_data['x_train'], y_train, interactions)
+        pairs = [(snp_columns[i], snp_columns[j]) for i, j in pairs]
+
+    # The imputer fill values are saved as a plain array
+    model_config = {
+        'snps': snp_columns,
+        'pheno_map': model_data['pheno_map'],
+        'imputer': model_data['imputer'],
+        'no_interactions': no_interactions,
+        'interactions': pairs
+    }
+
+    # Define model. The design matrix has the type of the imputed data if its values are exact in that type.
+    model_desc = build_model_desc(snp_columns, no_interactions, pairs)
+    dtype = model_data['x_train'].dtype
+    if dtype == np.float32 and not __float32_exact(model_data['x_train'], no_interactions):
+        logger.warning('The model data is not exact in float32, the design matrix is built as float64')
+        dtype = np.float64
+    x_test = design_matrix(model_data['x_test'], snp_columns, no_interactions, pairs, dtype)
+
+    # The training design matrix is built directly in a memory-mapped file so that all cross validation and
+    # estimator workers read the same buffer instead of each getting a copy of it, and it is never held twice
+    shared_dir = __create_shared_dir()
+    x_train = None
+    try:
+        x_train = __shared_design_matrix(model_data['x_train'], snp_columns, no_interactions, pairs, dtype,
+                                         path.join(shared_dir, 'x_train.mmap'))
+
+        # Fit training data to model
+        search = search or grid_search
+        best_model, best_params = search(model, param_grid, cross_validation, x_train, y_train, n_jobs)
+        model_config['model'] = best_model
+
+        # Predictions are made with the design matrix type of the training data, unless it changes the predictions
+        y_pred = best_model.predict(x_test)
+        model_config['dtype'] = np.dtype(dtype).name
+        if dtype != np.float64 and not np.array_equal(y_pred, best_model.predict(x_test.astype(np.float64))):
+            logger.warning('The {} test data predictions differ from the float64 predictions, predictions will be '
+                           'made with float64 data'.format(model_config['dtype']))
+            model_config['dtype'] = 'float64'
+
+        train_pred = best_model.predict(x_train)
+        if compile_scorer is not None:
+            scorer = compile_scorer(best_model, snp_columns, no_interactions, pairs)
+            score = scorers.build(scorer)
+            if np.array_equal(score(model_data['x_test']), y_pred) and \
+                    np.array_equal(score(model_data['x_train']), train_pred):
+                model_config['scorer'] = scorer
+            else:
+                logger.warning('The compiled scorer predictions differ from the model predictions, predictions will '
+                               'be made with the model')
+        if compact:
+            if 'scorer' in model_config:
+                model_config['model'] = None
+            else:
+                logger.warning('The model is not compiled into a scorer, the model is saved')
+
+        if output_dir is not None:
+            __save_model(model_config, output_dir)
+        logger.info('Best estimator params found during parameter search: {}'.format(best_params))
+
+        # Test model
+        metrics = __save_confusion_matrix(y_test, y_pred, output_dir, 'testing_data')
+        __save_confusion_matrix(y_train, train_pred, output_dir, 'training_data')
+    finally:
+        del x_train
+        shutil.rmtree(shared_dir, ignore_errors=True)
+
+    metrics['best_params'] = best_params
 
     # Optional model stats
+    metrics['auc'] = None
     roc_probs = model_eval.get('roc')
     if roc_probs:
-        __save_roc(y_test, roc_probs(best_model, x_test), output_dir)
+        metrics['auc'] = __save_roc(y_test, roc_probs(best_model, x_test), output_dir)
 
     features = model_eval.get('features')
-    if features:
+    if features and output_dir is not None:
         model_terms = __get_model_term_labels(model_desc)
         features(best_model, model_terms, output_dir)
 
+    return model_config, metrics
+
+
+def grid_search(model, param_grid, cross_validation, x_train, y_train, n_jobs):
+    """
+    Selects the model parameters with a k-fold cross validation grid search
+    :param model: The model to fit
+    :param param_grid: The parameter matrix for the model
+    :param cross_validation: The number of folds for k-fold cross validation
+    :param x_train: The training data
+    :param y_train: The training phenotypes
+    :param n_jobs: The number of processes used for the grid search
+    :return: The model fitted with the best parameters and the best parameters
+    """
+    grid = GridSearchCV(model, param_grid=param_grid, cv=cross_validation, verbose=5, n_jobs=n_jobs,
+                        pre_dispatch='n_jobs')
+    grid.fit(x_train, y_train)
+    return grid.best_estimator_, grid.best_params_
+
+
+def __create_shared_dir():
+    """
+    Creates a temporary directory for memory-mapped arrays. Shared memory is used if it is available.
+    :return: The directory path
+    """
+    shm = '/dev/shm'
+    if path.isdir(shm) and os.access(shm, os.W_OK):
+        return tempfile.mkdtemp(prefix='genopheno_', dir=shm)
+
+    return tempfile.mkdtemp(prefix='genopheno_')
+
+
+def __shared_design_matrix(x, snps, no_interactions, pairs, dtype, file_path):
+    """
+    Builds the design matrix in a read-only memory-mapped file. Joblib passes memory-mapped arrays to worker
+    processes by reference, so the workers read the data without copying it.
+    :param x: The imputed data with a column for each SNP
+    :param snps: The selected snp labels
+    :param no_interactions: If false, interactions will not be included in the model
+    :param pairs: The SNP label pairs to include as interactions. If None all pairs are included.
+    :param dtype: The type of the design matrix
+    :param file_path: The path of the memory-mapped file
+    :return: The memory-mapped design matrix
+    """
+    shared = design_matrix(x, snps, no_interactions, pairs, dtype,
+                           lambda shape, dtype: np.memmap(file_path, dtype=dtype, mode='w+', shape=shape))
+    shared.flush()
+    shape = shared.shape
+    del shared
+
+    return np.memmap(file_path, dtype=dtype, mode='r', shape=shape)
+
 
 def __save_confusion_matrix(y_true, y_pred, output_dir, file_suffix):
     """
     Calculates the metrics for the model prediction using a confusion matrix
     :param y_true: The test data provided as a numpy array
     :param y_pred: The test predicted by the model as a numpy array
-    :param output_dir: The directory to write the results to
+    :param output_dir: The directory to write the results to. If None the results are only logged.
     :param file_suffix: The suffix for the output file name
+    :return: A dictionary with the accuracy, sensitivity and specificity
     """
     confusion_matrix = skm.confusion_matrix(y_true, y_pred)
     true_pos = confusion_matrix[1][1]
@@ -122,8 +272,11 @@ def __save_confusion_matrix(y_true, y_pred, output_dir, file_suffix):
                 linesep)
 
     logger.info(metrics)
-    with open(path.join(output_dir, 'confusion_matrix_{}.txt'.format(file_suffix)), 'w') as metrics_file:
-        metrics_file.write(metrics)
+    if output_dir is not None:
+        with open(path.join(output_dir, 'confusion_matrix_{}.txt'.format(file_suffix)), 'w') as metrics_file:
+            metrics_file.write(metrics)
+
+    return {'accuracy': accuracy, 'sensitivity': sensitivity, 'specificity': specificity}
 
 
 def __pheno_to_binary(y_train, y_test, negative):
@@ -154,52 +307,127 @@ def __pheno_to_binary(y_train, y_test, negative):
     return {0: negative, 1: positive}
 
 
-def __impute_data(x_train, x_test):
+def __impute_data(x_train, x_test, dtype):
     """
     Fills in the missing data. nan values will be replaced with the most frequent value for the feature
     :param x_train: The training data
     :param x_test: The test data
+    :param dtype: The type of the imputed data
     :return: The fitted imputer, modified training and test data.
     """
-    imputer = Imputer(missing_values='NaN', strategy='most_frequent', axis=0, copy=True, verbose=1)
-
-    train_snp_count = x_train.shape[1]
-    x_train = imputer.fit_transform(x_train)
-    if train_snp_count > x_train.shape[1]:
+    imputer = GenotypeImputer().fit(x_train)
+    if np.isnan(imputer.fill_values).any():
         raise ValueError('A SNP column was dropped while imputing the training set. '
                          'This means the entire feature had no data. Try decreasing the invalid SNP threshold.')
 
-    test_snp_count = x_test.shape[1]
-    x_test = imputer.transform(x_test)
-    if test_snp_count > x_test.shape[1]:
-        raise ValueError('A SNP column was dropped while imputing the test set. '
-                         'This means the entire feature had no data. Try decreasing the invalid SNP threshold.')
+    return imputer, imputer.transform(x_train, dtype), imputer.transform(x_test, dtype)
+
 
-    return imputer, x_train, x_test
+def __float32_exact(x, no_interactions):
+    """
+    Checks that the design matrix of the data is exact in float32. The data must be integers, and small enough that
+    the interaction products are integers below 2 ** 24.
+    :param x: The imputed data
+    :param no_interactions: If True the design matrix has no interaction products
+    :return: True if the design matrix is exact in float32
+    """
+    limit = 2 ** 24 if no_interactions else FLOAT32_EXACT_MAX
+    return bool(np.all(np.floor(x) == x) and np.all(np.abs(x) <= limit))
 
 
-def build_model_desc(snps, no_interactions):
+def build_model_desc(snps, no_interactions, pairs=None):
     """
     Creates the model description (formula)
     :param snps: The selected snp labels
     :param no_interactions: If false, interactions will not be included in the model
+    :param pairs: The SNP label pairs to include as interactions. If None all pairs are included.
     :return: The model description
     """
     x_terms = []
-    for i in range(len(snps)):
+    for i, partners in __model_terms(snps, no_interactions, pairs):
         # Main effects
         snp_i = EvalFactor(snps[i])
         x_terms.append(Term([snp_i]))
 
-        if not no_interactions:
-            for j in range(i + 1, len(snps)):
-                # Interaction effects
-                snp_j = EvalFactor(snps[j])
-                x_terms.append(Term([snp_i, snp_j]))
+        # Interaction effects
+        for j in partners:
+            x_terms.append(Term([snp_i, EvalFactor(snps[j])]))
 
     return ModelDesc([], x_terms)
 
 
+def design_matrix(x, snps, no_interactions, pairs=None, dtype=np.float64, allocate=np.empty):
+    """
+    Creates the design matrix of the model description of build_model_desc, with the same columns as the patsy
+    design matrix. The interaction columns of each SNP are multiplied at once into the matrix, so no intermediate data
+    frames or copies are created.
+    :param x: The imputed data with a column for each SNP
+    :param snps: The selected snp labels
+    :param no_interactions: If false, interactions will not be included in the model
+    :param pairs: The SNP label pairs to include as interactions. If None all pairs are included.
+    :param dtype: The type of the design matrix
+    :param allocate: The function that allocates the uninitialized design matrix from its shape and type
+    :return: The design matrix
+    """
+    x = np.asarray(x, dtype=dtype)
+    terms = __model_terms(snps, no_interactions, pairs)
+    design = allocate((x.shape[0], sum(1 + len(partners) for _, partners in terms)), dtype)
+
+    column = 0
+    for i, partners in terms:
+        design[:, column] = x[:, i]
+        if len(partners) > 0:
+            # the partners of all pairs are the next SNPs, which are a view of the data
+            if isinstance(partners, xrange):
+                partner_data = x[:, partners[0]:partners[-1] + 1]
+            else:
+                partner_data = x[:, partners]
+            np.multiply(x[:, i:i + 1], partner_data, out=design[:, column + 1:column + 1 + len(partners)])
+        column += 1 + len(partners)
+
+    return design
+
+
+def term_snps(snps, no_interactions, pairs=None):
+    """
+    Gets the SNPs of each design matrix column of the model description of build_model_desc
+    :param snps: The selected snp labels
+    :param no_interactions: If false, interactions will not be included in the model
+    :param pairs: The SNP label pairs to include as interactions. If None all pairs are included.
+    :return: A tuple of two int arrays with the position of the first and second SNP of each column. The second
+             position is -1 for main effects.
+    """
+    first, second = [], []
+    for i, partners in __model_terms(snps, no_interactions, pairs):
+        first.extend([i] * (1 + len(partners)))
+        second.append(-1)
+        second.extend(partners)
+
+    return np.array(first, dtype=np.intp), np.array(second, dtype=np.intp)
+
+
+def __model_terms(snps, no_interactions, pairs):
+    """
+    Lists the model terms in design matrix order, each main effect followed by its interactions with later SNPs
+    :param snps: The selected snp labels
+    :param no_interactions: If false, interactions will not be included in the model
+    :param pairs: The SNP label pairs to include as interactions. If None all pairs are included.
+    :return: A list of tuples of a SNP position and the positions of the SNPs it interacts with
+    """
+    if no_interactions:
+        return [(i, []) for i in range(len(snps))]
+    if pairs is None:
+        return [(i, xrange(i + 1, len(snps))) for i in range(len(snps))]
+
+    positions = dict((snp, i) for i, snp in enumerate(snps))
+    partners = [[] for _ in snps]
+    for snp_a, snp_b in pairs:
+        i, j = sorted([positions[snp_a], positions[snp_b]])
+        partners[i].append(j)
+
+    return [(i, sorted(partners[i])) for i in range(len(snps))]
+
+
 def __get_model_term_labels(model_desc):
     term_labels = []
     for term in model_desc.rhs_termlist:
@@ -240,8 +468,8 @@ def __save_model(model_config, output_dir):
     :param output_dir: The directory to write the imputer and model to
     """
     try:
-        with open(path.join(output_dir, 'model_config.pkl'), 'w') as f:
-            f.write(pickle.dumps(model_config))
+        with open(path.join(output_dir, 'model_config.pkl'), 'wb') as f:
+            pickle.dump(model_config, f, pickle.HIGHEST_PROTOCOL)
     except Exception as e:
         logger.info('Cannot save model: {}'.format(e))
 
@@ -251,10 +479,13 @@ def __save_roc(y_true, y_pred, output_dir):
     Creates an ROC curve with AUC for the model
     :param y_true: The actual phenotypes for the test data
     :param y_pred: The predicted phenotypes for the test data
-    :param output_dir: The directory to save the ROC curve in
+    :param output_dir: The directory to save the ROC curve in. If None the curve is not plotted.
+    :return: The area under the curve
     """
     fpr, tpr, thresholds = roc_curve(y_true, y_pred)
     roc_auc = auc(fpr, tpr)
+    if output_dir is None:
+        return roc_auc
 
     # Plot code referenced from http://scikit-learn.org/stable/auto_examples/model_selection/plot_roc.html
     plt.figure()
@@ -271,6 +502,8 @@ def __save_roc(y_true, y_pred, output_dir):
     plt.savefig(path.join(output_dir, 'roc.png'))
     plt.close()
 
+    return roc_auc
+
 
 def __save_data_summary(pheno_map, y_train, y_test, n_snps, output_dir):
     # counts for phenotypes
@@ -302,6 +535,8 @@ def __save_data_summary(pheno_map, y_train, y_test, n_snps, output_dir):
 
     logger.info(pheno_summary)
     logger.info(count_summary)
+    if output_dir is None:
+        return
 
     # write to file
     with open(path.join(output_dir, 'data_summary.txt'), 'w') as summary_file:
@@ -2,11 +2,11 @@ import numpy as np
 import pandas as pd
 import pydotplus
 import common
+import scorers
 from os.path import join
 from os import remove
 from sklearn import tree
 from operator import itemgetter
-from sklearn.preprocessing import Imputer
 from sklearn.model_selection import train_test_split, GridSearchCV
 from sklearn.metrics import confusion_matrix
 
@@ -14,7 +14,8 @@ from sklearn.metrics import confusion_matrix
 pydotplus.find_graphviz()
 
 
-def build_model(data_set, data_split, no_interactions, negative, max_snps, cross_validation, output_dir):
+def build_model(model_data, no_interactions, cross_validation, output_dir, n_jobs=1, estimator_jobs=-1, compact=False):
+    # A decision tree is always built in a single thread, so estimator_jobs is not used
     param_grid = {
         "criterion": ["gini", "entropy"],
           #If float then min_samples_split is a percentage and ceil(min_samples_split * n_samples)
@@ -34,17 +35,17 @@ def build_model(data_set, data_split, no_interactions, negative, max_snps, cross
         'features': save_features
     }
 
-    common.build_model(
-        data_set,
-        data_split,
+    return common.build_model(
+        model_data,
         True,
-        negative,
         tree.DecisionTreeClassifier(random_state=1),
         cross_validation,
-        max_snps,
         output_dir,
         param_grid,
-        model_eval
+        model_eval,
+        n_jobs,
+        compile_scorer=scorers.compile_forest,
+        compact=compact
     )
 
 
@@ -1,18 +1,27 @@
 import common
+import scorers
+import numpy as np
 import pandas as pd
 from os import path, linesep
 from sklearn.linear_model import SGDClassifier
 
+import logging
+logger = logging.getLogger('root')
 
-def build_model(data_set, data_split, no_interactions, negative, max_snps, cross_validation, output_dir):
+
+def build_model(model_data, no_interactions, cross_validation, output_dir, n_jobs=1, estimator_jobs=-1,
+                interactions=None, compact=False):
     """
     Builds a model using logistic regression and an elastic net penalty
-    :param data_set: The feature data set
-    :param data_split: The percentage of data to use for testing the model
+    :param model_data: The prepared training and testing data
     :param no_interactions: If True interactions will not be included in the model
-    :param negative: The negative phenotype label
-    :param max_snps: The maximum number of SNPs for the model to include
-    :param output_dir: The directory to write the model to
+    :param cross_validation: The number of folds for k-fold cross validation
+    :param output_dir: The directory to write the model to. If None nothing is written.
+    :param n_jobs: The number of processes used for the cross validation grid search
+    :param estimator_jobs: The number of threads the estimator may use, -1 for all CPUs
+    :param interactions: The number of screened SNP pairs to include as interactions. If None all pairs are included.
+    :param compact: If True the model configuration only has the compiled scorer instead of the fitted model
+    :return: The model configuration and the testing data metrics
     """
     l1_ratio = 0
     l1_ratios = []
@@ -28,21 +37,52 @@ def build_model(data_set, data_split, no_interactions, negative, max_snps, cross
         'features': save_features
     }
 
-    common.build_model(
-        data_set,
-        data_split,
+    return common.build_model(
+        model_data,
         no_interactions,
-        negative,
         SGDClassifier(
-            loss="log", penalty="elasticnet", random_state=1, n_jobs=-1, max_iter=1000, tol=1e-3),
+            loss="log", penalty="elasticnet", random_state=1, n_jobs=estimator_jobs, max_iter=1000, tol=1e-3),
         cross_validation,
-        max_snps,
         output_dir,
         param_grid,
-        model_eval
+        model_eval,
+        n_jobs,
+        interactions=interactions,
+        compile_scorer=compile_scorer,
+        compact=compact
     )
 
 
+def compile_scorer(model, snps, no_interactions, pairs=None):
+    """
+    Compiles the fitted model into a quadratic form scorer: the intercept, a main effect coefficient for each SNP and
+    the non-zero interaction coefficients as a sparse upper triangular matrix, see scorers
+    :param model: The fitted model
+    :param snps: The model SNP labels
+    :param no_interactions: If True the model has no interactions
+    :param pairs: The SNP label pairs of the interactions. If None the model has all pairs.
+    :return: The scorer
+    """
+    coefficients = model.coef_.ravel().astype(np.float64)
+    first, second = common.term_snps(snps, no_interactions, pairs)
+    main = second < 0
+    main_effects = np.zeros(len(snps))
+    main_effects[first[main]] = coefficients[main]
+
+    interactions = ~main & (coefficients != 0)
+    logger.info('Compiled the model into a scorer with {} of {} interaction terms'
+                .format(interactions.sum(), (~main).sum()))
+    return {
+        'type': scorers.QUADRATIC,
+        'intercept': float(model.intercept_[0]),
+        'main_effects': main_effects,
+        'rows': first[interactions].astype(np.int32),
+        'cols': second[interactions].astype(np.int32),
+        'weights': coefficients[interactions],
+        'classes': np.asarray(model.classes_)
+    }
+
+
 def get_roc_probs(model, x_test):
     """
     Gets the prediction probabilities to generate an ROC curve
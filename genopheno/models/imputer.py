@@ -0,0 +1,60 @@
+import numpy as np
+
+# The possible genotype values (number of mutations)
+GENOTYPES = 3
+
+
+class GenotypeImputer:
+    """
+    Replaces missing genotypes with the most frequent genotype of each SNP. This is equivalent to the scikit-learn
+    most frequent imputer, including choosing the smallest value for ties, but finds the mode of all SNPs at once by
+    counting the three possible genotype values with a single bincount.
+    """
+
+    def __init__(self, fill_values=None):
+        """
+        Creates a new imputer
+        :param fill_values: The value to replace missing data with for each SNP column, if the imputer is already fitted
+        """
+        self.fill_values = fill_values
+
+    def fit(self, x):
+        """
+        Finds the most frequent genotype of each SNP. SNPs without any data have a fill value of NaN.
+        :param x: The genotype matrix where each row is a user and each column is a SNP
+        :return: The imputer
+        """
+        x = np.asarray(x, dtype=np.float64)
+        n_snps = x.shape[1]
+
+        observed = ~np.isnan(x)
+        values = x[observed]
+        if np.any((values != 0) & (values != 1) & (values != 2)):
+            raise ValueError('Genotypes must be the number of mutations (0, 1 or 2) or missing')
+
+        # count each genotype of each SNP, the bins are ordered by SNP and then genotype
+        columns = np.broadcast_to(np.arange(n_snps), x.shape)[observed]
+        counts = np.bincount(columns * GENOTYPES + values.astype(np.intp), minlength=n_snps * GENOTYPES)\
+            .reshape(n_snps, GENOTYPES)
+
+        self.fill_values = counts.argmax(axis=1).astype(np.float64)
+        self.fill_values[counts.sum(axis=1) == 0] = np.nan
+        return self
+
+    def transform(self, x, dtype=np.float64):
+        """
+        Replaces the missing genotypes
+        :param x: The genotype matrix where each row is a user and each column is a SNP
+        :param dtype: The type of the returned matrix. The genotypes are exact in float32 and float64.
+        :return: A copy of the genotype matrix without missing values
+        """
+        x = np.array(x, dtype=dtype)
+        if x.shape[1] != len(self.fill_values):
+            raise ValueError('The data has {} SNPs, but the imputer was fitted with {} SNPs'
+                             .format(x.shape[1], len(self.fill_values)))
+
+        np.copyto(x, np.broadcast_to(self.fill_values.astype(dtype), x.shape), where=np.isnan(x))
+        return x
+
+    def fit_transform(self, x):
+        return self.fit(x).transform(x)
@@ -1,11 +1,38 @@
 import common
+import scorers
 import pandas as pd
 import os
 
+from sklearn.base import clone
 from sklearn.ensemble import RandomForestClassifier
+from sklearn.model_selection import ParameterGrid
 
+import logging
+logger = logging.getLogger('root')
 
-def build_model(dataset, data_split, no_interactions, negative, max_snps, cross_validation, output_dir):
+# The number of trees added to the forest in each out-of-bag growth step
+OOB_STEP = 50
+# The number of growth steps without an out-of-bag score improvement after which the forest stops growing
+OOB_PATIENCE = 3
+# The minimum out-of-bag score change that is an improvement
+OOB_TOLERANCE = 0.001
+
+
+def build_model(model_data, no_interactions, cross_validation, output_dir, n_jobs=1, estimator_jobs=-1, oob=False,
+                compact=False):
+    """
+    Builds a random forest model
+    :param model_data: The prepared training and testing data
+    :param no_interactions: Not used, interactions are never included in the model
+    :param cross_validation: The number of folds for k-fold cross validation
+    :param output_dir: The directory to write the model to. If None nothing is written.
+    :param n_jobs: The number of processes used for the cross validation grid search
+    :param estimator_jobs: The number of threads used to build the trees, -1 for all CPUs
+    :param oob: If True the parameters are selected with out-of-bag scores instead of k-fold cross validation and
+                the forests grow until the out-of-bag score stops improving
+    :param compact: If True the model configuration only has the compiled scorer instead of the fitted forest
+    :return: The model configuration and the testing data metrics
+    """
     model_eval = {
         'features': save_features
     }
@@ -37,20 +64,81 @@ def build_model(dataset, data_split, no_interactions, negative, max_snps, cross_
         "n_estimators": [500, 1000, 3000]
     }
 
-    common.build_model(
-        dataset,
-        data_split,
+    return common.build_model(
+        model_data,
         True,
-        negative,
-        RandomForestClassifier(n_jobs=-1),
+        # the trees are built in estimator_jobs threads
+        RandomForestClassifier(n_jobs=estimator_jobs),
         cross_validation,
-        max_snps,
         output_dir,
         param_grid=default_grid,
-        model_eval=model_eval
+        model_eval=model_eval,
+        n_jobs=n_jobs,
+        search=oob_search if oob else None,
+        compile_scorer=scorers.compile_forest,
+        compact=compact
     )
 
 
+def oob_search(model, param_grid, cross_validation, x_train, y_train, n_jobs):
+    """
+    Selects the random forest parameters with out-of-bag scores. The forest for each grid point is fitted once and
+    grows OOB_STEP trees at a time until the out-of-bag score has not improved for OOB_PATIENCE steps, or until it
+    has the largest n_estimators in the grid. Each training example is scored only by the trees that did not see it
+    in their bootstrap sample, so no cross validation refits are needed.
+    :param model: The random forest to fit
+    :param param_grid: The parameter matrix for the model. n_estimators is the maximum forest size.
+    :param cross_validation: Not used
+    :param x_train: The training data
+    :param y_train: The training phenotypes
+    :param n_jobs: Not used, the trees are built in the threads of the random forest
+    :return: The forest with the best out-of-bag score and its parameters
+    """
+    param_grid = dict(param_grid)
+    max_trees = max(param_grid.pop('n_estimators', [model.n_estimators]))
+
+    best_model, best_params, best_score = None, None, None
+    for params in ParameterGrid(param_grid):
+        forest = clone(model).set_params(warm_start=True, oob_score=True, bootstrap=True, **params)
+        score = __grow_forest(forest, x_train, y_train, max_trees)
+        params = dict(params, n_estimators=forest.n_estimators)
+        logger.info('Out-of-bag score {} for params: {}'.format(round(score, 4), params))
+
+        if best_score is None or score > best_score:
+            best_model, best_params, best_score = forest, params, score
+
+    # later fits must not add trees to the selected forest
+    best_model.set_params(warm_start=False)
+    return best_model, best_params
+
+
+def __grow_forest(forest, x_train, y_train, max_trees):
+    """
+    Adds trees to a warm started forest until the out-of-bag score plateaus
+    :param forest: The forest with warm_start and oob_score enabled
+    :param x_train: The training data
+    :param y_train: The training phenotypes
+    :param max_trees: The maximum number of trees
+    :return: The out-of-bag score of the grown forest
+    """
+    best_score = None
+    steps_without_improvement = 0
+    n_trees = 0
+    while n_trees < max_trees and steps_without_improvement < OOB_PATIENCE:
+        n_trees = min(n_trees + OOB_STEP, max_trees)
+        forest.set_params(n_estimators=n_trees)
+        forest.fit(x_train, y_train)
+
+        score = forest.oob_score_
+        if best_score is None or score > best_score + OOB_TOLERANCE:
+            best_score = score
+            steps_without_improvement = 0
+        else:
+            steps_without_improvement += 1
+
+    return forest.oob_score_
+
+
 def save_features(model, model_terms, output_dir):
     # rf default features
     ftrs = pd.DataFrame()
@@ -0,0 +1,152 @@
+"""
+Scorers are fitted models compiled into plain arrays, which are saved in the model configuration. A scorer predicts
+from the imputed SNP data with a few batched array operations, without the estimator and without building the design
+matrix.
+
+An elastic net is a quadratic form over the SNP vector x of a user: intercept + b'x + x'Wx, where b is the vector of
+the main effect coefficients and W is the upper triangular matrix of the interaction coefficients. Most interaction
+coefficients are zero, so only the non-zero ones are kept, as the rows, columns and weights of a sparse matrix.
+
+Decision trees and random forests are flattened into node arrays: the feature, threshold and children of each node of
+all trees and the class probabilities of the leaves. All trees are walked for a block of users at once, one tree level
+at a time, and the leaf probabilities are averaged like the scikit-learn forest does.
+"""
+import numpy as np
+from scipy import sparse
+
+import logging
+logger = logging.getLogger('root')
+
+QUADRATIC = 'quadratic'
+FOREST = 'forest'
+
+# The number of user and tree pairs walked at once by a forest scorer, which bounds the memory of a block
+BLOCK_NODES = 2 ** 20
+
+
+def build(scorer):
+    """
+    Creates the prediction function of a scorer
+    :param scorer: The scorer saved in the model configuration
+    :return: A function that predicts the classes of the imputed data, with a row for each user and a column for each
+    model SNP
+    """
+    if scorer['type'] not in _BUILDERS:
+        raise ValueError('Scorer type "{}" is not supported'.format(scorer['type']))
+    return _BUILDERS[scorer['type']](scorer)
+
+
+def compile_forest(model, snps, no_interactions, pairs=None):
+    """
+    Compiles a fitted decision tree or random forest into a forest scorer. The nodes of all trees are concatenated and
+    the children of leaves are -1, as in the scikit-learn trees.
+    :param model: The fitted DecisionTreeClassifier or RandomForestClassifier
+    :param snps: The model SNP labels, which are the features of the trees
+    :param no_interactions: Must be True, the trees are fitted on the SNPs only
+    :param pairs: Not used
+    :return: The scorer
+    """
+    if not no_interactions:
+        raise ValueError('Only trees fitted without interaction terms can be compiled')
+
+    trees = getattr(model, 'estimators_', [model])
+    features, thresholds, lefts, rights, values, roots = [], [], [], [], [], []
+    offset = 0
+    for estimator in trees:
+        tree = estimator.tree_
+        leaves = tree.children_left < 0
+        features.append(tree.feature)
+        thresholds.append(tree.threshold)
+        lefts.append(np.where(leaves, -1, tree.children_left + offset))
+        rights.append(np.where(leaves, -1, tree.children_right + offset))
+
+        # the class probabilities of each node, normalized like the tree predict_proba
+        value = tree.value[:, 0, :].astype(np.float64)
+        normalizer = value.sum(axis=1)[:, np.newaxis]
+        normalizer[normalizer == 0.0] = 1.0
+        values.append(value / normalizer)
+
+        roots.append(offset)
+        offset += tree.node_count
+
+    logger.info('Compiled {} trees with {} nodes into a scorer'.format(len(trees), offset))
+    return {
+        'type': FOREST,
+        'feature': np.concatenate(features).astype(np.int32),
+        'threshold': np.concatenate(thresholds),
+        'left': np.concatenate(lefts).astype(np.int32),
+        'right': np.concatenate(rights).astype(np.int32),
+        'values': np.concatenate(values),
+        'roots': np.array(roots, dtype=np.int32),
+        'classes': np.asarray(model.classes_)
+    }
+
+
+def _build_quadratic(scorer):
+    """
+    Creates the prediction function of a quadratic form scorer
+    :param scorer: A dictionary with the intercept, the main_effects vector, the rows, cols and weights of the non-zero
+    interaction coefficients and the classes of a negative and positive decision
+    :return: The prediction function
+    """
+    intercept = scorer['intercept']
+    main_effects = np.asarray(scorer['main_effects'], dtype=np.float64)
+    classes = np.asarray(scorer['classes'])
+    n_snps = len(main_effects)
+    # x'W is computed as (W'x')', so W' is kept in row compressed form
+    interactions_t = sparse.csr_matrix((scorer['weights'], (scorer['cols'], scorer['rows'])), shape=(n_snps, n_snps))
+
+    def predict(x):
+        x = np.asarray(x, dtype=np.float64)
+        decision = x.dot(main_effects) + intercept
+        if interactions_t.nnz > 0:
+            decision += np.einsum('ij,ij->i', interactions_t.dot(x.T).T, x)
+        return classes[(decision > 0).astype(np.intp)]
+
+    return predict
+
+
+def _build_forest(scorer):
+    """
+    Creates the prediction function of a forest scorer
+    :param scorer: A dictionary with the node arrays, the root node of each tree and the classes, see compile_forest
+    :return: The prediction function
+    """
+    feature, threshold = scorer['feature'], scorer['threshold']
+    left, right, values = scorer['left'], scorer['right'], scorer['values']
+    roots, classes = scorer['roots'], np.asarray(scorer['classes'])
+    leaf = left < 0
+    block_size = max(1, BLOCK_NODES // len(roots))
+
+    def predict(x):
+        # the trees compare float32 data with the thresholds, as scikit-learn does
+        x = np.ascontiguousarray(x, dtype=np.float32)
+        proba = np.empty((len(x), values.shape[1]))
+        for start in range(0, len(x), block_size):
+            block = x[start:start + block_size]
+            # the current node of each user and tree, and the offset of the user's data in the flattened block
+            nodes = np.tile(roots, len(block))
+            offsets = np.repeat(np.arange(len(block)) * x.shape[1], len(roots))
+
+            # one level of all trees is walked at a time, only for the users and trees that have not reached a leaf
+            active = np.flatnonzero(~leaf[nodes])
+            while len(active) > 0:
+                current = nodes[active]
+                go_left = block.ravel()[offsets[active] + feature[current]] <= threshold[current]
+                current = np.where(go_left, left[current], right[current])
+                nodes[active] = current
+                active = active[~leaf[current]]
+
+            # the probabilities of the trees are added in tree order
+            proba[start:start + len(block)] = values[nodes].reshape(len(block), len(roots), -1).sum(axis=1)
+
+        proba /= len(roots)
+        return classes.take(proba.argmax(axis=1))
+
+    return predict
+
+
+_BUILDERS = {
+    QUADRATIC: _build_quadratic,
+    FOREST: _build_forest
+}
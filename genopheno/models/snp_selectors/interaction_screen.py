@@ -0,0 +1,66 @@
+import numpy as np
+
+import logging
+logger = logging.getLogger("root")
+
+# The maximum number of pair scores calculated at once
+BLOCK_PAIRS = 2 ** 20
+
+
+def screen_interactions(x, y, k, block_pairs=BLOCK_PAIRS):
+    """
+    Selects the SNP pairs with the strongest interaction with the phenotype. The interaction of a pair is the product of
+    the centered mutations of the two SNPs and its score is the squared correlation of the product with the phenotype.
+    Centering the SNPs keeps pairs from being selected only because of the main effects of the SNPs.
+
+    All pairs are scored with matrix products, in blocks of SNPs so that at most block_pairs scores are in memory.
+    :param x: The imputed training data with a column for each SNP
+    :param y: The training phenotypes (0 or 1)
+    :param k: The number of pairs to select
+    :param block_pairs: The maximum number of pair scores calculated at once
+    :return: A tuple of the selected pairs, as a list of (i, j) SNP column positions with i < j sorted by i and j, and
+    their scores in the same order
+    """
+    x = np.asarray(x, dtype=np.float64)
+    x = x - x.mean(axis=0)
+    y = np.asarray(y, dtype=np.float64)
+    y = y - y.mean()
+    n_samples, n_snps = x.shape
+    y_ss = np.dot(y, y)
+    x_sq = x ** 2
+    block_size = max(1, block_pairs // max(n_snps, 1))
+
+    best_i = np.empty(0, dtype=np.int64)
+    best_j = np.empty(0, dtype=np.int64)
+    best_scores = np.empty(0)
+    for start in range(0, n_snps, block_size):
+        stop = min(start + block_size, n_snps)
+        block = x[:, start:stop]
+
+        # For the product z of SNPs i and j: sum(z * y), sum(z) and sum(z ** 2)
+        zy = np.dot((block * y[:, np.newaxis]).T, x)
+        z_sum = np.dot(block.T, x)
+        z_ss = np.dot(x_sq[:, start:stop].T, x_sq) - z_sum ** 2 / n_samples
+        with np.errstate(divide='ignore', invalid='ignore'):
+            scores = np.where(z_ss > 1e-12, zy ** 2 / (z_ss * y_ss), 0)
+
+        # only the pairs with i < j
+        i, j = np.nonzero(np.arange(start, stop)[:, np.newaxis] < np.arange(n_snps))
+        scores = scores[i, j]
+        i += start
+
+        # keep the best k pairs of the blocks so far
+        best_i = np.concatenate([best_i, i])
+        best_j = np.concatenate([best_j, j])
+        best_scores = np.concatenate([best_scores, scores])
+        if len(best_scores) > k:
+            # ties are broken by the SNP positions so the selection does not depend on the block size
+            keep = np.lexsort((best_j, best_i, -best_scores))[:k]
+            best_i, best_j, best_scores = best_i[keep], best_j[keep], best_scores[keep]
+
+    order = np.lexsort((best_j, best_i))
+    pairs = [(int(a), int(b)) for a, b in zip(best_i[order], best_j[order])]
+    logger.info('{} of {} SNP pairs selected as interactions, scores {:.4f} to {:.4f}'.format(
+        len(pairs), n_snps * (n_snps - 1) // 2, best_scores.min() if len(pairs) > 0 else 0,
+        best_scores.max() if len(pairs) > 0 else 0))
+    return pairs, best_scores[order]
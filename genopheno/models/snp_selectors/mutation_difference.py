@@ -2,6 +2,7 @@
 import numpy as np
 import pandas as pd
 import math
+from preprocessing.genotype_matrix import PackedGenotypes
 
 import logging
 logger = logging.getLogger("root")
@@ -16,24 +17,22 @@ fm = full mutations
 MUTATION_LEVELS = ['nm', 'pm', 'fm']
 
 
-def __remove_missing_data(pheno, snp_data, invalid_thresh):
+def __remove_missing_data(pheno, phenotype, invalid_thresh):
     """
     Removes missing data from the user data. If a SNP row has a percentage of users with an invalid or missing genotype
-    then the SNP row is removed. Missing SNP data is changed from its numeric missing value to NaN.
-    :param snp_data: The SNP data for all users
+    then the SNP row is removed.
+    :param phenotype: The packed SNP data for all users, see PackedPhenotype
     :param invalid_thresh: The maximum percentage of invalid data for a row or column
-    :return: The SNP data for all users with the missing data removed
     """
-    non_user_columns = ['Gene_info', 'pct_fm', 'pct_nm', 'pct_pm']
-    user_columns = set(snp_data.columns.values).difference(non_user_columns)
-    users_count = len(user_columns)
-
-    snp_count = snp_data.shape[0]
+    users_count = len(phenotype.users)
+    snp_count = len(phenotype.snps)
 
     min_required = math.ceil((1 - invalid_thresh / float(100)) * users_count)
-    snp_data.dropna(axis=0, thresh=min_required, inplace=True, subset=user_columns)
+    observed = users_count - phenotype.genotypes.snp_missing()
+    phenotype.drop_snps(observed < min_required)
+    removed = snp_count - len(phenotype.snps)
     logger.info("{} ({:.2f}%) SNPs removed due to too many missing user observations for phenotype '{}'"
-                .format(snp_count - snp_data.shape[0], float(snp_count - snp_data.shape[0]) / snp_count * 100, pheno))
+                .format(removed, float(removed) / snp_count * 100, pheno))
 
 
 def __filter_snps(row, abs_diff_thresh, relative_diff_thresh, selected_snps):
@@ -152,8 +151,8 @@ def __identify_mutated_snps(phenotypes, relative_diff_thresh):
         raise ValueError('Using mutation differences to identify SNPs is only valid for two phenotype options.')
 
     # Merge the data frames top identify common SNPs and be able to do selection in one pass
-    pheno_df_a = phenotypes.values()[0]
-    pheno_df_b = phenotypes.values()[1]
+    pheno_df_a = phenotypes.values()[0].snps
+    pheno_df_b = phenotypes.values()[1].snps
     mutation_columns = ['pct_nm', 'pct_pm', 'pct_fm']
     merged = pheno_df_a[mutation_columns].merge(pheno_df_b[mutation_columns], left_index=True, right_index=True,
                                                 suffixes=('_a', '_b'))
@@ -167,23 +166,21 @@ def __identify_mutated_snps(phenotypes, relative_diff_thresh):
     return selected_snps
 
 
-def __format_selected_snps(pheno_label, pheno_df, selected_snps):
+def __format_selected_snps(pheno_label, phenotype, selected_snps):
     """
     Builds the phenotype DataFrame used for the machine learning model based on the selected SNPs
-    :param pheno_df: The DataFrame for the phenotype with the user mutation data
+    :param phenotype: The packed SNP data for all users with the phenotype, see PackedPhenotype
     :param selected_snps: A list of selected SNP RSIDs
     :param pheno_label: The phenotype label (i.e. 'Brown' for eye color)
     :return: The DataFrame for the selected SNPs
     """
-    # Filter out SNPs that have not been selected
-    snp_data = pheno_df.loc[selected_snps]
-    snp_data.index = 'gene_' + snp_data['Gene_info'].str.replace(r'\W', '_') + '_' + snp_data.index
-
-    # Drop the mutation percentages and gene info columns because they are no longer needed
-    snp_data.drop(labels=['Gene_info', 'pct_fm', 'pct_nm', 'pct_pm'], axis=1, inplace=True)
+    # Only the selected SNPs are unpacked
+    gene_info = phenotype.snps['Gene_info'].loc[selected_snps]
+    snp_labels = 'gene_' + gene_info.str.replace(r'\W', '_') + '_' + gene_info.index
 
     # Transpose the data and add columns for user Id and phenotype
-    transposed_data = snp_data.transpose()
+    transposed_data = pd.DataFrame(phenotype.user_mutations(selected_snps).T, index=phenotype.users,
+                                   columns=snp_labels)
     transposed_data['phenotype'] = pheno_label
 
     return transposed_data
@@ -192,7 +189,8 @@ def __format_selected_snps(pheno_label, pheno_df, selected_snps):
 def create_dataset(phenotypes, invalid_thresh, invalid_user_thresh, relative_diff_thresh):
     """
     Function to return those SNPs that satisfy a criterion to check for differences between blue and brown SNPs
-    :param phenotypes: A map of phenotypes where the key is the phenotype ID and the value is the phenotype data frame.
+    :param phenotypes: A map of phenotypes where the key is the phenotype ID and the value is the packed phenotype, see
+                       PackedPhenotype. The SNPs with too much missing data are removed from the packed phenotypes.
     :param invalid_thresh: The percentage of missing user observations a SNP can have before it is removed
     :param invalid_user_thresh: The acceptable percentage of missing data before a user is discarded
     :param relative_diff_thresh: The relative difference in mutation percent, calculated as a percent of the
@@ -201,8 +199,8 @@ def create_dataset(phenotypes, invalid_thresh, invalid_user_thresh, relative_dif
     The value is the number of mutations (0,1,2).
     """
     # Filter out SNPs that do not have enough user observations
-    for pheno, pheno_df in phenotypes.iteritems():
-        __remove_missing_data(pheno, pheno_df, invalid_thresh)
+    for pheno, phenotype in phenotypes.iteritems():
+        __remove_missing_data(pheno, phenotype, invalid_thresh)
 
     # Select snps based on mutation differences between phenotypes
     selected_snps = __identify_mutated_snps(phenotypes, relative_diff_thresh)
@@ -210,8 +208,8 @@ def create_dataset(phenotypes, invalid_thresh, invalid_user_thresh, relative_dif
 
     # Generate data frame for each phenotype using the selected SNPs
     final_datasets = []
-    for pheno_key, pheno_df in phenotypes.items():
-        final_datasets.append(__format_selected_snps(pheno_key, pheno_df, selected_snps))
+    for pheno_key, phenotype in phenotypes.items():
+        final_datasets.append(__format_selected_snps(pheno_key, phenotype, selected_snps))
 
     # Merge and return aggregate data set
     merged = pd.concat(final_datasets)
@@ -220,7 +218,9 @@ def create_dataset(phenotypes, invalid_thresh, invalid_user_thresh, relative_dif
     user_count = merged.shape[0]
     snp_count = merged.shape[1] - 1
     min_obs = math.ceil((1 - invalid_user_thresh / float(100)) * snp_count)
-    merged.dropna(axis=0, thresh=min_obs, inplace=True)
+    genotypes = PackedGenotypes.from_array(merged.drop(labels=['phenotype'], axis=1).values.T)
+    observed = snp_count - genotypes.user_missing()
+    merged = merged[observed >= min_obs]
     logger.info('{} users dropped due to too many missing observations'.format(user_count - merged.shape[0]))
     logger.info("Model Data contains {} users and {} SNPs".format(merged.shape[0], snp_count))
 
@@ -0,0 +1,164 @@
+import os
+import pandas as pd
+
+import preprocess
+import model
+import predict
+from preprocessing import snp
+from preprocessing.users import UserPhenotypes
+from preprocessing.genome_cache import GenomeCache
+from preprocessing.genotype_matrix import PackedPhenotype
+from util import timed_invoke, expand_path, clean_output
+from stage_cache import detach_outputs
+
+import logging
+logger = logging.getLogger('root')
+
+# The sub directories of the pipeline output directory that each step writes its files to
+PREPROCESSED_DIR = 'preprocessed'
+MODEL_DIR = 'model'
+PREDICTION_DIR = 'prediction'
+
+
+class Pipeline:
+    """
+    Runs the preprocess, model and predict steps in one process. The SNP database, the preprocessed phenotypes and the
+    model are passed from step to step in memory instead of being written by one step and parsed again by the next.
+
+    The pipeline does not configure logging, so it logs to the 'root' logger of the application that uses it. If an
+    output directory is set, each step also writes the same files as its script to a sub directory of the output
+    directory, so the files can be used with the scripts. Otherwise nothing is written.
+    """
+
+    def __init__(self, output_dir=None, genome_cache_dir=None, genome_cache_size=10240):
+        """
+        Creates a pipeline
+        :param output_dir: The directory to write the files of each step to. If None no files are written.
+        :param genome_cache_dir: The directory to cache the parsed user genomic files in. If None nothing is cached.
+        :param genome_cache_size: The maximum size of the genome cache in megabytes
+        """
+        self.output_dir = expand_path(output_dir) if output_dir else None
+        self.genome_cache = None
+        if genome_cache_dir:
+            self.genome_cache = GenomeCache(expand_path(genome_cache_dir), genome_cache_size * 1024 * 1024)
+
+        self.snp_details = None
+        self.phenotypes = None
+        self.model_config = None
+        self.metrics = None
+
+    def preprocess(self, user_data_dir, snp_data_dir, known_pheno_file, cohort=False, checkpoint_interval=100,
+                   resume=False):
+        """
+        Preprocesses the user data for model building
+        :param user_data_dir: The directory containing all user genomic files
+        :param snp_data_dir: The directory containing all SNP VCF files
+        :param known_pheno_file: The file containing the known user phenotype classifications
+        :param cohort: If True all user files are processed once into the cohort genotype matrix and the users of each
+        phenotype are selected from it, the same as the preprocess cohort option
+        :param checkpoint_interval: The number of users processed between checkpoints. Checkpoints are only written if
+        the pipeline writes files. If 0 no checkpoints are written.
+        :param resume: If True the preprocessing continues from the checkpoints of an interrupted run in the output
+        directory instead of cleaning it
+        :return: A map of phenotypes where the key is the phenotype ID and the value is the preprocessed data frame.
+        The phenotypes that were preprocessed before the run was resumed are read from their preprocessed files.
+        """
+        if resume and self.output_dir is None:
+            raise ValueError('Preprocessing can only be resumed if the pipeline writes files')
+
+        output_dir = self.__step_dir(PREPROCESSED_DIR, clean=not resume)
+        snp_data_dir = expand_path(snp_data_dir)
+        self.snp_details = timed_invoke('building SNP data frame', lambda: snp.build_database(snp_data_dir,
+                                                                                              output_dir))
+
+        users_phenotypes = UserPhenotypes(expand_path(known_pheno_file), expand_path(user_data_dir), self.genome_cache)
+        phenotypes = timed_invoke('building final data structure', lambda: preprocess.preprocess_users(
+            users_phenotypes, self.snp_details, output_dir, checkpoint_interval, cohort))
+        for phenotype, data in phenotypes.items():
+            if data is None:
+                phenotypes[phenotype] = pd.read_csv(
+                    os.path.join(output_dir, 'preprocessed_{}.csv.gz'.format(phenotype)), compression='gzip',
+                    index_col='Rsid')
+
+        self.phenotypes = phenotypes
+        return phenotypes
+
+    def build_model(self, model_id='rf', invalid_thresh=60, invalid_user_thresh=90, relative_diff_thresh=None,
+                    data_split=33, no_interactions=False, negative=None, max_snps=None, cross_validation=3, n_jobs=1,
+                    oob=False, interactions=None, float32=False, compact=False):
+        """
+        Builds a model from the preprocessed phenotypes. The parameters are the same as the model script parameters.
+        :return: The model configuration, which contains everything needed to make predictions. The testing data
+        metrics are in the metrics attribute.
+        """
+        if self.phenotypes is None:
+            raise ValueError('The data must be preprocessed before the model is built')
+
+        output_dir = self.__step_dir(MODEL_DIR)
+
+        # The data set is created from packed copies so the model can be built again with other parameters. The users
+        # are named by the user id, as in the preprocessed files.
+        phenotypes = dict((phenotype, PackedPhenotype.from_frame(data)) for phenotype, data in self.phenotypes.items())
+        model_data = model.prepare_data(phenotypes, invalid_thresh, invalid_user_thresh, relative_diff_thresh,
+                                        data_split, negative, max_snps, output_dir, float32)
+
+        self.model_config, self.metrics = timed_invoke('building model', lambda: model.train_model(
+            model_data, model_id, no_interactions, cross_validation, output_dir, n_jobs, -1 if n_jobs == 1 else 1,
+            oob, interactions, compact))
+        return self.model_config
+
+    def predict(self, users_dir, block_size=100, workers=1):
+        """
+        Predicts the phenotype of each user with the model
+        :param users_dir: The directory containing the user genomic files
+        :param block_size: The number of users to predict at once
+        :param workers: The number of processes used to parse the user files
+        :return: A data frame with the user_id and prediction columns
+        """
+        if self.model_config is None:
+            raise ValueError('The model must be built before phenotypes are predicted')
+
+        output_dir = self.__step_dir(PREDICTION_DIR)
+        users_dir = expand_path(users_dir)
+        snp_details = self.snp_details[self.snp_details['Rsid'].isin(
+            map(snp.extract_rsid, self.model_config['snps']))]
+        predict_block = predict.build_predictor(self.model_config)
+
+        blocks = []
+
+        def add_block(user_files, predictions):
+            if len(predictions) > 0:
+                blocks.append(predictions)
+
+        timed_invoke('predicting user phenotypes', lambda: predict.predict_users(
+            users_dir, UserPhenotypes.get_user_geno_files(users_dir), snp_details, predict_block, add_block,
+            block_size, workers, self.genome_cache))
+        if len(blocks) == 0:
+            predictions = pd.DataFrame(columns=['user_id', 'prediction'])
+        else:
+            predictions = pd.concat(blocks, ignore_index=True)
+
+        if output_dir is not None:
+            predictions.to_csv(os.path.join(output_dir, predict.PREDICTIONS_FILE), index=False)
+
+        return predictions
+
+    def __step_dir(self, name, clean=True):
+        """
+        Cleans the output directory of a step
+        :param name: The step directory name
+        :param clean: If False the existing files of the step are kept
+        :return: The step output directory, or None if the pipeline does not write files
+        """
+        if self.output_dir is None:
+            return None
+
+        step_dir = os.path.join(self.output_dir, name)
+        if clean:
+            clean_output(step_dir)
+        else:
+            if not os.path.exists(step_dir):
+                os.makedirs(step_dir)
+            # the existing outputs are rewritten, so they must not be linked to the stage cache
+            detach_outputs(step_dir)
+        return step_dir
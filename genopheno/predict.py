@@ -1,93 +1,452 @@
 import argparse
+import csv
 import os
 import pickle
+import time
+from multiprocessing import Pool
+import numpy as np
 import pandas as pd
 from preprocessing.users import UserPhenotypes, User
-from preprocessing.snp import extract_rsid, format_snps
-from models.common import build_model_desc
-from patsy import dmatrix
-from util import setup_logger, timed_invoke, expand_path, clean_output
+from preprocessing.genome_cache import GenomeCache
+from preprocessing.snp import extract_rsid
+from preprocessing.snp_index import SnpIndex
+from preprocessing import bgzf, genome_sources
+from models.common import design_matrix
+from models import scorers
+from models.imputer import GenotypeImputer
+from util import setup_logger, setup_profiler, setup_worker_profiler, timed_invoke, expand_path, clean_output, \
+    file_hash
+from stage_cache import StageCache, detach_outputs
+import memory_plan
 
 import logging.config
 logger = logging.getLogger('root')
 
+PREDICTIONS_FILE = 'predictions.csv'
+MANIFEST_FILE = 'predictions_manifest.csv'
+MANIFEST_COLUMNS = ['file', 'size', 'mtime', 'model']
+# The seconds to wait for the workers to parse a block of users
+POOL_TIMEOUT = 7 * 24 * 3600
 
-def run(users_dir, init_dir, model_dir, output_dir):
+# State shared with the prediction worker processes. It is set before the workers are forked so they get it through
+# copy-on-write memory instead of pickling it for every user.
+__shared = {}
+
+
+def __read_model_config(model_dir):
+    """
+    Reads the model configuration saved by the model step
+    :param model_dir: The directory containing the model files
+    :return: The model configuration dictionary
+    """
+    with open(os.path.join(model_dir, 'model_config.pkl'), 'rb') as f:
+        return pickle.load(f)
+
+
+def calc_user_mutations(user, snp_index, snp_labels):
+    """
+    Calculates the mutations of a user for the model SNPs
+    :param user: The user
+    :param snp_index: The join index of the SNP database rows of the model SNPs
+    :param snp_labels: The model SNP label of each SNP database row
+    :return: A data frame with one row containing the user mutations, where the columns are the model SNP labels, or
+    None if the user has no valid genomic data
+    """
+    mutations, _ = user.mutations(snp_index)
+    if mutations is None:
+        return None
+
+    return pd.DataFrame([mutations], index=[user.id], columns=snp_labels)
+
+
+def snp_labels(snp_details):
+    """
+    Formats the model SNP labels (gene_<gene info>_<rsid>) of SNP database rows
+    :param snp_details: The SNP database rows
+    :return: The list of labels
+    """
+    return list('gene_' + snp_details['Gene_info'].str.replace(r'\W', '_') + '_' + snp_details['Rsid'])
+
+
+def build_predictor(model_config):
+    """
+    Creates the prediction function of a model
+    :param model_config: The model configuration saved by the model step
+    :return: A function that predicts the phenotypes of a data frame of user mutations, with a row for each user and
+    the model SNP labels as columns. It returns the list of predicted phenotype labels.
+    """
+    snp_columns = model_config['snps']
+    imputer = model_config['imputer']
+    if isinstance(imputer, np.ndarray):
+        imputer = GenotypeImputer(imputer)
+    elif not isinstance(imputer, GenotypeImputer):
+        # models built before the genotype imputer have a fitted scikit-learn most frequent imputer
+        imputer = GenotypeImputer(np.asarray(imputer.statistics_, dtype=np.float64))
+    no_interactions = model_config['no_interactions']
+    # models built before interaction screening include all pairs and older models use float64 data
+    pairs = model_config.get('interactions')
+    dtype = np.dtype(model_config.get('dtype', 'float64'))
+    model = model_config['model']
+    pheno_map = model_config['pheno_map']
+    # models compiled into a scorer predict from the imputed data without the design matrix
+    score = scorers.build(model_config['scorer']) if 'scorer' in model_config else None
+
+    def predict_block(mutations):
+        # The imputer is positional so the SNP columns must be in the same order the model was trained with
+        mutations = mutations.reindex(columns=snp_columns)
+
+        # Impute missing values
+        x = imputer.transform(mutations, dtype)
+        if score is not None:
+            return [pheno_map[pheno_id] for pheno_id in score(x)]
+
+        # Create model feature set
+        x = design_matrix(x, snp_columns, no_interactions, pairs, dtype)
+
+        # Predict
+        return [pheno_map[pheno_id] for pheno_id in model.predict(x)]
+
+    return predict_block
+
+
+def __calc_user_mutations(task):
+    """
+    Calculates the mutations of a user for the selected SNPs. This runs in the prediction worker processes, which
+    read the SNP data from the shared state set up before they were forked.
+    :param task: A tuple of the user count, the number of users and the user file name
+    :return: A tuple of the user file name and a data frame with one row containing the user mutations. The data
+    frame is None if the user has no valid genomic data.
+    """
+    count, n_users, user_file = task
+    users_dir = __shared['users_dir']
+    user = User(users_dir, user_file, __shared['genome_cache'])
+    mutations = timed_invoke('calculating mutations for user {} ({}/{})'.format(user.id, count, n_users),
+                             lambda: calc_user_mutations(user, __shared['snp_index'], __shared['snp_labels']),
+                             'calculating user mutations')
+    if mutations is None:
+        logger.warning('User {} did not have any valid genomic data. Skipping the user.'.format(user.id))
+
+    return user_file, mutations
+
+
+def predict_users(users_dir, user_files, snp_details, predict_block, write_block, block_size=100, workers=1,
+                  genome_cache=None):
+    """
+    Predicts the users in fixed size blocks. Each block is passed to write_block as soon as it is predicted, so memory
+    use does not grow with the number of users. With multiple workers the user files are parsed in worker processes,
+    which are forked for each call so they share the SNP data of the model.
+    :param users_dir: The directory or archive containing the user files
+    :param user_files: The user files to predict
+    :param snp_details: The SNP database rows of the model SNPs
+    :param predict_block: The block predictor, see build_predictor
+    :param write_block: The function that is called for each block with the user files of the block and a data frame
+                        with the user_id and prediction columns. Users without valid genomic data are not predicted.
+    :param block_size: The number of users to predict at once
+    :param workers: The number of processes used to parse the user files
+    :param genome_cache: The optional cache of parsed user genomic files
+    :return: The number of predicted users
+    """
+    __shared['users_dir'] = users_dir
+    __shared['snp_index'] = SnpIndex(snp_details)
+    __shared['snp_labels'] = snp_labels(snp_details)
+    __shared['genome_cache'] = genome_cache
+
+    pool = None
+    if workers > 1:
+        pool = Pool(workers, setup_worker_profiler)
+    try:
+        n_predicted = 0
+        for block in __user_blocks(user_files, block_size, pool):
+            predictions = pd.DataFrame(columns=['user_id', 'prediction'])
+            valid = [mutations for _, mutations in block if mutations is not None]
+            if len(valid) > 0:
+                mutations = pd.concat(valid)
+                predictions = pd.DataFrame({'user_id': mutations.index, 'prediction': timed_invoke(
+                    'predicting phenotypes for users {}-{}'.format(n_predicted + 1, n_predicted + len(valid)),
+                    lambda: predict_block(mutations), 'predicting blocks')}, columns=['user_id', 'prediction'])
+                n_predicted += len(valid)
+
+            write_block([user_file for user_file, _ in block], predictions)
+
+        if pool is not None:
+            pool.close()
+    except BaseException:
+        if pool is not None:
+            pool.terminate()
+        raise
+    finally:
+        if pool is not None:
+            pool.join()
+
+    logger.info('{} users predicted'.format(n_predicted))
+    return n_predicted
+
+
+def __user_blocks(user_files, block_size, pool):
+    """
+    Calculates the mutations of the user files one block at a time. The workers are only sent the tasks of one block,
+    so the parsed users waiting to be predicted never exceed a block.
+    :param user_files: The user files
+    :param block_size: The number of users in each block
+    :param pool: The worker pool. If None the mutations are calculated in this process.
+    :return: A generator of blocks, which are lists of tuples of the user file name and its mutations
+    """
+    for start in range(0, len(user_files), block_size):
+        tasks = [(count, len(user_files), user_file)
+                 for count, user_file in enumerate(user_files[start:start + block_size], start + 1)]
+        if pool is None:
+            yield map(__calc_user_mutations, tasks)
+        else:
+            # waiting with a timeout lets an interrupt stop the wait, which Python 2 does not do for map
+            yield pool.map_async(__calc_user_mutations, tasks).get(POOL_TIMEOUT)
+
+
+def __model_fingerprint(init_dir, model_dir):
+    """
+    Identifies the model used for predictions. Predictions made with a different model or SNP database are stale.
+    :param init_dir: The directory containing the preprocessed files
+    :param model_dir: The directory containing the model files
+    :return: The model fingerprint
+    """
+    return file_hash(os.path.join(model_dir, 'model_config.pkl'))[:20] + \
+        file_hash(os.path.join(init_dir, 'snp_database.csv.gz'))[:20]
+
+
+def __file_state(users_dir, user_file, fingerprint):
+    """
+    Gets the manifest entry of a user file
+    :param users_dir: The directory containing the user files
+    :param user_file: The user file name
+    :param fingerprint: The model fingerprint
+    :return: The manifest entry (file, size, mtime, model)
+    """
+    size, mtime = genome_sources.stat(os.path.join(users_dir, user_file))
+    return user_file, str(size), repr(mtime), fingerprint
+
+
+def __read_manifest(output_dir):
+    """
+    Reads the manifest of the user files that have already been predicted
+    :param output_dir: The directory containing the predictions
+    :return: A dictionary where the key is the user file name and the value is its manifest entry
+    """
+    manifest = {}
+    manifest_path = os.path.join(output_dir, MANIFEST_FILE)
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'rb') as f:
+            reader = csv.reader(f)
+            next(reader, None)
+            # the manifest is append only so later entries replace earlier ones
+            for entry in reader:
+                manifest[entry[0]] = tuple(entry)
+
+    return manifest
+
+
+def __remove_predictions(output_dir, user_ids):
+    """
+    Removes the predictions for users from the predictions file. The file is streamed to a new file, which replaces it
+    atomically, so memory use does not depend on the number of predictions.
+    :param output_dir: The directory containing the predictions
+    :param user_ids: The ids of the users to remove
+    """
+    user_ids = set(str(user_id) for user_id in user_ids)
+    predictions_path = os.path.join(output_dir, PREDICTIONS_FILE)
+    tmp_path = predictions_path + '.tmp'
+    n_removed = 0
+    with open(predictions_path, 'rb') as f, open(tmp_path, 'wb') as out:
+        out.write(next(f, ''))
+        for line in f:
+            if line.split(',', 1)[0] in user_ids:
+                n_removed += 1
+            else:
+                out.write(line)
+
+    if n_removed > 0:
+        os.rename(tmp_path, predictions_path)
+        logger.info('{} stale predictions removed'.format(n_removed))
+    else:
+        os.remove(tmp_path)
+
+
+def run(users_dir, init_dir, model_dir, output_dir, block_size=100, workers=1, incremental=False, watch=None,
+        genome_cache_dir=None, genome_cache_size=10240, max_memory=None, cache_dir=None, profile=False,
+        profile_memory=False):
     """
     Predicts phenotype for users
     :param users_dir: The directory containing the user
     :param init_dir: The directory containing the preprocessed files
     :param model_dir: The directory containing the model files
     :param output_dir: The directory to write the predictions to
+    :param block_size: The number of users to predict at once. The predictions are written after each block.
+    :param workers: The number of processes used to parse the user files
+    :param incremental: If True only users files that are new or changed since the last run are predicted and the
+                        predictions are merged into the existing output
+    :param watch: If set, the users directory is polled for new files every `watch` seconds until interrupted.
+                  This implies incremental predictions. A model or SNP database that changes while watching is read
+                  again and all users are predicted with it.
+    :param genome_cache_dir: The directory to cache the parsed user genomic files in. If None nothing is cached.
+    :param genome_cache_size: The maximum size of the genome cache in megabytes
+    :param max_memory: The memory budget in megabytes. The block size and the number of workers are chosen from the
+                       number of model SNPs and terms and the size of the user files so that the working set fits the
+                       budget. If None the settings are used as given.
+    :param cache_dir: The stage cache directory. If the user files, the model and the code did not change since a run
+                      with the same cache directory, the predictions of that run are linked into the output directory
+                      instead of predicting again. Incremental runs do not use the cache. If None nothing is cached.
+    :param profile: If True each stage is profiled and the reports are written to the output directory
+    :param profile_memory: If True the memory allocations of each profiled stage are traced
     """
     users_dir = expand_path(users_dir)
     init_dir = expand_path(init_dir)
     model_dir = expand_path(model_dir)
     output_dir = expand_path(output_dir)
 
-    # Make sure output directory exists before doing work
-    clean_output(output_dir)
+    incremental = incremental or watch is not None
+    cache = None
+    if cache_dir is not None and not incremental:
+        cache = StageCache(expand_path(cache_dir))
+        stage_fingerprint = cache.fingerprint('predict', {}, [
+            users_dir, os.path.join(init_dir, 'snp_database.csv.gz'), model_dir])
+        if cache.restore(stage_fingerprint, output_dir):
+            setup_logger(output_dir, "predict")
+            logger.info('The user files and the model are unchanged, the predictions were restored from the stage '
+                        'cache "{}"'.format(cache.cache_dir))
+            print 'Output written to "{}"'.format(output_dir)
+            return
+
+    # Make sure output directory exists before doing work. Incremental runs build on the previous output.
+    if not incremental:
+        clean_output(output_dir)
+    else:
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+        # the predictions are updated in place, so they must not be linked to the stage cache
+        detach_outputs(output_dir)
 
     # Setup console and file loggers
     setup_logger(output_dir, "predict")
+    setup_profiler(output_dir, profile, profile_memory)
 
-    # Read SNP data
-    snp_details = pd.read_csv(os.path.join(init_dir, 'snp_database.csv.gz'), compression='gzip')
+    genome_cache = None
+    if genome_cache_dir:
+        genome_cache = GenomeCache(expand_path(genome_cache_dir), genome_cache_size * 1024 * 1024)
+    state = {'fingerprint': None}
 
-    # Read model config
-    with open(os.path.join(model_dir, 'model_config.pkl')) as f:
-        model_config = pickle.load(f)
+    def load_model(fingerprint):
+        """
+        Reads the model and the SNP data of the model SNPs and creates the block predictor. In watch mode this is done
+        again when the model or the SNP database change.
+        :param fingerprint: The model fingerprint of the model files that are read
+        """
+        model_config = timed_invoke('reading the model', lambda: __read_model_config(model_dir))
 
-    # Filter snps to only include selected snps
-    snp_columns = model_config['snps']
-    selected_rsids = map(extract_rsid, snp_columns)
-    snp_details = snp_details[snp_details['Rsid'].isin(selected_rsids)]
+        # Read the SNP data of the selected snps. Only the blocks with the selected SNPs are read if the database has a
+        # row index, otherwise the whole database is read and filtered.
+        selected_rsids = map(extract_rsid, model_config['snps'])
+        snp_database = os.path.join(init_dir, 'snp_database.csv.gz')
+        if bgzf.has_index(snp_database):
+            snp_details = timed_invoke('reading the SNP database',
+                                       lambda: bgzf.read_rows(snp_database, selected_rsids))
+        else:
+            snp_details = timed_invoke('reading the SNP database',
+                                       lambda: pd.read_csv(snp_database, compression='gzip'))
+            snp_details = snp_details[snp_details['Rsid'].isin(selected_rsids)]
+        state['snp_details'] = snp_details
 
+        state['block_size'], state['workers'] = block_size, workers
+        if max_memory is not None:
+            snps = model_config['snps']
+            pairs = model_config.get('interactions')
+            n_terms = len(snps)
+            if not model_config['no_interactions'] and 'scorer' not in model_config:
+                n_terms += len(snps) * (len(snps) - 1) // 2 if pairs is None else len(pairs)
+            genome_bytes = max([genome_sources.stat(os.path.join(users_dir, user_file))[0]
+                                for user_file in UserPhenotypes.get_user_geno_files(users_dir)] + [0])
+            plan = memory_plan.plan_predict(
+                max_memory, len(snps), n_terms,
+                os.path.getsize(os.path.join(model_dir, 'model_config.pkl')) * 2 +
+                snp_details.memory_usage(index=True, deep=True).sum(),
+                genome_bytes * memory_plan.GENOME_FILE_FACTOR, block_size, workers)
+            state['block_size'] = plan['block_size']
+            state['workers'] = plan['workers']
 
-    # Predict for each user
-    imputer = model_config['imputer']
-    model_desc = build_model_desc(snp_columns, model_config['no_interactions'])
-    model = model_config['model']
-    pheno_map = model_config['pheno_map']
-    users = []
-    predictions = []
+        state['predict_block'] = build_predictor(model_config)
+        state['fingerprint'] = fingerprint
 
-    def calc_mutations(user):
-        mutations = user.allele_transformation(snp_details, how='right')
-        mutations['Rsid'] = mutations['Rsid'].apply(format_snps, args=(snp_details,))
-        mutations.set_index('Rsid', inplace=True)
-        mutations = mutations.transpose()
+    def write_predictions(user_files, mode):
+        """
+        Predicts the users and writes the predictions and the manifest, see predict_users. The predicted files are
+        recorded in the manifest after their predictions are written.
+        :param user_files: The user files to predict
+        :param mode: The mode to open the output files with. 'w' to start new files or 'a' to append to them.
+        """
+        fingerprint = state['fingerprint']
+        manifest_path = os.path.join(output_dir, MANIFEST_FILE)
+        new_manifest = mode == 'w' or not os.path.exists(manifest_path)
+        with open(os.path.join(output_dir, PREDICTIONS_FILE), mode) as f, \
+                open(manifest_path, mode + 'b') as manifest_file:
+            manifest = csv.writer(manifest_file)
+            if mode == 'w':
+                f.write('user_id,prediction\n')
+            if new_manifest:
+                manifest.writerow(MANIFEST_COLUMNS)
 
-        return mutations
+            def write_block(block_files, predictions):
+                if len(predictions) > 0:
+                    predictions.to_csv(f, header=False, index=False)
 
-    def predict_pheno(mutations):
-        # Impute missing values
-        x = imputer.transform(mutations)
+                # Make sure the block is on disk so a failed run keeps all completed predictions
+                f.flush()
+                os.fsync(f.fileno())
+                manifest.writerows(__file_state(users_dir, user_file, fingerprint) for user_file in block_files)
+                manifest_file.flush()
 
-        # Create model feature set
-        x = dmatrix(model_desc, pd.DataFrame(x, columns=mutations.columns))
+            predict_users(users_dir, user_files, state['snp_details'], state['predict_block'], write_block,
+                          state['block_size'], state['workers'], genome_cache)
 
-        # Predict
-        return model.predict(x)[0]
+    def predict_new_users():
+        """
+        Predicts the user files that are not in the manifest, or that changed or were predicted with another model.
+        The model is read again if it or the SNP database changed since it was read.
+        """
+        fingerprint = __model_fingerprint(init_dir, model_dir)
+        if fingerprint != state['fingerprint']:
+            if state['fingerprint'] is not None:
+                logger.info('The model or the SNP database changed, all users will be predicted again')
+            load_model(fingerprint)
 
-    count = 0
-    user_files = UserPhenotypes.get_user_geno_files(users_dir)
-    for user_file in user_files:
-        user = User(users_dir, user_file)
-        count += 1
+        has_predictions = os.path.exists(os.path.join(output_dir, PREDICTIONS_FILE))
+        manifest = __read_manifest(output_dir) if has_predictions else {}
+        user_files = [user_file for user_file in UserPhenotypes.get_user_geno_files(users_dir)
+                      if manifest.get(user_file) != __file_state(users_dir, user_file, fingerprint)]
+        if len(user_files) == 0:
+            logger.info('No new or changed user files')
+            return
 
-        # Calculate mutations
-        mutations = timed_invoke('calculating mutations for user {} ({}/{})'.format(user.id, count, len(user_files)),
-                                 lambda: calc_mutations(user))
+        logger.info('{} new or changed user files'.format(len(user_files)))
+        # Files that are not in the manifest can also have predictions, if a run stopped after writing a block and
+        # before adding it to the manifest
+        if has_predictions:
+            __remove_predictions(output_dir, [User(users_dir, user_file).id for user_file in user_files])
+        write_predictions(user_files, 'a' if has_predictions else 'w')
 
-        # Predict phenotype
-        pheno_id = timed_invoke('prediction mutations for user {} ({}/{})'.format(user.id, count, len(user_files)),
-                                lambda: predict_pheno(mutations))
-        users.append(user.id)
-        predictions.append(pheno_map[pheno_id])
+    if not incremental:
+        load_model(__model_fingerprint(init_dir, model_dir))
+        timed_invoke('predicting user phenotypes',
+                     lambda: write_predictions(UserPhenotypes.get_user_geno_files(users_dir), 'w'))
+    elif watch is None:
+        timed_invoke('predicting new user phenotypes', predict_new_users)
+    else:
+        logger.info('Watching "{}" for new user files every {} seconds'.format(users_dir, watch))
+        try:
+            while True:
+                timed_invoke('predicting new user phenotypes', predict_new_users)
+                time.sleep(watch)
+        except KeyboardInterrupt:
+            logger.info('Stopped watching "{}"'.format(users_dir))
 
-    pd.DataFrame({'user_id': users, 'prediction': predictions})\
-        .to_csv(os.path.join(output_dir, 'predictions.csv'), index=False, columns=['user_id', 'prediction'])
+    if cache is not None:
+        timed_invoke('adding the predictions to the stage cache', lambda: cache.store(stage_fingerprint, output_dir))
 
     print 'Output written to "{}"'.format(output_dir)
 
@@ -99,9 +458,10 @@ if __name__ == '__main__':
     parser.add_argument(
         "--users-dir",
         "-u",
-        metavar="<directory path>",
+        metavar="<directory or archive path>",
         default="resources" + os.sep + "data" + os.sep + "users",
-        help="The directory that contains the users genomic data to predict the phenotypes for."
+        help="The directory that contains the users genomic data to predict the phenotypes for. A zip or tar "
+             "archive of the user files can be used instead of a directory."
              "\n\nDefault: resources/data/users"
     )
 
@@ -132,5 +492,111 @@ if __name__ == '__main__':
              "\n\nDefault: resources/data/prediction"
     )
 
+    parser.add_argument(
+        "--block-size",
+        "-b",
+        metavar="users",
+        type=int,
+        default=100,
+        help="The number of users to predict at once. The predictions for each block are appended to the output file "
+             "as soon as they are ready, so memory use does not depend on the number of users."
+             "\n\nDefault: 100"
+    )
+
+    parser.add_argument(
+        "--workers",
+        "-j",
+        metavar="N",
+        type=int,
+        default=1,
+        help="The number of processes used to parse the user files. The model and SNP data are loaded once and "
+             "shared with the worker processes. Predictions are written in the same order as with a single process."
+             "\n\nDefault: 1"
+    )
+
+    parser.add_argument(
+        "--incremental",
+        "-inc",
+        default=False,
+        action='store_true',
+        help="If set then only user files that are new or changed since the last run, or that were predicted with a "
+             "different model, are predicted. Their predictions are merged into the existing output. The predicted "
+             "files are tracked in {} in the output directory."
+             "\n\nDefault: False".format(MANIFEST_FILE)
+    )
+
+    parser.add_argument(
+        "--watch",
+        "-w",
+        metavar="seconds",
+        type=float,
+        help="If set then the users directory is polled for new or changed files every <seconds> seconds until the "
+             "process is interrupted. Implies --incremental. If the model changes while watching, it is read again "
+             "and all users are predicted with it."
+    )
+
+    parser.add_argument(
+        "--genome-cache",
+        "-gc",
+        metavar="<directory path>",
+        help="The directory to cache the parsed user genomic files in. Cached files are not parsed again in later "
+             "preprocess and predict runs unless they change. If not set, the user files are always parsed."
+    )
+
+    parser.add_argument(
+        "--genome-cache-size",
+        "-gcs",
+        metavar="MB",
+        type=int,
+        default=10240,
+        help="The maximum size of the genome cache in megabytes. The least recently used genomes are removed when "
+             "the cache is larger."
+             "\n\nDefault: 10240"
+    )
+
+    parser.add_argument(
+        "--max-memory",
+        "-mm",
+        type=int,
+        metavar="<megabytes>",
+        help="The memory budget in megabytes. The working set is estimated from the number of model SNPs and terms "
+             "and the size of the user files, and the block size and then the number of workers are lowered until "
+             "it fits. The plan is logged."
+             "\n\nDefault: no limit"
+    )
+
+    parser.add_argument(
+        "--cache-dir",
+        "-cd",
+        metavar="<directory path>",
+        help="The stage cache directory. The outputs of each run are stored in the cache by the hash of the user "
+             "files, the SNP database, the model and the code. When they did not change the cached predictions are "
+             "linked into the output directory instead of predicting again. Not used with --incremental or --watch."
+             "\n\nDefault: no cache"
+    )
+
+    parser.add_argument(
+        "--profile",
+        "-pf",
+        default=False,
+        action='store_true',
+        help="If set then each stage is profiled with cProfile. The pstats files and a summary of the slowest "
+             "functions for each stage are written to the output directory."
+             "\n\nDefault: False"
+    )
+
+    parser.add_argument(
+        "--profile-memory",
+        "-pm",
+        default=False,
+        action='store_true',
+        help="If set with --profile then the memory allocations of each stage are also traced with tracemalloc and "
+             "the top allocations are written to the output directory. Requires Python 3.4 or later, older "
+             "versions log a warning and only profile the time."
+             "\n\nDefault: False"
+    )
+
     args = parser.parse_args()
-    run(args.users_dir, args.init_dir, args.model_dir, args.output)
+    run(args.users_dir, args.init_dir, args.model_dir, args.output, args.block_size, args.workers, args.incremental,
+        args.watch, args.genome_cache, args.genome_cache_size, args.max_memory, args.cache_dir, args.profile,
+        args.profile_memory)
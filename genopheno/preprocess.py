@@ -1,85 +1,104 @@
 import argparse
+import shutil
+import socket
+import time
+import traceback
+import numpy as np
 import pandas as pd
-from preprocessing import snp
+from multiprocessing import Pool, Process
+from preprocessing import snp, bgzf
+from preprocessing.genotype_matrix import PackedGenotypes, PCT_COLUMNS, calc_snp_percents, add_snp_percents
 from util import *
-from preprocessing.users import UserPhenotypes
+from preprocessing.users import UserPhenotypes, User
+from preprocessing.snp_index import SnpIndex
+from preprocessing.genome_cache import GenomeCache
+from preprocessing.work_queue import WorkQueue
+from preprocessing.checkpoint import Checkpoint
+from stage_cache import StageCache, detach_outputs
+import memory_plan
 
 import logging.config
 logger = logging.getLogger('root')
 
+SHARDS_DIR = 'shards'
+CHECKPOINTS_DIR = 'checkpoints'
+QUEUE_DIR = 'queue'
+QUEUE_ROLES = ['coordinator', 'worker', 'merge', 'requeue']
+# The cohort genotype matrix, with the mutations of all users for each SNP regardless of their phenotype
+GENOTYPES_FILE = 'genotypes.csv.gz'
+# The checkpoint label of the users of the cohort genotype matrix
+COHORT = '.cohort'
+# The number of rows formatted at once when a preprocessed file is written, unless a memory budget lowers it
+WRITE_CHUNK_ROWS = 10000
 
-def __merge_user_mutations(users, phenotype, snp_details):
+# State shared with the shard processes. It is set before the processes are forked so the SNP shards and users are
+# inherited by the processes instead of being copied to each of them.
+__shared = {}
+
+
+def __merge_user_mutations(users, phenotype, snp_details, checkpoint=None):
     """
     Calculates the mutations for each user SNP and merges them into one data frame.
     :param users: The users to include in the mutations data frame
     :param phenotype: The phenotype label
     :param snp_details: The data frame containing the SNP details
+    :param checkpoint: If set the users are processed in chunks and each chunk is written to the checkpoint. Users in
+    the chunks that are already in the checkpoint are not processed again.
     :return: A data frame containing all user mutations for all SNPs
     """
-    # The final data structure doesn't need ref or alt, only if the user has a mutation or not.
-    merged_user_data = snp_details.drop(['Ref', 'Alt'], axis=1)
+    # The final data structure doesn't need ref, alt or the location, only if the user has a mutation or not.
+    snp_data = snp_details.drop(['Ref', 'Alt', 'Chrom', 'Pos'], axis=1).reset_index(drop=True)
+
+    # The index is built once and each user is joined with it, so the cost of a user does not depend on the SNP database
+    snp_index = SnpIndex(snp_details)
 
-    def merge_user(user_to_merge, all_user_data):
+    def user_mutations(user):
         """
-        Merges the user data with the data frame containing data about all user SNPs
-        :param user_to_merge: The user to merge
-        :param all_user_data: The data frame containing data about all user SNPs
-        :return: The merged data
+        Calculates the mutations of a user for all SNPs
+        :param user: The user
+        :return: The mutations of the user in SNP database order, or None if the user has no SNPs in the database
         """
-        user_data = user_to_merge.allele_transformation(snp_details)
-        if not user_data.empty:
-            return pd.merge(all_user_data, user_data, on=['Rsid'], how='outer')
-        else:
+        mutations, n_found = user.mutations(snp_index)
+        if n_found == 0:
             logger.warning('User {} did not have any SNPs in the SNP database. '
-                           'Skipping the user.'.format(user_to_merge.id))
-            return all_user_data
-
-    for i in range(len(users)):
-        user = users[i]
-        merged_user_data = timed_invoke(
-            "processing user {} with phenotype '{}' ({}/{})".format(user.id, phenotype, i + 1, len(users)),
-            lambda: merge_user(user, merged_user_data)
-        )
-
-    return merged_user_data
-
-
-def __calc_snp_percents(user_mutations):
-    """
-    Calculates the average mutation percentage (no, partial and full mutations) for each SNP
-    :param user_mutations: The data frame containing user mutations
-    :return: The mutations data frame with mutation percentages
-    """
-    zero_pct = []
-    one_pct = []
-    two_pct = []
-
-    def count_snps(row):
-        zero_count = 0
-        one_count = 0
-        two_count = 0
+                           'Skipping the user.'.format(user.id))
+            return None
+        return mutations
 
-        # count number of mutations for each gene
-        for mut_count in row[2::].values:
-            if mut_count == 0:
-                zero_count += 1
-            elif mut_count == 1:
-                one_count += 1
-            elif mut_count == 2:
-                two_count += 1
+    # The users are merged in chunks, each chunk is a genotype matrix with a column for each user with data
+    start, user_ids, chunks = 0, [], []
+    chunk_size = max(1, len(users))
+    if checkpoint is not None:
+        snp_hash = Checkpoint.snp_hash(snp_data['Rsid'])
+        start, user_ids, chunks = checkpoint.load(phenotype, [user.file_path for user in users], snp_hash)
+        chunk_size = checkpoint.interval
+        if start > 0:
+            logger.info("Resuming phenotype '{}' from the checkpoint, {} of {} users are already processed"
+                        .format(phenotype, start, len(users)))
 
-        # calculate the percents of each mutation
-        total = zero_count + one_count + two_count
-        zero_pct.append(0 if zero_count == 0 else float(zero_count) / total * 100)
-        one_pct.append(0 if one_count == 0 else float(one_count) / total * 100)
-        two_pct.append(0 if two_count == 0 else float(two_count) / total * 100)
+    for chunk_start in range(start, len(users), chunk_size):
+        chunk_users = users[chunk_start:chunk_start + chunk_size]
+        chunk_ids, columns = [], []
+        for i in range(len(chunk_users)):
+            user = chunk_users[i]
+            mutations = timed_invoke(
+                "processing user {} with phenotype '{}' ({}/{})"
+                .format(user.id, phenotype, chunk_start + i + 1, len(users)),
+                lambda: user_mutations(user),
+                'processing users'
+            )
+            if mutations is not None:
+                chunk_ids.append(user.id)
+                columns.append(mutations.astype(np.float32))
 
-    user_mutations.apply(count_snps, axis=1)
-    user_mutations['pct_fm'] = two_pct
-    user_mutations['pct_nm'] = zero_pct
-    user_mutations['pct_pm'] = one_pct
+        chunk = np.column_stack(columns) if len(columns) > 0 else np.empty((len(snp_data), 0), dtype=np.float32)
+        if checkpoint is not None:
+            checkpoint.save(phenotype, [user.file_path for user in chunk_users], chunk_ids, chunk, snp_hash)
+        user_ids.extend(chunk_ids)
+        chunks.append(chunk)
 
-    return user_mutations
+    genotypes = np.hstack(chunks) if len(chunks) > 0 else np.empty((len(snp_data), 0))
+    return pd.concat([snp_data, pd.DataFrame(genotypes.astype(np.float64), columns=user_ids)], axis=1)
 
 
 def __write_final(phenotype, all_user_data, output_dir):
@@ -89,21 +108,428 @@ def __write_final(phenotype, all_user_data, output_dir):
     :param all_user_data: The SNP data for all users
     :param output_dir: The directory to write the data to
     """
-    # set index to rsid
-    all_user_data.set_index(['Rsid'], inplace=True)
-    
-    # Save as a CSV file
+    # Save as a block compressed CSV file. The first column is the RSID, which is the index of the file.
     file_path = os.path.join(output_dir, "preprocessed_{}.csv.gz".format(phenotype))
-    all_user_data.to_csv(file_path, header=True, compression='gzip')
+    bgzf.write_csv(all_user_data, file_path, chunk_rows=__shared.get('chunk_rows', WRITE_CHUNK_ROWS))
+
+
+def preprocess_phenotype(phenotype, users, snp_details, output_dir=None, checkpoint=None, genotypes=None):
+    """
+    Processes the users of a phenotype into the final data structure form
+    :param phenotype: The phenotype of the users
+    :param users: The users with the phenotype
+    :param snp_details: The SNP database
+    :param output_dir: The directory to write the preprocessed file to. If None the file is not written.
+    :param checkpoint: If set the processed users are written to the checkpoint, see __merge_user_mutations
+    :param genotypes: The cohort genotype matrix, see preprocess_cohort. If set the columns of the users are selected
+    from it instead of processing the users again.
+    :return: The preprocessed data frame indexed by RSID. It has the Gene_info column, a column with the mutations of
+    each user with valid data and the mutation percentage columns, like the preprocessed file.
+    """
+    logger.info('{} Users for Phenotype {}'.format(len(users), phenotype))
+    if genotypes is None:
+        all_user_data = __merge_user_mutations(users, phenotype, snp_details, checkpoint)
+    else:
+        user_columns = [user.id for user in users if user.id in genotypes.columns]
+        all_user_data = genotypes[['Rsid', 'Gene_info'] + user_columns].copy()
+    all_user_data = timed_invoke('calculating mutation percentages', lambda: calc_snp_percents(
+        all_user_data, all_user_data.columns[2:]))
+    if output_dir is not None:
+        timed_invoke("saving preprocessed file for phenotype '{}'".format(phenotype),
+                     lambda: __write_final(phenotype, all_user_data, output_dir))
+
+    all_user_data.set_index(['Rsid'], inplace=True)
+    n_invalid_user_files = len(users) - all_user_data.shape[1] - 2  # exclude RSID and Gene_info columns
+    logger.info("{} invalid user files found for phenotype '{}'".format(n_invalid_user_files, phenotype))
+    return all_user_data
+
+
+def preprocess_cohort(users, snp_details, output_dir=None, checkpoint=None):
+    """
+    Processes all users, regardless of their phenotype, into one genotype matrix. The matrix does not depend on the
+    phenotype, so the data set of any phenotype can be created from it by selecting the columns of its users.
+    :param users: The users
+    :param snp_details: The SNP database
+    :param output_dir: The directory to write the genotypes file to. If None the file is not written.
+    :param checkpoint: If set the processed users are written to the checkpoint, see __merge_user_mutations
+    :return: The genotype matrix with the Rsid and Gene_info columns and a column with the mutations of each user with
+    valid data, named by the user id
+    """
+    logger.info('{} Users in the cohort'.format(len(users)))
+    genotypes = __merge_user_mutations(users, COHORT, snp_details, checkpoint)
+    if output_dir is not None:
+        timed_invoke('saving the cohort genotype matrix', lambda: bgzf.write_csv(
+            genotypes, os.path.join(output_dir, GENOTYPES_FILE),
+            chunk_rows=__shared.get('chunk_rows', WRITE_CHUNK_ROWS)))
+
+    logger.info('{} invalid user files found in the cohort'.format(len(users) - genotypes.shape[1] + 2))
+    return genotypes
+
+
+def preprocess_users(users_phenotypes, snp_details, output_dir=None, checkpoint_interval=0, cohort=False):
+    """
+    Processes the users of each phenotype into the final data structure form, when the data is not sharded or
+    distributed. The checkpoints of an interrupted run in the output directory are resumed.
+    :param users_phenotypes: The users and their phenotypes, see UserPhenotypes
+    :param snp_details: The SNP database
+    :param output_dir: The directory to write the preprocessed files and the checkpoints to. If None nothing is
+    written.
+    :param checkpoint_interval: The number of users processed between checkpoints. If 0, or if there is no output
+    directory, no checkpoints are written.
+    :param cohort: If True all users are processed once into the cohort genotype matrix, see preprocess_cohort, and
+    the users of each phenotype are selected from it
+    :return: A map of phenotypes where the key is the phenotype ID and the value is the preprocessed data frame, see
+    preprocess_phenotype. The value is None for the phenotypes that were preprocessed before the run was resumed.
+    """
+    checkpoint = None
+    if checkpoint_interval > 0 and output_dir is not None:
+        checkpoint = Checkpoint(os.path.join(output_dir, CHECKPOINTS_DIR), checkpoint_interval)
+
+    genotypes = None
+    if cohort:
+        genotypes = timed_invoke('building the cohort genotype matrix', lambda: preprocess_cohort(
+            users_phenotypes.get_users(), snp_details, output_dir, checkpoint))
+
+    def reducer(phenotype, users):
+        """
+        Processes a list of users categorized by phenotype into the final data structure form
+        :param phenotype: The phenotype of the users
+        :param users: The users with the phenotype
+        """
+        if checkpoint is not None and checkpoint.is_complete(phenotype):
+            logger.info("Phenotype '{}' was already preprocessed before the run was resumed".format(phenotype))
+            return None
+
+        all_user_data = preprocess_phenotype(phenotype, users, snp_details, output_dir, checkpoint, genotypes)
+        if checkpoint is not None:
+            checkpoint.complete(phenotype)
+        return all_user_data
+
+    users_phenotypes.reduce_phenotypes(reducer)
+
+    # the checkpoints are only needed until all phenotypes are preprocessed
+    if checkpoint is not None:
+        checkpoint.remove()
+
+    return users_phenotypes.get_phenotypes()
+
+
+def __preprocess_shard(shard_id):
+    """
+    Preprocesses the SNPs of one shard for all phenotypes. The shard is written to a temporary directory that is
+    renamed when it is complete, so a failed shard never leaves partial output.
+    :param shard_id: The id of the shard
+    :return: A tuple of the shard id and the error, which is None if the shard was preprocessed
+    """
+    shard_snps = __shared['shards'][shard_id]
+    shard_dir = os.path.join(__shared['output_dir'], SHARDS_DIR, shard_id)
+    tmp_dir = shard_dir + '.tmp'
+    try:
+        if os.path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        os.makedirs(tmp_dir)
+
+        for phenotype, users in __shared['phenotypes'].items():
+            all_user_data = __merge_user_mutations(users, '{}, {}'.format(phenotype, shard_id), shard_snps)
+            all_user_data = calc_snp_percents(all_user_data, all_user_data.columns[2:])
+            __write_final(phenotype, all_user_data, tmp_dir)
+
+        if os.path.exists(shard_dir):
+            shutil.rmtree(shard_dir)
+        os.rename(tmp_dir, shard_dir)
+        return shard_id, None
+    except Exception:
+        return shard_id, traceback.format_exc()
 
 
-def run(user_data_dir, snp_data_dir, known_pheno_file, output_dir):
+def __concat_shards(shard_ids, phenotypes, snp_details, output_dir):
+    """
+    Concatenates the preprocessed shards into one preprocessed file for each phenotype. The SNPs are in the order of
+    the SNP database and the users are in the same order as when the data is not sharded.
+    :param shard_ids: The ids of all shards
+    :param phenotypes: A dictionary where the key is the phenotype and the value is a list of users
+    :param snp_details: The SNP database
+    :param output_dir: The directory containing the shards directory and to write the preprocessed files to
+    """
+    missing = [shard_id for shard_id in shard_ids if not os.path.isdir(os.path.join(output_dir, SHARDS_DIR, shard_id))]
+    if len(missing) > 0:
+        raise ValueError('{} shards have not been preprocessed. Rerun them with --rerun-shards {}'
+                         .format(len(missing), ','.join(missing)))
+
+    for phenotype, users in phenotypes.items():
+        file_name = "preprocessed_{}.csv.gz".format(phenotype)
+        # floats are parsed exactly so the percentages are written the same as when the data is not sharded
+        all_user_data = pd.concat([pd.read_csv(os.path.join(output_dir, SHARDS_DIR, shard_id, file_name),
+                                               compression='gzip', index_col='Rsid', float_precision='round_trip')
+                                   for shard_id in shard_ids], sort=False)
+
+        user_columns = [str(user.id) for user in users if str(user.id) in all_user_data.columns]
+        all_user_data = all_user_data.loc[snp_details['Rsid'].values, ['Gene_info'] + user_columns + PCT_COLUMNS]
+        all_user_data.index.name = 'Rsid'
+        bgzf.write_csv(all_user_data.reset_index(), os.path.join(output_dir, file_name),
+                       chunk_rows=__shared.get('chunk_rows', WRITE_CHUNK_ROWS))
+
+        logger.info("{} invalid user files found for phenotype '{}'".format(len(users) - len(user_columns), phenotype))
+
+
+def __preprocess_sharded(snp_details, users_phenotypes, shard_size, rerun_shards, workers, output_dir,
+                         max_memory=None):
+    """
+    Preprocesses each chromosome, or chromosome position range, as an independent shard and concatenates the shards.
+    :param snp_details: The SNP database
+    :param users_phenotypes: The users with known phenotypes
+    :param shard_size: The number of base pairs in each shard. If None each chromosome is one shard.
+    :param rerun_shards: The ids of the shards to preprocess again. If None all shards are preprocessed.
+    :param workers: The number of shards preprocessed in parallel
+    :param output_dir: The directory to write the shards and preprocessed files to
+    :param max_memory: The memory budget in megabytes that the number of workers is chosen for. If None all workers
+    are used.
+    """
+    shards = snp.split_shards(snp_details, shard_size)
+    shard_ids = list(shards.keys())
+    logger.info('{} SNP shards: {}'.format(len(shard_ids), ', '.join(shard_ids)))
+
+    run_ids = shard_ids
+    if rerun_shards is not None:
+        unknown = [shard_id for shard_id in rerun_shards if shard_id not in shards]
+        if len(unknown) > 0:
+            raise ValueError('Unknown shards {}. The shards are: {}'.format(unknown, ', '.join(shard_ids)))
+        run_ids = rerun_shards
+
+    phenotypes = users_phenotypes.get_phenotypes()
+    if max_memory is not None:
+        workers = __plan_memory(max_memory, snp_details, phenotypes.values(), workers=workers,
+                                shard_snps=max(len(shard) for shard in shards.values()))['workers']
+
+    __shared['shards'] = shards
+    __shared['phenotypes'] = phenotypes
+    __shared['output_dir'] = output_dir
+
+    if workers == 1:
+        results = map(__preprocess_shard, run_ids)
+    else:
+        pool = Pool(workers, setup_worker_profiler)
+        try:
+            results = list(pool.imap_unordered(__preprocess_shard, run_ids))
+        finally:
+            pool.close()
+            pool.join()
+
+    failed = [shard_id for shard_id, error in results if error is not None]
+    for shard_id, error in results:
+        if error is not None:
+            logger.error('Shard {} failed: {}'.format(shard_id, error))
+    if len(failed) > 0:
+        raise RuntimeError('{} of {} shards failed. Rerun them with --rerun-shards {}'
+                           .format(len(failed), len(run_ids), ','.join(sorted(failed))))
+
+    timed_invoke('concatenating shards', lambda: __concat_shards(shard_ids, phenotypes, snp_details, output_dir))
+
+
+def __plan_memory(max_memory, snp_details, phenotype_users, **settings):
+    """
+    Plans the preprocessing settings for a memory budget, see memory_plan.plan_preprocess. The number of rows written
+    at once is shared with the shard processes.
+    :param max_memory: The memory budget in megabytes
+    :param snp_details: The SNP database
+    :param phenotype_users: The lists of users of each phenotype
+    :param settings: The other settings to plan
+    :return: The planned settings
+    """
+    n_users = max([len(users) for users in phenotype_users] + [0])
+    plan = memory_plan.plan_preprocess(max_memory, len(snp_details), n_users,
+                                       snp_details.memory_usage(index=True, deep=True).sum(), WRITE_CHUNK_ROWS,
+                                       **settings)
+    __shared['chunk_rows'] = plan['chunk_rows']
+    return plan
+
+
+def __run_coordinator(users_phenotypes, queue, batch_size):
+    """
+    Adds a task to the work queue for each batch of users with the same phenotype
+    :param users_phenotypes: The users with known phenotypes
+    :param queue: The work queue
+    :param batch_size: The number of users in each task
+    """
+    queue.clear()
+    n_tasks = 0
+    for phenotype, users in users_phenotypes.get_phenotypes().items():
+        for start in range(0, len(users), batch_size):
+            queue.add('{:06d}'.format(n_tasks), {
+                'phenotype': phenotype,
+                'user_files': [user.file_path for user in users[start:start + batch_size]]
+            })
+            n_tasks += 1
+
+    queue.close()
+    logger.info('{} tasks added to the work queue "{}"'.format(n_tasks, queue.queue_dir))
+
+
+def __process_task(task_id, task, snp_details, genome_cache, queue):
+    """
+    Calculates the mutations of a batch of users and writes the genotype matrix and the mutation counts of each SNP
+    as the task result
+    :param task_id: The task id
+    :param task: The task descriptor with the phenotype and user files
+    :param snp_details: The SNP database
+    :param genome_cache: The optional cache of parsed user genomic files
+    :param queue: The work queue
+    """
+    users = [User(os.path.dirname(f), os.path.basename(f), genome_cache) for f in task['user_files']]
+    all_user_data = __merge_user_mutations(users, task['phenotype'], snp_details)
+
+    genotypes = all_user_data.iloc[:, 2:].values.astype(np.float32)
+    counts = PackedGenotypes.from_array(genotypes).snp_counts()[:, :3]
+    queue.write_result(task_id, '.npz', lambda f: np.savez(
+        f, rsids=all_user_data['Rsid'].values.astype(str), users=np.array(all_user_data.columns[2:], dtype=np.int64),
+        genotypes=genotypes, counts=counts))
+
+
+def __run_worker(output_dir, queue_dir, genome_cache_dir, genome_cache_size, forked=False):
+    """
+    Claims and processes tasks from the work queue until all tasks are claimed
+    :param output_dir: The output directory of the coordinator, which contains the SNP database
+    :param queue_dir: The work queue directory
+    :param genome_cache_dir: The directory to cache the parsed user genomic files in. If None nothing is cached.
+    :param genome_cache_size: The maximum size of the genome cache in megabytes
+    :param forked: True if the worker runs in a process forked by __run_workers
+    """
+    worker_id = '{}_{}'.format(socket.gethostname(), os.getpid())
+    if forked:
+        setup_worker_profiler()
+
+    # The coordinator cleans the output directory, so the worker only logs to it once the tasks are added
+    queue = WorkQueue(queue_dir)
+    if not queue.is_closed():
+        print 'Waiting for the coordinator to add the tasks to "{}"'.format(queue_dir)
+        while not queue.is_closed():
+            time.sleep(5)
+
+    setup_logger(output_dir, 'preprocess_worker_{}'.format(worker_id))
+
+    snp_details = pd.read_csv(os.path.join(output_dir, 'snp_database.csv.gz'), compression='gzip')
+    genome_cache = None
+    if genome_cache_dir:
+        genome_cache = GenomeCache(expand_path(genome_cache_dir), genome_cache_size * 1024 * 1024)
+
+    n_tasks = 0
+    claimed = queue.claim(worker_id)
+    while claimed is not None:
+        task_id, task = claimed
+        try:
+            timed_invoke('task {} ({} users with phenotype \'{}\')'
+                         .format(task_id, len(task['user_files']), task['phenotype']),
+                         lambda: __process_task(task_id, task, snp_details, genome_cache, queue), 'processing tasks')
+            queue.complete(task_id)
+            n_tasks += 1
+        except Exception:
+            error = traceback.format_exc()
+            logger.error('Task {} failed: {}'.format(task_id, error))
+            queue.fail(task_id, error)
+
+        claimed = queue.claim(worker_id)
+
+    logger.info('Worker {} finished {} tasks'.format(worker_id, n_tasks))
+
+
+def __run_workers(workers, output_dir, queue_dir, genome_cache_dir, genome_cache_size):
+    """
+    Runs several worker processes on this machine
+    :param workers: The number of worker processes
+    """
+    if workers == 1:
+        __run_worker(output_dir, queue_dir, genome_cache_dir, genome_cache_size)
+        return
+
+    processes = [Process(target=__run_worker, args=(output_dir, queue_dir, genome_cache_dir, genome_cache_size, True))
+                 for _ in range(workers)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+
+def __merge_results(queue, snp_details, output_dir):
+    """
+    Merges the task results into one preprocessed file for each phenotype. The user genotypes are concatenated in
+    task order and the mutation counts of the tasks are added to calculate the mutation percentages.
+    :param queue: The work queue
+    :param snp_details: The SNP database
+    :param output_dir: The directory to write the preprocessed files to
+    """
+    task_ids = queue.task_ids()
+    failures = queue.failures()
+    unfinished = [task_id for task_id in task_ids if not queue.is_done(task_id)]
+    if len(task_ids) == 0 or not queue.is_closed():
+        raise ValueError('The work queue "{}" has no tasks. Run the coordinator first.'.format(queue.queue_dir))
+    if len(unfinished) > 0:
+        for task_id in sorted(failures):
+            logger.error('Task {} failed: {}'.format(task_id, failures[task_id]))
+        raise ValueError('{} of {} tasks are not done ({} failed). Run the requeue role and more workers to finish '
+                         'them.'.format(len(unfinished), len(task_ids), len(failures)))
+
+    phenotype_tasks = {}
+    for task_id in task_ids:
+        phenotype_tasks.setdefault(queue.get(task_id)['phenotype'], []).append(task_id)
+
+    rsids = snp_details['Rsid'].values.astype(str)
+    for phenotype, phenotype_task_ids in phenotype_tasks.items():
+        users, genotypes, counts = [], [], 0
+        for task_id in phenotype_task_ids:
+            with open(queue.result_path(task_id, '.npz'), 'rb') as f:
+                result = np.load(f)
+                if not np.array_equal(result['rsids'], rsids):
+                    raise ValueError('The result of task {} does not match the SNP database'.format(task_id))
+                users.extend(result['users'])
+                genotypes.append(result['genotypes'])
+                counts = counts + result['counts']
+
+        all_user_data = snp_details[['Rsid', 'Gene_info']].reset_index(drop=True)
+        user_data = pd.DataFrame(np.hstack(genotypes).astype(np.float64), columns=users)
+        all_user_data = pd.concat([all_user_data, user_data], axis=1)
+        all_user_data = add_snp_percents(all_user_data, counts)
+        timed_invoke("saving preprocessed file for phenotype '{}'".format(phenotype),
+                     lambda: __write_final(phenotype, all_user_data, output_dir))
+        logger.info("{} users for phenotype '{}'".format(len(users), phenotype))
+
+
+def run(user_data_dir, snp_data_dir, known_pheno_file, output_dir, genome_cache_dir=None, genome_cache_size=10240,
+        shards=False, shard_size=None, rerun_shards=None, workers=1, queue_role=None, queue_dir=None, batch_size=50,
+        checkpoint_interval=100, resume=False, max_memory=None, cohort=False, cache_dir=None, profile=False,
+        profile_memory=False):
     """
     Preprocesses the user data for model building
     :param user_data_dir: The directory containing all user genomic files
     :param snp_data_dir: The directory containing all SNP VCF files
     :param known_pheno_file: The file containing the known user phenotype classifications
     :param output_dir: The directory to write the preprocessed files to
+    :param genome_cache_dir: The directory to cache the parsed user genomic files in. If None nothing is cached.
+    :param genome_cache_size: The maximum size of the genome cache in megabytes
+    :param shards: If True each chromosome is preprocessed as an independent shard
+    :param shard_size: The number of base pairs in each shard. If None each chromosome is one shard.
+    :param rerun_shards: The ids of shards to preprocess again, i.e. after they failed. The other shards are not
+    preprocessed and the output directory is not cleaned. This implies shards.
+    :param workers: The number of shards preprocessed in parallel, or the number of local worker processes for the
+    worker role
+    :param queue_role: The role of this process when preprocessing is distributed through a work queue on a shared
+    filesystem. The coordinator adds the tasks, workers on any machine process them, merge writes the preprocessed files
+    from the task results and requeue releases the tasks that were not finished. If None the work is not distributed.
+    :param queue_dir: The work queue directory. If None the queue directory in the output directory is used.
+    :param batch_size: The number of users in each work queue task
+    :param checkpoint_interval: The number of users processed between checkpoints. If 0 no checkpoints are written.
+    :param resume: If True the run continues from the last checkpoint of an interrupted run instead of cleaning the
+    output directory
+    :param max_memory: The memory budget in megabytes. The number of rows written at once, the number of shard workers
+    and the number of users in each work queue task are chosen from the number of users and SNPs so that the working
+    set fits the budget. If None the settings are used as given.
+    :param cohort: If True all user files, with or without a known phenotype, are processed once into the cohort
+    genotype matrix, which is written to the genotypes file. The preprocessed files are created from it by selecting
+    the users of each phenotype, and the model can create the data set of any other phenotype from it.
+    :param cache_dir: The stage cache directory. If the input files and the code did not change since a run with the
+    same cache directory, the outputs of that run are linked into the output directory instead of preprocessing the
+    data again. The cache is only used when the data is not sharded or distributed. If None nothing is cached.
+    :param profile: If True each stage is profiled and the reports are written to the output directory
+    :param profile_memory: If True the memory allocations of each profiled stage are traced
     :return:
     """
     # Expand file paths
@@ -112,37 +538,106 @@ def run(user_data_dir, snp_data_dir, known_pheno_file, output_dir):
     known_pheno_file = expand_path(known_pheno_file)
     output_dir = expand_path(output_dir)
 
-    # Make sure output directory exists before doing work
-    clean_output(output_dir)
+    queue_dir = expand_path(queue_dir) if queue_dir else os.path.join(output_dir, QUEUE_DIR)
+    if queue_role is not None and queue_role not in QUEUE_ROLES:
+        raise ValueError('Queue role "{}" is not valid. Must be one of the following: {}'
+                         .format(queue_role, QUEUE_ROLES))
+
+    if resume and (shards or rerun_shards is not None or queue_role is not None):
+        raise ValueError('Resume is only supported when the data is not sharded or distributed. '
+                         'Failed shards can be rerun and unfinished work queue tasks can be requeued.')
+
+    if cohort and (shards or rerun_shards is not None or queue_role is not None):
+        raise ValueError('The cohort genotype matrix is only supported when the data is not sharded or distributed.')
+
+    if queue_role == 'worker':
+        __run_workers(workers, output_dir, queue_dir, genome_cache_dir, genome_cache_size)
+        return
+
+    shards = shards or rerun_shards is not None
+    cache = None
+    if cache_dir is not None and not shards and queue_role is None and not resume:
+        cache = StageCache(expand_path(cache_dir))
+        fingerprint = cache.fingerprint('preprocess', {'cohort': cohort},
+                                        [user_data_dir, snp_data_dir, known_pheno_file])
+        if cache.restore(fingerprint, output_dir):
+            setup_logger(output_dir, "preprocess")
+            logger.info('The inputs are unchanged, the preprocessed files were restored from the stage cache "{}"'
+                        .format(cache.cache_dir))
+            logger.info('Output written to "{}"'.format(output_dir))
+            return
+
+    # Make sure output directory exists before doing work. The existing shards are kept when some are run again, the
+    # coordinator output is kept when the work queue results are merged and the checkpoints are kept when resuming.
+    if rerun_shards is None and queue_role in [None, 'coordinator'] and not resume:
+        clean_output(output_dir)
+    else:
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+        # the existing outputs are rewritten, so they must not be linked to the stage cache
+        detach_outputs(output_dir)
 
     setup_logger(output_dir, "preprocess")
+    setup_profiler(output_dir, profile, profile_memory)
+
+    if queue_role == 'requeue':
+        requeued = WorkQueue(queue_dir).requeue()
+        logger.info('{} unfinished tasks requeued: {}'.format(len(requeued), ', '.join(requeued)))
+        return
+    elif queue_role == 'merge':
+        snp_details = pd.read_csv(os.path.join(output_dir, 'snp_database.csv.gz'), compression='gzip')
+        if max_memory is not None:
+            queue = WorkQueue(queue_dir)
+            phenotype_users = {}
+            for task_id in queue.task_ids():
+                task = queue.get(task_id)
+                phenotype_users.setdefault(task['phenotype'], []).extend(task['user_files'])
+            __plan_memory(max_memory, snp_details, phenotype_users.values())
+        timed_invoke('merging the work queue results', lambda: __merge_results(
+            WorkQueue(queue_dir), snp_details, output_dir))
+        logger.info('Output written to "{}"'.format(output_dir))
+        return
 
     def timed_run():
         # Build SNPs data frame
         snp_details = timed_invoke('building SNP data frame', lambda: snp.build_database(snp_data_dir, output_dir))
 
         # Build users information
-        users_phenotypes = UserPhenotypes(known_pheno_file, user_data_dir)
-
-        def reducer(phenotype, users):
-            """
-            Processes a list of users categorized by phenotype into the final data structure form
-            :param phenotype: The phenotype of the users
-            :param users: The users with the phenotype
-            """
-            logger.info('{} Users for Phenotype {}'.format(len(users), phenotype))
-            all_user_data = __merge_user_mutations(users, phenotype, snp_details)
-            all_user_data = timed_invoke('calculating mutation percentages', lambda: __calc_snp_percents(all_user_data))
-            timed_invoke("saving preprocessed file for phenotype '{}'".format(phenotype),
-                         lambda: __write_final(phenotype, all_user_data, output_dir))
-            n_invalid_user_files = len(users) - all_user_data.shape[1] - 2  # exclude RSID and Gene_info columns
-            logger.info("{} invalid user files found for phenotype '{}'".format(n_invalid_user_files, phenotype))
-            return all_user_data
-
-        timed_invoke('building final data structure', lambda: users_phenotypes.reduce_phenotypes(reducer))
+        genome_cache = None
+        if genome_cache_dir:
+            genome_cache = GenomeCache(expand_path(genome_cache_dir), genome_cache_size * 1024 * 1024)
+        elif shards:
+            # every shard reads all user files, so they are only parsed by the first shard that reads them
+            genome_cache = GenomeCache(os.path.join(output_dir, SHARDS_DIR, 'genome_cache'),
+                                       genome_cache_size * 1024 * 1024)
+        users_phenotypes = UserPhenotypes(known_pheno_file, user_data_dir, genome_cache)
+
+        if queue_role == 'coordinator':
+            task_size = batch_size
+            if max_memory is not None:
+                task_size = __plan_memory(max_memory, snp_details, users_phenotypes.get_phenotypes().values(),
+                                          batch_size=batch_size)['batch_size']
+            timed_invoke('adding tasks to the work queue', lambda: __run_coordinator(
+                users_phenotypes, WorkQueue(queue_dir), task_size))
+            return
+
+        if shards:
+            timed_invoke('building final data structure from shards', lambda: __preprocess_sharded(
+                snp_details, users_phenotypes, shard_size, rerun_shards, workers, output_dir, max_memory))
+            return
+
+        if max_memory is not None:
+            __plan_memory(max_memory, snp_details, [users_phenotypes.get_users()] if cohort else
+                          users_phenotypes.get_phenotypes().values())
+
+        timed_invoke('building final data structure', lambda: preprocess_users(
+            users_phenotypes, snp_details, output_dir, checkpoint_interval, cohort))
 
     timed_invoke('preprocessing data', lambda: timed_run())
 
+    if cache is not None:
+        timed_invoke('adding the preprocessed files to the stage cache', lambda: cache.store(fingerprint, output_dir))
+
     logger.info('Output written to "{}"'.format(output_dir))
 
 
@@ -152,15 +647,17 @@ if __name__ == '__main__':
     parser.add_argument(
         "--user-geno",
         "-u",
-        metavar="<directory path>",
+        metavar="<directory or archive path>",
         default="resources" + os.sep + "data" + os.sep + "users",
         help="The directory containing user genomic data. Each file contains data for one user."
              " 23andMe and Ancestry.com data formats are supported."
              " File names must start with the numeric user ID followed by an underscore and end"
-             " with either 23andme.txt or ancestry.txt."
+             " with either 23andme.txt or ancestry.txt, optionally followed by .gz for gzip compressed files."
+             " A zip or tar archive of the files, like the openSNP data dump, can be used instead of a directory."
+             " The files are read from the archive without extracting it."
              "\n\nExamples:"
              "\nuser44_file19_yearofbirth_1970_sex_XY.23andme.txt"
-             "\nuser44_file19_yearofbirth_1970_sex_XY.ancestry.txt"
+             "\nuser44_file19_yearofbirth_1970_sex_XY.ancestry.txt.gz"
              "\n\nDefault: resources/data/users"
         )
 
@@ -202,5 +699,171 @@ if __name__ == '__main__':
              "\n\nDefault: resources/data/preprocessed"
     )
 
+    parser.add_argument(
+        "--genome-cache",
+        "-gc",
+        metavar="<directory path>",
+        help="The directory to cache the parsed user genomic files in. Cached files are not parsed again in later "
+             "preprocess and predict runs unless they change. If not set, the user files are always parsed."
+    )
+
+    parser.add_argument(
+        "--genome-cache-size",
+        "-gcs",
+        metavar="MB",
+        type=int,
+        default=10240,
+        help="The maximum size of the genome cache in megabytes. The least recently used genomes are removed when "
+             "the cache is larger."
+             "\n\nDefault: 10240"
+    )
+
+    parser.add_argument(
+        "--shards",
+        "-sh",
+        default=False,
+        action='store_true',
+        help="If set then each chromosome is preprocessed as an independent shard in the shards directory of the "
+             "output directory. The shards are then concatenated into the preprocessed files. If --genome-cache is "
+             "not set, the parsed user files are cached in the shards directory so they are only parsed once."
+             "\n\nDefault: False"
+    )
+
+    parser.add_argument(
+        "--shard-size",
+        "-ss",
+        metavar="base pairs",
+        type=int,
+        help="If set with --shards then chromosomes are split into shards of this many base pairs."
+    )
+
+    parser.add_argument(
+        "--rerun-shards",
+        "-rs",
+        metavar="shard ids",
+        help="A comma separated list of shards to preprocess again (i.e. chr1,chr7), for example after they failed. "
+             "Only these shards are preprocessed, the existing shards are kept and all shards are concatenated "
+             "again. This implies --shards."
+    )
+
+    parser.add_argument(
+        "--workers",
+        "-j",
+        type=int,
+        default=1,
+        help="The number of shards preprocessed in parallel, or the number of worker processes started on this "
+             "machine for --queue-role worker."
+             "\n\nDefault: 1"
+    )
+
+    parser.add_argument(
+        "--queue-role",
+        "-qr",
+        choices=QUEUE_ROLES,
+        help="Distributes preprocessing through a work queue on a filesystem shared by several machines."
+             "\ncoordinator = builds the SNP database and adds a task to the queue for each batch of users"
+             "\nworker = claims and processes tasks until all tasks are claimed. Start workers on any machine with "
+             "the same --output and --queue-dir."
+             "\nmerge = writes the preprocessed files from the task results once all tasks are done"
+             "\nrequeue = releases the tasks that failed or whose worker was killed. Only run it when no workers are "
+             "running."
+    )
+
+    parser.add_argument(
+        "--queue-dir",
+        "-qd",
+        metavar="<directory path>",
+        help="The work queue directory. It must be on a filesystem shared by all machines."
+             "\n\nDefault: the queue directory in the output directory"
+    )
+
+    parser.add_argument(
+        "--batch-size",
+        "-bs",
+        type=int,
+        default=50,
+        help="The number of users in each work queue task."
+             "\n\nDefault: 50"
+    )
+
+    parser.add_argument(
+        "--checkpoint-interval",
+        "-ci",
+        metavar="users",
+        type=int,
+        default=100,
+        help="The number of users processed between checkpoints. The mutations of the processed users are written to "
+             "the checkpoints directory of the output directory, so an interrupted run can be resumed with --resume. "
+             "The checkpoints are removed when the run is complete. If 0 no checkpoints are written."
+             "\n\nDefault: 100"
+    )
+
+    parser.add_argument(
+        "--resume",
+        "-r",
+        default=False,
+        action='store_true',
+        help="If set then the run continues from the last checkpoint of an interrupted run with the same input, "
+             "instead of cleaning the output directory and starting over."
+             "\n\nDefault: False"
+    )
+
+    parser.add_argument(
+        "--max-memory",
+        "-mm",
+        type=int,
+        metavar="<megabytes>",
+        help="The memory budget in megabytes. The working set is estimated from the number of users and SNPs, and "
+             "the number of rows written at once, the number of shard workers and the number of users in each work "
+             "queue task are lowered until it fits. The plan is logged."
+             "\n\nDefault: no limit"
+    )
+
+    parser.add_argument(
+        "--cohort",
+        "-co",
+        default=False,
+        action='store_true',
+        help="If set then all user files, with or without a known phenotype, are processed once into one genotype "
+             "matrix of the whole cohort, which is written to genotypes.csv.gz. The preprocessed files are created "
+             "from it and the model step can create the data set of any other phenotype file from it with "
+             "--genotypes and --phenotypes, without preprocessing again. Not used with --shards or --queue-role."
+             "\n\nDefault: False"
+    )
+
+    parser.add_argument(
+        "--cache-dir",
+        "-cd",
+        metavar="<directory path>",
+        help="The stage cache directory. The outputs of each run are stored in the cache by the hash of the input "
+             "files and the code. When they did not change the cached outputs are linked into the output directory "
+             "instead of preprocessing the data again. Not used with --shards, --queue-role or --resume."
+             "\n\nDefault: no cache"
+    )
+
+    parser.add_argument(
+        "--profile",
+        "-pf",
+        default=False,
+        action='store_true',
+        help="If set then each stage is profiled with cProfile. The pstats files and a summary of the slowest "
+             "functions for each stage are written to the output directory."
+             "\n\nDefault: False"
+    )
+
+    parser.add_argument(
+        "--profile-memory",
+        "-pm",
+        default=False,
+        action='store_true',
+        help="If set with --profile then the memory allocations of each stage are also traced with tracemalloc and "
+             "the top allocations are written to the output directory. Requires Python 3.4 or later, older "
+             "versions log a warning and only profile the time."
+             "\n\nDefault: False"
+    )
+
     args = parser.parse_args()
-    run(args.user_geno, args.snp, args.known_phenos, args.output)
+    run(args.user_geno, args.snp, args.known_phenos, args.output, args.genome_cache, args.genome_cache_size,
+        args.shards, args.shard_size, args.rerun_shards.split(',') if args.rerun_shards else None, args.workers,
+        args.queue_role, args.queue_dir, args.batch_size, args.checkpoint_interval, args.resume, args.max_memory,
+        args.cohort, args.cache_dir, args.profile, args.profile_memory)
@@ -0,0 +1,225 @@
+"""
+Block gzip (BGZF) files, the layout used by bgzip and tabix. The file is a series of gzip members (blocks) that each
+hold at most 64KB of data, so every block can be compressed and decompressed on its own. The compressed size of each
+block is stored in the BC extra field of its gzip header. The file ends with an empty block.
+
+The files are valid multi-member gzip files, so they can be read with gzip, zcat and pandas. A position in the file is
+a virtual offset, the offset of the block in the file shifted left 16 bits plus the offset in the uncompressed block.
+"""
+import os
+import struct
+import zlib
+from cStringIO import StringIO
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+import pandas as pd
+
+import logging
+logger = logging.getLogger('root')
+
+# The maximum number of uncompressed bytes in a block. The compressed block, including the header and footer, must
+# not be larger than 64KB even if the data does not compress.
+BLOCK_SIZE = 0xff00
+INDEX_SUFFIX = '.idx'
+# The index stores the difference to the virtual offset of the previous row, which is usually the row length, so it
+# compresses well
+INDEX_COLUMNS = ['Rsid', 'Gene_info', 'offset_delta']
+
+__HEADER = struct.Struct('<4BI2BH2BHH')
+__FOOTER = struct.Struct('<II')
+EOF_BLOCK = '\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00'
+
+
+def compress_block(data, level=6):
+    """
+    Compresses data into one block
+    :param data: The uncompressed data, at most BLOCK_SIZE bytes
+    :param level: The zlib compression level
+    :return: The block
+    """
+    # a raw deflate stream, the gzip header and footer are written around it
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    deflated = compressor.compress(data) + compressor.flush()
+    block_size = __HEADER.size + len(deflated) + __FOOTER.size
+    header = __HEADER.pack(0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6, ord('B'), ord('C'), 2, block_size - 1)
+    return header + deflated + __FOOTER.pack(zlib.crc32(data) & 0xffffffff, len(data))
+
+
+def write_csv(data, path, index_columns=('Rsid', 'Gene_info'), threads=None, chunk_rows=10000,
+              block_size=BLOCK_SIZE):
+    """
+    Writes a data frame as a BGZF compressed CSV file, without the data frame index, and writes the row index of the
+    file. The rows are formatted in chunks and the blocks of each chunk are compressed in parallel in a thread pool and
+    written before the next chunk is formatted, so only the text of a chunk is in memory.
+    :param data: The data frame
+    :param path: The file path. The row index is written to the path with the .idx suffix.
+    :param index_columns: The two columns of the data frame that identify a row in the index, the RSID and gene
+    :param threads: The number of compression threads. If None a thread is used for each CPU.
+    :param chunk_rows: The number of rows formatted at once
+    :param block_size: The maximum number of uncompressed bytes in a block
+    """
+    # Each row starts at a position in a block. The block of the row is the block number and the position is later
+    # converted to a virtual offset, once the compressed size of the blocks before it is known.
+    row_blocks, row_positions = [], []
+    offsets = []
+    blocks = []
+    buf = []
+    buf_size = [0]
+
+    def flush():
+        blocks.append(''.join(buf))
+        del buf[:]
+        buf_size[0] = 0
+
+    def add(text, is_row):
+        if is_row:
+            if buf_size[0] >= block_size:
+                flush()
+            row_blocks.append(len(offsets) + len(blocks))
+            row_positions.append(buf_size[0])
+
+        # rows longer than the free space of the block continue in the next blocks
+        while len(text) > 0:
+            free = block_size - buf_size[0]
+            if free == 0:
+                flush()
+                continue
+            buf.append(text[:free])
+            buf_size[0] += min(free, len(text))
+            text = text[free:]
+
+    def write_blocks(f):
+        for block in pool.map(compress_block, blocks):
+            offsets.append(f.tell())
+            f.write(block)
+        del blocks[:]
+
+    pool = ThreadPool(threads or cpu_count())
+    try:
+        with open(path, 'wb') as f:
+            add(data.iloc[:0].to_csv(index=False), False)
+            for start in range(0, len(data), chunk_rows):
+                for line in data.iloc[start:start + chunk_rows].to_csv(index=False, header=False).splitlines(True):
+                    add(line, True)
+                write_blocks(f)
+            if buf_size[0] > 0:
+                flush()
+            write_blocks(f)
+            f.write(EOF_BLOCK)
+    finally:
+        pool.terminate()
+
+    block_offsets = np.array(offsets, dtype=np.int64)
+    virtual_offsets = (block_offsets[row_blocks] << 16) | np.array(row_positions, dtype=np.int64)
+    index = pd.DataFrame({
+        INDEX_COLUMNS[0]: data[index_columns[0]].values,
+        INDEX_COLUMNS[1]: data[index_columns[1]].values,
+        INDEX_COLUMNS[2]: np.diff(virtual_offsets, prepend=0)
+    }, columns=INDEX_COLUMNS)
+    index.to_csv(path + INDEX_SUFFIX, index=False, compression='gzip')
+
+
+def has_index(path):
+    return os.path.exists(path + INDEX_SUFFIX)
+
+
+def read_index(path):
+    """
+    Reads the row index of a BGZF compressed CSV file
+    :param path: The file path
+    :return: A data frame with the Rsid, Gene_info and offset columns, where the offset is the virtual offset of the row
+    """
+    index = pd.read_csv(path + INDEX_SUFFIX, compression='gzip', dtype={INDEX_COLUMNS[0]: str, INDEX_COLUMNS[1]: str})
+    index['offset'] = index.pop(INDEX_COLUMNS[2]).cumsum()
+    return index
+
+
+def read_rows(path, rsids=None, genes=None, **kwargs):
+    """
+    Reads the rows of a BGZF compressed CSV file with an RSID or gene. Only the blocks with the rows are read.
+    :param path: The file path. The file must have a row index, see write_csv.
+    :param rsids: The RSIDs of the rows to read
+    :param genes: The genes of the rows to read
+    :param kwargs: Other arguments for pandas.read_csv
+    :return: A data frame with the rows, in the order of the file
+    """
+    index = read_index(path)
+    selected = pd.Series(False, index=index.index)
+    if rsids is not None:
+        selected |= index['Rsid'].isin(rsids)
+    if genes is not None:
+        selected |= index['Gene_info'].isin(genes)
+
+    with BlockReader(path) as reader:
+        lines = [reader.read_line(0)]
+        lines.extend(reader.read_line(offset) for offset in index.loc[selected, 'offset'].values)
+
+    return pd.read_csv(StringIO(''.join(lines)), **kwargs)
+
+
+class BlockReader:
+    """
+    Reads lines from a BGZF file at virtual offsets. The last decompressed block is kept, so reading lines in file
+    order decompresses each block once.
+    """
+
+    def __init__(self, path):
+        self.__file = open(path, 'rb')
+        self.__block_offset = None
+        self.__block = None
+        self.__next_offset = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self.__file.close()
+
+    def read_line(self, virtual_offset):
+        """
+        Reads the line starting at a virtual offset
+        :param virtual_offset: The virtual offset
+        :return: The line, including the line break
+        """
+        self.__load(int(virtual_offset) >> 16)
+        position = int(virtual_offset) & 0xffff
+        parts = []
+        while True:
+            end = self.__block.find('\n', position)
+            if end >= 0:
+                parts.append(self.__block[position:end + 1])
+                return ''.join(parts)
+
+            # the line continues in the next block
+            parts.append(self.__block[position:])
+            if not self.__load(self.__next_offset):
+                return ''.join(parts)
+            position = 0
+
+    def __load(self, block_offset):
+        """
+        Decompresses the block at a file offset
+        :param block_offset: The file offset of the block
+        :return: False if there is no block at the offset
+        """
+        if block_offset == self.__block_offset:
+            return True
+
+        self.__file.seek(block_offset)
+        header = self.__file.read(18)
+        if len(header) < 18:
+            return False
+        if header[:4] != '\x1f\x8b\x08\x04' or header[12:14] != 'BC':
+            raise ValueError('"{}" is not a BGZF file'.format(self.__file.name))
+
+        block_size = struct.unpack('<H', header[16:18])[0] + 1
+        data = self.__file.read(block_size - 18)
+        self.__block = zlib.decompress(data[:-8], -zlib.MAX_WBITS)
+        self.__block_offset = block_offset
+        self.__next_offset = block_offset + block_size
+        return True
@@ -0,0 +1,136 @@
+import hashlib
+import os
+import re
+import shutil
+import tempfile
+
+import numpy as np
+
+import logging
+logger = logging.getLogger('root')
+
+
+class Checkpoint:
+    """
+    Periodic checkpoints of the user mutations of each phenotype, so an interrupted preprocessing run can be resumed.
+
+    The users of a phenotype are processed in chunks. When a chunk is done its genotype matrix (the mutations of each
+    user in the chunk for every SNP), the files of the users in the chunk and the hash of the SNP order are written to
+    one file. Chunk files are written atomically, so the chunk files are always the complete list of processed users.
+    """
+
+    def __init__(self, checkpoint_dir, interval):
+        """
+        Creates a new checkpoint
+        :param checkpoint_dir: The directory to write the checkpoints in. It is created if it does not exist.
+        :param interval: The number of users in each chunk
+        """
+        self.checkpoint_dir = checkpoint_dir
+        self.interval = interval
+
+    @staticmethod
+    def snp_hash(rsids):
+        """
+        Identifies the SNPs and their order, which are the rows of the chunk genotype matrices
+        :param rsids: The RSIDs of the SNP database rows
+        :return: The hash of the RSIDs
+        """
+        return hashlib.sha1('\n'.join(str(rsid) for rsid in rsids)).hexdigest()
+
+    def load(self, phenotype, user_files, snp_hash):
+        """
+        Loads the chunks of a phenotype. Only chunks that processed the same users in the same order, with the same
+        SNPs, are used. Chunks after the first chunk that does not match are removed.
+        :param phenotype: The phenotype
+        :param user_files: The files of all users with the phenotype, in processing order
+        :param snp_hash: The hash of the SNP database rows, see snp_hash
+        :return: A tuple of the number of processed users, the ids of the users with data and a list of the genotype
+        matrices of the chunks
+        """
+        n_processed, user_ids, genotypes = 0, [], []
+        chunk_files = self.__chunk_files(phenotype)
+        for i, chunk_file in enumerate(chunk_files):
+            with open(chunk_file, 'rb') as f:
+                chunk = np.load(f)
+                files = list(chunk['files'])
+                valid = files == user_files[n_processed:n_processed + len(files)] and \
+                    'snps' in chunk.files and str(chunk['snps']) == snp_hash
+                if valid:
+                    n_processed += len(files)
+                    user_ids.extend(chunk['users'])
+                    genotypes.append(chunk['genotypes'])
+
+            if not valid:
+                logger.warning('The checkpoint for phenotype \'{}\' does not match the users or SNPs after {} users. '
+                               'Processing the remaining users again.'.format(phenotype, n_processed))
+                for invalid_file in chunk_files[i:]:
+                    os.remove(invalid_file)
+                break
+
+        return n_processed, user_ids, genotypes
+
+    def save(self, phenotype, user_files, user_ids, genotypes, snp_hash):
+        """
+        Writes the next chunk of a phenotype
+        :param phenotype: The phenotype
+        :param user_files: The files of the users processed in the chunk, including users without valid data
+        :param user_ids: The ids of the users with data
+        :param genotypes: The genotype matrix of the users with data with shape (SNPs, users)
+        :param snp_hash: The hash of the SNP database rows, see snp_hash
+        """
+        phenotype_dir = self.__phenotype_dir(phenotype)
+        if not os.path.exists(phenotype_dir):
+            os.makedirs(phenotype_dir)
+
+        chunk_path = os.path.join(phenotype_dir, 'chunk_{:06d}.npz'.format(len(self.__chunk_files(phenotype))))
+        fd, tmp_path = tempfile.mkstemp(dir=phenotype_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, files=np.array(user_files, dtype=str), users=np.array(user_ids, dtype=np.int64),
+                         genotypes=genotypes, snps=np.array(snp_hash))
+            os.rename(tmp_path, chunk_path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def complete(self, phenotype):
+        """
+        Marks that the preprocessed file of a phenotype is written
+        :param phenotype: The phenotype
+        """
+        phenotype_dir = self.__phenotype_dir(phenotype)
+        if not os.path.exists(phenotype_dir):
+            os.makedirs(phenotype_dir)
+        with open(os.path.join(phenotype_dir, 'complete'), 'w') as f:
+            f.write('complete')
+
+    def is_complete(self, phenotype):
+        return os.path.exists(os.path.join(self.__phenotype_dir(phenotype), 'complete'))
+
+    def remove(self):
+        """
+        Removes all checkpoints
+        """
+        if os.path.exists(self.checkpoint_dir):
+            shutil.rmtree(self.checkpoint_dir)
+
+    def __phenotype_dir(self, phenotype):
+        """
+        Gets the checkpoint directory of a phenotype. Labels that are not safe file names, i.e. with path separators,
+        are replaced by a safe name with the hash of the label, so different labels never share a directory.
+        :param phenotype: The phenotype
+        :return: The directory path
+        """
+        name = str(phenotype)
+        if not re.match(r'^\w[\w.-]*$', name):
+            name = '{}_{}'.format(re.sub(r'\W+', '_', name).strip('_'), hashlib.sha1(name).hexdigest()[:8])
+        return os.path.join(self.checkpoint_dir, name)
+
+    def __chunk_files(self, phenotype):
+        phenotype_dir = self.__phenotype_dir(phenotype)
+        if not os.path.exists(phenotype_dir):
+            return []
+
+        chunk_regex = re.compile(r'^chunk_[0-9]+\.npz$')
+        return [os.path.join(phenotype_dir, f) for f in sorted(os.listdir(phenotype_dir)) if chunk_regex.match(f)]
@@ -0,0 +1,70 @@
+"""
+Compact numeric encodings for user genomic data.
+
+RSIDs are encoded as their integer accession number (rs123 -> 123). Genotypes are encoded in one byte, four bits for
+each allele, using the index of the allele in ALLELES. Index 0 means there is no allele, so single allele genotypes
+(i.e. 'A' on the X chromosome for males) keep their length. Genotypes that cannot be encoded are INVALID_GENOTYPE.
+"""
+import numpy as np
+import pandas as pd
+
+ALLELES = ['', 'A', 'C', 'G', 'T', 'D', 'I', '-', '0', 'N']
+INVALID_GENOTYPE = 255
+
+__allele_codes = dict((allele, code) for code, allele in enumerate(ALLELES) if allele != '')
+__genotype_strings = np.array([np.nan if code == INVALID_GENOTYPE or code >> 4 >= len(ALLELES) or
+                               code & 15 >= len(ALLELES) else ALLELES[code >> 4] + ALLELES[code & 15]
+                               for code in range(256)], dtype=object)
+
+
+def encode_rsids(rsids):
+    """
+    Encodes RSIDs as integers. Only dbSNP accession numbers (rs<number>) can be encoded, other identifiers like the
+    23andMe internal identifiers (i<number>) are not in the SNP database.
+    :param rsids: A series of RSID strings
+    :return: A tuple of the encoded RSIDs and a boolean mask of the RSIDs that could be encoded
+    """
+    rsids = pd.Series(rsids).astype(str)
+    valid = rsids.str.match(r'^rs[0-9]+$').values
+    return rsids[valid].str.slice(2).astype(np.int64).values, valid
+
+
+def decode_rsids(rsids):
+    """
+    Decodes integer RSIDs
+    :param rsids: An array of encoded RSIDs
+    :return: An array of RSID strings
+    """
+    return np.array(['rs' + str(rsid) for rsid in rsids], dtype=object)
+
+
+def encode_genotypes(genotypes):
+    """
+    Encodes genotype strings in one byte each
+    :param genotypes: A series of genotype strings (i.e. 'AG')
+    :return: An array of uint8 genotype codes
+    """
+    genotypes = pd.Series(genotypes)
+    is_str = genotypes.map(lambda genotype: isinstance(genotype, basestring)).values
+    genotypes = genotypes.where(is_str, '')
+    lengths = genotypes.str.len().values
+
+    first = genotypes.str[0].map(__allele_codes).values
+    second = genotypes.str[1].map(__allele_codes).values
+    first[lengths < 1] = 0
+    second[lengths < 2] = 0
+
+    codes = np.full(len(genotypes), INVALID_GENOTYPE, dtype=np.uint8)
+    valid = is_str & (lengths <= 2) & ~pd.isnull(first) & ~pd.isnull(second)
+    codes[valid] = (first[valid].astype(np.uint8) << 4) | second[valid].astype(np.uint8)
+    return codes
+
+
+def decode_genotypes(codes):
+    """
+    Decodes genotype codes
+    :param codes: An array of uint8 genotype codes
+    :return: An array of genotype strings. Invalid genotypes are NaN.
+    """
+    return __genotype_strings[np.asarray(codes, dtype=np.uint8)]
+
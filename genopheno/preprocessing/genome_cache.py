@@ -0,0 +1,204 @@
+import os
+import hashlib
+import tempfile
+from contextlib import closing
+
+import numpy as np
+
+from encoding import encode_rsids, encode_genotypes
+import genome_sources
+
+import logging
+logger = logging.getLogger('root')
+
+# The number of writes after which the cache directory is scanned again, to account for writes of other processes
+EVICT_INTERVAL = 100
+# The fraction of the size budget the cache is reduced to on eviction, so the cache is not scanned on every write
+EVICT_TARGET = 0.9
+
+
+class GenomeCache:
+    """
+    A disk cache of parsed user genomic files. Each genome is stored as compact arrays of the encoded RSIDs and
+    genotypes so that user genomic text files only need to be parsed once.
+
+    Genomes are stored by the hash of the file content. A small key file maps the file path, size and modification
+    time to the content hash so unchanged files do not need to be hashed again. Genomes that have not been used
+    recently are evicted together with their key files when the cache is larger than its size budget. The size of
+    the cache is tracked while writing, so the cache directory is only scanned when eviction is needed or every
+    EVICT_INTERVAL writes.
+    """
+
+    def __init__(self, cache_dir, max_size=None):
+        """
+        Creates a new genome cache
+        :param cache_dir: The directory to store the cache in. It is created if it does not exist.
+        :param max_size: The maximum size of the cached genomes in bytes. If None the cache is never evicted.
+        """
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.__size = None
+        self.__writes = 0
+        self.__keys_dir = os.path.join(cache_dir, 'keys')
+        self.__genomes_dir = os.path.join(cache_dir, 'genomes')
+        for directory in [self.__keys_dir, self.__genomes_dir]:
+            if not os.path.exists(directory):
+                try:
+                    os.makedirs(directory)
+                except OSError:
+                    # another process created it first
+                    if not os.path.isdir(directory):
+                        raise
+
+    def get(self, file_path, parse):
+        """
+        Gets the encoded genome for a user file, parsing it if it is not in the cache
+        :param file_path: The path of the user genomic file
+        :param parse: The function that parses the file. It must return a data frame with columns Rsid and Genotype.
+        :return: A tuple of the encoded RSIDs and the encoded genotypes
+        """
+        key_path = os.path.join(self.__keys_dir, self.__stat_key(file_path))
+
+        # Files that did not change since they were cached are found without reading them
+        content_hash = None
+        if os.path.exists(key_path):
+            with open(key_path) as f:
+                content_hash = f.read().strip()
+
+        if content_hash is None or not os.path.exists(self.__genome_path(content_hash)):
+            content_hash = self.__content_hash(file_path)
+            self.__write_atomic(key_path, lambda f: f.write(content_hash))
+
+        genome_path = self.__genome_path(content_hash)
+        if os.path.exists(genome_path):
+            try:
+                with open(genome_path, 'rb') as f:
+                    genome = np.load(f)
+                    rsids, genotypes = genome['rsids'].astype(np.int64), genome['genotypes']
+                # mark the genome as recently used
+                os.utime(genome_path, None)
+                return rsids, genotypes
+            except (IOError, OSError, ValueError, KeyError) as e:
+                logger.warning('Invalid genome cache entry "{}". Parsing "{}" again. Reason: {}'
+                               .format(genome_path, file_path, e))
+
+        data = parse()
+        rsids, valid = encode_rsids(data['Rsid'])
+        genotypes = encode_genotypes(data['Genotype'][valid])
+
+        # Current dbSNP accession numbers fit in 32 bits, which halves the cache size
+        stored_rsids = rsids.astype(np.uint32) if len(rsids) == 0 or rsids.max() < 2 ** 32 else rsids
+        self.__write_atomic(genome_path, lambda f: np.savez(f, rsids=stored_rsids, genotypes=genotypes))
+        self.__track(os.path.getsize(genome_path))
+
+        return rsids, genotypes
+
+    def __genome_path(self, content_hash):
+        return os.path.join(self.__genomes_dir, content_hash + '.npz')
+
+    @staticmethod
+    def __stat_key(file_path):
+        """
+        Creates the key of a file from its path, size and modification time
+        :param file_path: The file path, or the archive path joined with the member name
+        :return: The key
+        """
+        size, mtime = genome_sources.stat(file_path)
+        key = '{}|{}|{!r}'.format(os.path.abspath(file_path), size, mtime)
+        return hashlib.sha1(key).hexdigest()
+
+    @staticmethod
+    def __content_hash(file_path):
+        sha1 = hashlib.sha1()
+        with closing(genome_sources.open_file(file_path)) as f:
+            for block in iter(lambda: f.read(1048576), b''):
+                sha1.update(block)
+
+        return sha1.hexdigest()
+
+    def __write_atomic(self, path, write):
+        """
+        Writes a file atomically so concurrent processes never read partial cache entries
+        :param path: The file path
+        :param write: The function that writes the content to an open file
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                write(f)
+            os.rename(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def __track(self, size):
+        """
+        Adds a written genome to the tracked cache size and evicts genomes if the cache is over its size budget
+        :param size: The size of the written genome in bytes
+        """
+        if self.max_size is None:
+            return
+
+        self.__writes += 1
+        if self.__size is None or self.__writes % EVICT_INTERVAL == 0:
+            self.__evict()
+        else:
+            self.__size += size
+            if self.__size > self.max_size:
+                self.__evict()
+
+    def __evict(self):
+        """
+        Scans the cache size and removes the least recently used genomes and their key files until the cache is
+        within EVICT_TARGET of its size budget
+        """
+        entries = []
+        total_size = 0
+        for file_name in os.listdir(self.__genomes_dir):
+            if not file_name.endswith('.npz'):
+                continue
+
+            path = os.path.join(self.__genomes_dir, file_name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total_size += stat.st_size
+
+        evicted = set()
+        if total_size > self.max_size:
+            for _, size, path in sorted(entries):
+                if total_size <= self.max_size * EVICT_TARGET:
+                    break
+
+                try:
+                    os.remove(path)
+                except OSError:
+                    # already evicted by another process
+                    pass
+                total_size -= size
+                evicted.add(os.path.basename(path)[:-len('.npz')])
+
+        self.__size = total_size
+        if evicted:
+            self.__remove_keys(evicted)
+
+    def __remove_keys(self, content_hashes):
+        """
+        Removes the key files that map to evicted genomes
+        :param content_hashes: The content hashes of the evicted genomes
+        """
+        for file_name in os.listdir(self.__keys_dir):
+            if file_name.endswith('.tmp'):
+                continue
+
+            path = os.path.join(self.__keys_dir, file_name)
+            try:
+                with open(path) as f:
+                    if f.read().strip() in content_hashes:
+                        os.remove(path)
+            except (IOError, OSError):
+                # already removed by another process
+                pass
@@ -0,0 +1,145 @@
+"""
+Reads user genomic files from directories, gzip compressed files and zip or tar archives, like the openSNP data dump,
+without extracting them. A user file in an archive is addressed by the archive path joined with the member name, i.e.
+opensnp_datadump.zip/user1_file9_yearofbirth_unknown_sex_unknown.23andme.txt, so it can be used like any file path.
+
+Each process keeps its archives open, so the archive index is only read once per process. Compressed tar archives can
+only be read forward, so their members are fastest to read in archive order, which is the order they are listed in.
+"""
+import os
+import gzip
+import time
+import tarfile
+import zipfile
+from cStringIO import StringIO
+
+ARCHIVE_SUFFIXES = ('.zip', '.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2')
+GZIP_SUFFIX = '.gz'
+
+# The open archives of this process by archive path. Forked processes must not share the file offsets of the archives
+# of their parent, so the archives are opened again in each process.
+_archives = {}
+
+
+def is_archive(path):
+    return path.lower().endswith(ARCHIVE_SUFFIXES) and os.path.isfile(path)
+
+
+def list_files(source):
+    """
+    Lists the files of a directory or the members of an archive
+    :param source: The directory or archive path
+    :return: The file names, relative to the source. Archive member names include their directories.
+    """
+    if is_archive(source):
+        return _open_archive(source).names()
+    return os.listdir(source)
+
+
+def open_file(path):
+    """
+    Opens a file for reading. Files with the .gz suffix are decompressed.
+    :param path: The file path, or the archive path joined with the member name
+    :return: A file object
+    """
+    archive_path, member = _split_archive(path)
+    if archive_path is None:
+        return gzip.open(path, 'rb') if path.endswith(GZIP_SUFFIX) else open(path, 'rb')
+
+    f = _open_archive(archive_path).open(member)
+    if member.endswith(GZIP_SUFFIX):
+        # archive members can not be seeked, which gzip needs
+        return gzip.GzipFile(fileobj=StringIO(f.read()), mode='rb')
+    return f
+
+
+def stat(path):
+    """
+    Gets the size and modification time of a file
+    :param path: The file path, or the archive path joined with the member name
+    :return: A tuple of the size in bytes and the modification time
+    """
+    archive_path, member = _split_archive(path)
+    if archive_path is None:
+        file_stat = os.stat(path)
+        return file_stat.st_size, file_stat.st_mtime
+    return _open_archive(archive_path).stat(member)
+
+
+def _split_archive(path):
+    """
+    Splits a path into the archive path and the member name
+    :param path: The path
+    :return: A tuple of the archive path and member name, or None and the path if it is not in an archive
+    """
+    if os.path.exists(path):
+        return None, path
+
+    archive_path, member = path, ''
+    while True:
+        archive_path, name = os.path.split(archive_path)
+        if name == '':
+            return None, path
+        member = name if member == '' else name + '/' + member
+        if is_archive(archive_path):
+            return archive_path, member
+
+
+def _open_archive(archive_path):
+    """
+    Gets the open archive of this process. The archive is opened again if it changed since it was opened.
+    :param archive_path: The archive path
+    :return: The archive
+    """
+    archive_stat = os.stat(archive_path)
+    key = (os.getpid(), archive_stat.st_size, archive_stat.st_mtime)
+    cached = _archives.get(archive_path)
+    if cached is None or cached[0] != key:
+        if cached is not None and cached[0][0] == os.getpid():
+            cached[1].close()
+        archive = _ZipArchive(archive_path) if zipfile.is_zipfile(archive_path) else _TarArchive(archive_path)
+        cached = (key, archive)
+        _archives[archive_path] = cached
+
+    return cached[1]
+
+
+class _ZipArchive:
+
+    def __init__(self, archive_path):
+        self.__zip = zipfile.ZipFile(archive_path)
+
+    def names(self):
+        return [info.filename for info in self.__zip.infolist() if not info.filename.endswith('/')]
+
+    def open(self, member):
+        return self.__zip.open(member)
+
+    def stat(self, member):
+        info = self.__zip.getinfo(member)
+        return info.file_size, time.mktime(info.date_time + (0, 0, -1))
+
+    def close(self):
+        self.__zip.close()
+
+
+class _TarArchive:
+
+    def __init__(self, archive_path):
+        self.__tar = tarfile.open(archive_path)
+
+    def names(self):
+        return [info.name for info in self.__tar.getmembers() if info.isfile()]
+
+    def open(self, member):
+        f = self.__tar.extractfile(member)
+        if f is None:
+            raise IOError('"{}" is not a file'.format(member))
+        return f
+
+    def stat(self, member):
+        info = self.__tar.getmember(member)
+        return info.size, float(info.mtime)
+
+    def close(self):
+        self.__tar.close()
@@ -0,0 +1,291 @@
+import numpy as np
+import pandas as pd
+
+# Number of set bits for every byte value
+POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+# Selects the low bit of every 2 bit genotype call in a 64 bit word
+LOW_BITS = np.uint64(0x5555555555555555)
+
+MISSING = 3
+CALLS_PER_WORD = 32
+
+# The number of SNPs packed at once, which bounds the unpacked copies made while packing
+PACK_ROWS = 4096
+
+# The mutation percentage columns of the preprocessed files: full, no and partial mutations
+PCT_COLUMNS = ['pct_fm', 'pct_nm', 'pct_pm']
+
+
+class PackedGenotypes:
+    """
+    A matrix of genotype calls where each row is a SNP and each column is a user. Each call is the number of mutations
+    the user has for the SNP (0, 1 or 2) or missing, stored in 2 bits so one byte holds four calls. Rows are padded to
+    whole 64 bit words with missing calls so that the per SNP statistics can be computed with bitwise operations and
+    popcounts over whole words.
+    """
+
+    def __init__(self, words, n_users):
+        """
+        Creates a packed genotype matrix
+        :param words: The packed calls as a little-endian uint64 array with shape (SNPs, words per SNP)
+        :param n_users: The number of users (columns)
+        """
+        self.words = words
+        self.n_users = n_users
+
+    @staticmethod
+    def from_array(values):
+        """
+        Packs a genotype matrix. The SNPs are packed in chunks of PACK_ROWS, so only the codes of one chunk are held
+        besides the matrix.
+        :param values: An array with shape (SNPs, users). Values other than 0, 1 and 2 (i.e. NaN) are missing calls.
+        :return: The packed genotype matrix
+        """
+        values = np.asarray(values)
+        n_snps, n_users = values.shape
+        n_words = -(-n_users // CALLS_PER_WORD)
+
+        words = np.empty((n_snps, n_words), dtype='<u8')
+        for start in range(0, n_snps, PACK_ROWS):
+            words[start:start + PACK_ROWS] = PackedGenotypes.__pack(values[start:start + PACK_ROWS], n_words)
+
+        return PackedGenotypes(words, n_users)
+
+    @staticmethod
+    def from_frame(frame, columns):
+        """
+        Packs the genotypes of some columns of a data frame. The rows are selected in chunks of PACK_ROWS, so the
+        columns are never copied at once.
+        :param frame: The data frame with a row for each SNP
+        :param columns: The columns with the genotypes of each user
+        :return: The packed genotype matrix
+        """
+        positions = frame.columns.get_indexer(list(columns))
+        n_words = -(-len(positions) // CALLS_PER_WORD)
+
+        words = np.empty((len(frame), n_words), dtype='<u8')
+        for start in range(0, len(frame), PACK_ROWS):
+            words[start:start + PACK_ROWS] = PackedGenotypes.__pack(
+                frame.iloc[start:start + PACK_ROWS, positions].values, n_words)
+
+        return PackedGenotypes(words, len(positions))
+
+    @staticmethod
+    def __pack(values, n_words):
+        """
+        Packs the calls of some SNPs
+        :param values: An array with shape (SNPs, users)
+        :param n_words: The number of words of each SNP
+        :return: The packed words with shape (SNPs, n_words)
+        """
+        n_snps, n_users = values.shape
+        codes = np.full((n_snps, n_words * CALLS_PER_WORD), MISSING, dtype=np.uint8)
+        for mutations in range(3):
+            codes[:, :n_users][values == mutations] = mutations
+
+        # four calls per byte, the first call in the lowest bits
+        codes = codes.reshape(n_snps, -1, 4)
+        packed = codes[:, :, 0] | (codes[:, :, 1] << 2) | (codes[:, :, 2] << 4) | (codes[:, :, 3] << 6)
+        return np.ascontiguousarray(packed).view('<u8')
+
+    @staticmethod
+    def concat(matrices, n_users):
+        """
+        Concatenates the SNPs of packed genotype matrices of the same users
+        :param matrices: The packed genotype matrices
+        :param n_users: The number of users, used if there are no matrices
+        :return: The packed genotype matrix
+        """
+        if len(matrices) == 0:
+            return PackedGenotypes(np.empty((0, -(-n_users // CALLS_PER_WORD)), dtype='<u8'), n_users)
+
+        return PackedGenotypes(np.vstack([matrix.words for matrix in matrices]), n_users)
+
+    @property
+    def n_snps(self):
+        return self.words.shape[0]
+
+    @property
+    def nbytes(self):
+        return self.words.nbytes
+
+    def take(self, snps):
+        """
+        Selects SNPs
+        :param snps: The positions or a boolean mask of the SNPs
+        :return: The packed genotype matrix of the selected SNPs
+        """
+        return PackedGenotypes(self.words[snps], self.n_users)
+
+    def to_array(self):
+        """
+        Unpacks the genotype matrix
+        :return: A float array with shape (SNPs, users) where missing calls are NaN
+        """
+        packed = self.words.view(np.uint8)
+        codes = np.empty((self.n_snps, packed.shape[1], 4), dtype=np.uint8)
+        for i in range(4):
+            codes[:, :, i] = (packed >> (2 * i)) & 3
+
+        values = codes.reshape(self.n_snps, -1)[:, :self.n_users].astype(np.float64)
+        values[values == MISSING] = np.nan
+        return values
+
+    def __call_masks(self):
+        """
+        Creates a bit mask for each call value. Each mask has the low bit of a 2 bit call set if the call has the value.
+        :return: A list of masks for 0, 1, 2 and missing calls
+        """
+        low = self.words & LOW_BITS
+        high = (self.words >> np.uint64(1)) & LOW_BITS
+        return [
+            ~(low | high) & LOW_BITS,
+            low & ~high,
+            high & ~low,
+            low & high
+        ]
+
+    def snp_counts(self):
+        """
+        Counts the calls of each SNP
+        :return: An int array with shape (SNPs, 4) with the number of 0, 1, 2 and missing calls for each SNP
+        """
+        padding = self.words.shape[1] * CALLS_PER_WORD - self.n_users
+        counts = np.empty((self.n_snps, 4), dtype=np.int64)
+        for i, mask in enumerate(self.__call_masks()):
+            counts[:, i] = POPCOUNT[mask.view(np.uint8)].sum(axis=1, dtype=np.int64)
+
+        counts[:, MISSING] -= padding
+        return counts
+
+    def snp_missing(self):
+        """
+        Counts the missing calls of each SNP
+        :return: An int array with the number of missing calls for each SNP
+        """
+        return self.snp_counts()[:, MISSING]
+
+    def user_missing(self):
+        """
+        Counts the missing calls of each user
+        :return: An int array with the number of missing calls for each user
+        """
+        missing = self.__call_masks()[MISSING]
+        counts = np.empty((missing.shape[1], CALLS_PER_WORD), dtype=np.int64)
+        for i in range(CALLS_PER_WORD):
+            counts[:, i] = ((missing >> np.uint64(2 * i)) & np.uint64(1)).sum(axis=0, dtype=np.int64)
+
+        return counts.ravel()[:self.n_users]
+
+
+def calc_snp_percents(user_mutations, user_columns):
+    """
+    Calculates the percentage of users with no, partial and full mutations for each SNP and adds them as the mutation
+    percentage columns
+    :param user_mutations: The data frame with a row for each SNP and a column with the mutations of each user
+    :param user_columns: The user columns of the data frame
+    :return: The data frame with the mutation percentage columns
+    """
+    # count number of mutations for each SNP using the bit-packed genotypes of the users
+    genotypes = PackedGenotypes.from_frame(user_mutations, user_columns)
+    return add_snp_percents(user_mutations, genotypes.snp_counts()[:, :3])
+
+
+def add_snp_percents(user_mutations, counts):
+    """
+    Adds the mutation percentage columns from the mutation counts of each SNP
+    :param user_mutations: The data frame with a row for each SNP
+    :param counts: An array with the number of users with no, partial and full mutations for each SNP
+    :return: The data frame with the mutation percentage columns
+    """
+    counts = counts.astype(np.float64)
+
+    # calculate the percents of each mutation
+    total = counts.sum(axis=1)[:, np.newaxis]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        pcts = np.where(counts == 0, 0, counts / total * 100)
+
+    user_mutations[PCT_COLUMNS[0]] = pcts[:, 2]
+    user_mutations[PCT_COLUMNS[1]] = pcts[:, 0]
+    user_mutations[PCT_COLUMNS[2]] = pcts[:, 1]
+
+    return user_mutations
+
+
+class PackedPhenotype:
+    """
+    The preprocessed data of a phenotype with the user genotypes bit-packed, which is a small fraction of the memory of
+    the preprocessed data frame. The SNP data frame is indexed by RSID and has the Gene_info and mutation percentage
+    columns, and the genotypes have a row for each of its SNPs and a column for each user.
+    """
+
+    def __init__(self, snps, users, genotypes):
+        """
+        Creates a packed phenotype
+        :param snps: The SNP data frame
+        :param users: The user ids, as strings
+        :param genotypes: The packed genotypes
+        """
+        self.snps = snps
+        self.users = users
+        self.genotypes = genotypes
+
+    @staticmethod
+    def from_frame(frame):
+        """
+        Packs a preprocessed data frame
+        :param frame: The preprocessed data frame indexed by RSID, with the Gene_info and mutation percentage columns
+                      and a column with the mutations of each user
+        :return: The packed phenotype
+        """
+        users = [column for column in frame.columns if column not in ['Gene_info'] + PCT_COLUMNS]
+        return PackedPhenotype(frame[['Gene_info'] + PCT_COLUMNS].copy(), [str(user) for user in users],
+                               PackedGenotypes.from_frame(frame, users))
+
+    @staticmethod
+    def read_csv(file_path, users=None):
+        """
+        Reads a preprocessed file or a genotype matrix in chunks of PACK_ROWS SNPs, so the unpacked genotypes of only
+        one chunk are held. The mutation percentages are calculated if the file does not have them.
+        :param file_path: The gzip compressed CSV file with the Rsid and Gene_info columns and a column with the
+                          mutations of each user
+        :param users: The user columns to read. If None all users are read.
+        :return: The packed phenotype
+        """
+        columns = None if users is None else ['Rsid', 'Gene_info'] + list(users)
+        header = pd.read_csv(file_path, compression='gzip', usecols=columns, nrows=0, index_col='Rsid')
+        user_columns = [column for column in header.columns if column not in ['Gene_info'] + PCT_COLUMNS]
+
+        snps, genotypes = [], []
+        for chunk in pd.read_csv(file_path, compression='gzip', usecols=columns, chunksize=PACK_ROWS,
+                                 index_col='Rsid'):
+            genotypes.append(PackedGenotypes.from_frame(chunk, user_columns))
+            if all(column in chunk.columns for column in PCT_COLUMNS):
+                snps.append(chunk[['Gene_info'] + PCT_COLUMNS])
+            else:
+                snps.append(add_snp_percents(chunk[['Gene_info']].copy(), genotypes[-1].snp_counts()[:, :3]))
+
+        if len(snps) == 0:
+            snps.append(header.reindex(columns=['Gene_info'] + PCT_COLUMNS))
+        return PackedPhenotype(pd.concat(snps), user_columns, PackedGenotypes.concat(genotypes, len(user_columns)))
+
+    @property
+    def nbytes(self):
+        return self.snps.memory_usage(index=True, deep=True).sum() + self.genotypes.nbytes
+
+    def drop_snps(self, drop):
+        """
+        Removes SNPs
+        :param drop: A boolean mask of the SNPs to remove
+        """
+        self.snps = self.snps[~drop]
+        self.genotypes = self.genotypes.take(~drop)
+
+    def user_mutations(self, rsids):
+        """
+        Unpacks the mutations of the users for some SNPs
+        :param rsids: The RSIDs of the SNPs
+        :return: A float array with shape (SNPs, users) where missing calls are NaN
+        """
+        return self.genotypes.take(self.snps.index.get_indexer(rsids)).to_array()
@@ -3,8 +3,10 @@ import numpy as np
 import re
 import os
 from math import isnan
+from collections import OrderedDict
 from os import listdir
 from os.path import isfile, join
+import bgzf
 
 import logging
 logger = logging.getLogger('root')
@@ -19,14 +21,17 @@ POS_COLUMN = 'Pos'
 QUAL_COLUMN = 'Qual'
 FILTER_COLUMN = 'Filter'
 
+# The columns of the SNP database. The chromosome and position are last so the database can be split into shards.
+SNP_COLUMNS = [RSID_COLUMN, REF_COLUMN, ALT_COLUMN, GENEINFO_COLUMN, CHROM_COLUMN, POS_COLUMN]
 
-def build_database(snp_data_dir, output_dir):
+
+def build_database(snp_data_dir, output_dir=None):
     """
     Builds a data frame containing data for all SNPs from individual SNP files.
     :param snp_data_dir: The directory containing the individual SNP files.
     The files must be in VCF format and can optionally be compressed using gzip. Files must either end in .gz or .vcf.
-    :param output_dir: The directory to save the processed SNPs in
-    :return: A data frame containing all SNP data. The data frame includes columns Rsid,Ref,Alt,Gene_info.
+    :param output_dir: The directory to save the processed SNPs in. If None the SNPs are not saved.
+    :return: A data frame containing all SNP data. The data frame includes columns Rsid,Ref,Alt,Gene_info,Chrom,Pos.
     """
     # Combine all SNP files into one data frame
     snp_details = __combine_snp_data(snp_data_dir)
@@ -37,21 +42,42 @@ def build_database(snp_data_dir, output_dir):
     # Remove all SNPs with missing gene info
     snp_details.dropna(subset=[GENEINFO_COLUMN], inplace=True)
 
-    # Save the snp data frame. It is needed in the prediction step.
-    snp_details.to_csv(os.path.join(output_dir, 'snp_database.csv.gz'), compression='gzip', index=False)
+    # Save the snp data frame. It is needed in the prediction step, which only reads the rows of the model SNPs.
+    if output_dir is not None:
+        bgzf.write_csv(snp_details, os.path.join(output_dir, 'snp_database.csv.gz'))
 
     return snp_details
 
 
+def split_shards(snp_details, shard_size=None):
+    """
+    Splits the SNP database into independent shards by chromosome and optionally by position range.
+    :param snp_details: The SNP database
+    :param shard_size: The number of base pairs in each position range. If None each chromosome is one shard.
+    :return: An ordered dictionary where the key is the shard id (i.e. chr7 or chr7_25000000 for the position range
+    starting at 25000000) and the value is the SNP details of the shard. Shards are in the order of the database.
+    """
+    keys = 'chr' + snp_details[CHROM_COLUMN].astype(str)
+    if shard_size is not None:
+        starts = (snp_details[POS_COLUMN].astype(np.int64) // shard_size) * shard_size
+        keys = keys + '_' + starts.astype(str)
+
+    shards = OrderedDict()
+    for shard_id in keys.unique():
+        shards[shard_id] = snp_details[(keys == shard_id).values]
+
+    return shards
+
+
 def __combine_snp_data(snp_data_dir):
     """
     Combines SNP files into a data frame.
-    Columns 'Chrom', 'Pos', 'Qual', 'Filter' are dropped from the SNP files.
+    Columns 'Qual', 'Filter' are dropped from the SNP files.
     :param snp_data_dir: The directory containing the individual SNP files.
     The files must be in VCF format and can optionally be compressed using gzip. Files must either end in .gz or .vcf.
-    :return: A data frame containing all SNP data. The data frame includes columns Rsid,Ref,Alt,Gene_info.
+    :return: A data frame containing all SNP data. The data frame includes columns Rsid,Ref,Alt,Gene_info,Chrom,Pos.
     """
-    snp_details = pd.DataFrame(columns=[RSID_COLUMN, REF_COLUMN, ALT_COLUMN, GENEINFO_COLUMN])
+    snp_details = pd.DataFrame(columns=SNP_COLUMNS)
 
     snp_file_names = [f for f in listdir(snp_data_dir) if isfile(join(snp_data_dir, f))]
     for snp_file in snp_file_names:
@@ -60,18 +86,18 @@ def __combine_snp_data(snp_data_dir):
             if '.gz' in snp_file:
                 data = pd.read_csv(snp_file_path, compression="gzip", skiprows=12, sep='\t',
                                    names=[CHROM_COLUMN, POS_COLUMN, RSID_COLUMN, REF_COLUMN, ALT_COLUMN, QUAL_COLUMN,
-                                          FILTER_COLUMN, GENEINFO_COLUMN])
+                                          FILTER_COLUMN, GENEINFO_COLUMN], dtype={CHROM_COLUMN: str})
             else:
                 data = pd.read_csv(snp_file_path, skiprows=12, sep='\t',
                                    names=[CHROM_COLUMN, POS_COLUMN, RSID_COLUMN, REF_COLUMN, ALT_COLUMN, QUAL_COLUMN,
-                                          FILTER_COLUMN, GENEINFO_COLUMN])
+                                          FILTER_COLUMN, GENEINFO_COLUMN], dtype={CHROM_COLUMN: str})
 
         except Exception as e:
             logger.warning('"{}" VCF file invalid. Skipping it. Reason: {}'.format(snp_file_path, e))
             continue
 
         # Remove columns that are not needed
-        data = data.drop([CHROM_COLUMN, POS_COLUMN, QUAL_COLUMN, FILTER_COLUMN], 1)
+        data = data[SNP_COLUMNS]
 
         # Extract relevant gene info
         data[GENEINFO_COLUMN] = data[GENEINFO_COLUMN].apply(__extract_gene_info)
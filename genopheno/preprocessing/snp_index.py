@@ -0,0 +1,96 @@
+import numpy as np
+
+from encoding import ALLELES, encode_rsids
+
+
+class SnpIndex:
+    """
+    A join index of the SNP database, built once and used to look up the SNPs of every user. The integer RSIDs are
+    sorted and the reference and alternative alleles are encoded in arrays aligned with them, so a user is joined with
+    a binary search of each of the user RSIDs and the mutations are counted with array operations. The cost of a user
+    only depends on the number of SNPs of the user.
+
+    Only dbSNP accession numbers (rs<number>) are indexed, like in the genome cache.
+    """
+
+    def __init__(self, snp_details):
+        """
+        Builds the index
+        :param snp_details: The SNP database, with the Rsid, Ref and Alt columns
+        """
+        rsids, valid = encode_rsids(snp_details['Rsid'].values)
+        order = np.argsort(rsids, kind='mergesort')
+        self.n_snps = len(snp_details)
+        self.rsids = rsids[order]
+        # the row of each indexed SNP in the SNP database
+        self.rows = np.flatnonzero(valid)[order]
+        self.refs = _encode_refs(snp_details['Ref'].values)[self.rows]
+        self.alts, self.alts_valid = _encode_alts(snp_details['Alt'].values)
+        self.alts = self.alts[self.rows]
+        self.alts_valid = self.alts_valid[self.rows]
+
+    def join(self, rsids):
+        """
+        Finds the SNPs of the database in a list of RSIDs
+        :param rsids: The encoded RSIDs
+        :return: A tuple of the positions of the RSIDs that are in the database and their positions in the index
+        """
+        positions = np.searchsorted(self.rsids, rsids)
+        found = positions < len(self.rsids)
+        found[found] = self.rsids[positions[found]] == rsids[found]
+        return np.flatnonzero(found), positions[found]
+
+    def mutations(self, rsids, genotypes):
+        """
+        Counts the mutations of a user for every SNP of the database. A SNP is invalid (NaN) if the genotype does not
+        have two alleles or if an allele is neither the reference nor one of the alternative alleles. Otherwise the
+        count is the number of alleles that are not the reference allele.
+        :param rsids: The encoded RSIDs of the user, without duplicates
+        :param genotypes: The encoded genotypes of the user
+        :return: A tuple of an array with the number of mutations of each SNP in database order, which is NaN for
+        the SNPs the user does not have, and the number of user SNPs in the database
+        """
+        user_positions, index_positions = self.join(rsids)
+        genotypes = np.asarray(genotypes, dtype=np.uint8)[user_positions]
+        first = (genotypes >> 4).astype(np.int64)
+        second = (genotypes & 15).astype(np.int64)
+        refs = self.refs[index_positions]
+        alts = self.alts[index_positions]
+
+        valid = (first > 0) & (first < len(ALLELES)) & (second > 0) & (second < len(ALLELES)) & \
+            self.alts_valid[index_positions]
+        for allele in [first, second]:
+            valid &= (allele == refs) | ((alts >> allele) & 1).astype(bool)
+
+        counts = (first != refs).astype(np.float64) + (second != refs)
+        counts[~valid] = np.nan
+
+        mutations = np.full(self.n_snps, np.nan)
+        mutations[self.rows[index_positions]] = counts
+        return mutations, len(index_positions)
+
+
+def _encode_refs(refs):
+    """
+    Encodes the reference alleles. References that are not a single allele never match a genotype allele, so they are
+    encoded as 0.
+    :param refs: The reference alleles
+    :return: An array of allele codes
+    """
+    codes = dict((allele, code) for code, allele in enumerate(ALLELES) if allele != '')
+    return np.array([codes.get(ref, 0) if isinstance(ref, basestring) else 0 for ref in refs], dtype=np.int64)
+
+
+def _encode_alts(alts):
+    """
+    Encodes the alternative alleles as a bit mask of the allele codes of each character. Each character of the
+    alternative allele string can match a genotype allele.
+    :param alts: The alternative allele strings
+    :return: A tuple of the bit masks and a boolean array of the SNPs with an alternative allele string
+    """
+    masks = {}
+    for alt in set(alt for alt in alts if isinstance(alt, basestring)):
+        masks[alt] = sum(1 << code for code, allele in enumerate(ALLELES) if allele != '' and allele in alt)
+
+    valid = np.array([isinstance(alt, basestring) for alt in alts], dtype=bool)
+    return np.array([masks[alt] if is_valid else 0 for alt, is_valid in zip(alts, valid)], dtype=np.int64), valid
@@ -1,9 +1,13 @@
 import os
 import re
+from contextlib import closing
 
 import numpy as np
 import pandas as pd
 
+from encoding import encode_rsids, encode_genotypes
+import genome_sources
+
 import logging
 logger = logging.getLogger('root')
 
@@ -15,20 +19,23 @@ class UserPhenotypes:
     Represents a collection of users with known phenotypes
     """
 
-    def __init__(self, known_pheno_file, user_data_dir):
+    def __init__(self, known_pheno_file, user_data_dir, genome_cache=None):
         """
         Creates a new UserPhenos object
         :param known_pheno_file: The file path containing the known use phenotype classifications
         :param user_data_dir: A dictionary where the key is the phenotype classification value and the
         value is a list of users
+        :param genome_cache: The optional cache of parsed user genomic files
         """
-        self.__phenotypes = self.__map_phenotypes(known_pheno_file, user_data_dir)
+        self.__users = []
+        self.__phenotypes = self.__map_phenotypes(known_pheno_file, user_data_dir, genome_cache)
 
-    def __map_phenotypes(self, known_pheno_file, user_data_dir):
+    def __map_phenotypes(self, known_pheno_file, user_data_dir, genome_cache):
         """
         Maps each user data file to a phenotype classification
         :param known_pheno_file: The file path containing the known use phenotype classifications
         :param user_data_dir: The directory path containing all user data files
+        :param genome_cache: The optional cache of parsed user genomic files
         :return: A dictionary where the key is the phenotype classification value and the value is a list of users
         with the phenotype.
         """
@@ -38,16 +45,20 @@ class UserPhenotypes:
         users = []
         duplicates = []
         multi_pheno = []
+        cohort_ids = set()
 
         for user_file_name in self.get_user_geno_files(user_data_dir):
             # OpenSNP sometimes contains two genomic files for the same user Id. This is used to avoid duplicate
             # information for a user. The first file for the user is used.
-            user = User(user_data_dir, user_file_name)
+            user = User(user_data_dir, user_file_name, genome_cache)
             if user.id in users:
                 logger.warning('User {} already is associated with a genomic file. Ignoring file "{}"' \
                                .format(user.id, user.file_path))
                 duplicates.append(user.id)
                 continue
+            if user.id not in cohort_ids:
+                cohort_ids.add(user.id)
+                self.__users.append(user)
 
             # Get the phenotype classification for the user
             phenotype_row = \
@@ -90,18 +101,34 @@ class UserPhenotypes:
     def get_user_geno_files(user_data_dir):
         """
         Gets the list of user files. Each file contains the genetic information of one user. 23andMe and Ancestry.com
-        data formats are supported.
+        data formats are supported. The files can be gzip compressed and they can be in a zip or tar archive, like the
+        openSNP data dump, instead of a directory.
 
-        File names must start with the user id followed by an underscore and end with either 23andme.txt or ancestry.txt.
+        File names must start with the user id followed by an underscore and end with either 23andme.txt or ancestry.txt,
+        optionally followed by .gz. The names of archive members are matched without their directories.
         Examples:
         user44_file19_yearofbirth_1970_sex_XY.23andme.txt
-        user44_file19_yearofbirth_1970_sex_XY.ancestry.txt
-        :param user_data_dir: The directory containing the user files.
-        :return: The list of user files in the directory.
+        user44_file19_yearofbirth_1970_sex_XY.ancestry.txt.gz
+        :param user_data_dir: The directory or archive containing the user files.
+        :return: The list of user files in the directory or archive.
+        """
+        file_name_regex = re.compile("^user[0-9]+_.*(23andme|ancestry).txt(\\.gz)?$")
+        files = genome_sources.list_files(user_data_dir)
+        return [f for f in files if file_name_regex.match(os.path.basename(f))]
+
+    def get_users(self):
+        """
+        Gets all users with a genomic file, with or without a known phenotype
+        :return: The list of users in the order of the user files
+        """
+        return list(self.__users)
+
+    def get_phenotypes(self):
         """
-        file_name_regex = re.compile("^user[0-9]+_.*(23andme|ancestry).txt$")
-        files = os.listdir(user_data_dir)
-        return filter(file_name_regex.match, files)
+        Gets the users for each known phenotype
+        :return: A dictionary where the key is the phenotype classification value and the value is a list of users
+        """
+        return dict(self.__phenotypes)
 
     def reduce_phenotypes(self, reducer):
         """
@@ -118,14 +145,17 @@ class User:
     Represents a user's genetic information
     """
 
-    def __init__(self, user_data_dir, user_file_name):
+    def __init__(self, user_data_dir, user_file_name, genome_cache=None):
         """
         Creates a user
-        :param user_data_dir: The directory where the user data file is located
-        :param user_file_name: The user data file name
+        :param user_data_dir: The directory or archive where the user data file is located
+        :param user_file_name: The user data file name, or the archive member name
+        :param genome_cache: The optional cache of parsed user genomic files. If set the user file is only parsed if
+        it is not already in the cache.
         """
         self.file_path = os.path.join(user_data_dir, user_file_name)
-        self.__set_id(user_file_name)
+        self.genome_cache = genome_cache
+        self.__set_id(os.path.basename(user_file_name))
 
     def __set_id(self, user_file_name):
         # Extract just the user id from the file name
@@ -136,92 +166,64 @@ class User:
         user_id = int(user_id[len('user')::])
         self.id = user_id
 
-    def __get_data_frame(self, snp_details, how):
+    def __read_genome(self):
         """
-        Gets the user data and joins it with the SNP data. The user data only includes the SNP accession number and not
-        the details. This creates the user data frame and adds the SNP details to it.
-        :param snp_details: The gene_data is used to add the SNP data (i.e. ref and alt) to the user data.
-        The user data includes the accession number (rsid), but not the details for the SNP.
-        :param how: The data frame merge method (i.e. inner)
-        :return: The user data, joined with the SNP data, as a data frame. The data frame has columns Rsid, Genotyoe,
-        Ref, Alt, Gene_info.
+        Parses the user genomic file
+        :return: A data frame with columns Rsid and Genotype
         """
-        try:
-            if self.file_path.endswith("23andme.txt"):
-                data_person = pd.read_table(self.file_path, header=None, comment="#", low_memory=False,
+        file_name = self.file_path[:-len(genome_sources.GZIP_SUFFIX)] \
+            if self.file_path.endswith(genome_sources.GZIP_SUFFIX) else self.file_path
+        if file_name.endswith("23andme.txt"):
+            with closing(genome_sources.open_file(self.file_path)) as f:
+                data_person = pd.read_table(f, header=None, comment="#", low_memory=False,
                                             error_bad_lines=False, delim_whitespace=True, warn_bad_lines=False)
-                data_person.columns = ["Rsid", "chromosome", "position", "genotype"]
-                data_person.drop(["chromosome", "position"], axis=1, inplace=True)
-            elif self.file_path.endswith("ancestry.txt"):
-                data_person = pd.read_table(self.file_path, header=0, comment="#", low_memory=False,
+            data_person.columns = ["Rsid", "chromosome", "position", "genotype"]
+            data_person.drop(["chromosome", "position"], axis=1, inplace=True)
+        elif file_name.endswith("ancestry.txt"):
+            with closing(genome_sources.open_file(self.file_path)) as f:
+                data_person = pd.read_table(f, header=0, comment="#", low_memory=False,
                                             error_bad_lines=False, delim_whitespace=True, warn_bad_lines=False)
-                data_person.columns = ["Rsid", "chromosome", "position", "allele1", "allele2"]
-                data_person["genotype"] = data_person["allele1"] + data_person["allele2"]
-                data_person = data_person.loc[data_person["Rsid"].isin(list(snp_details["Rsid"]))]
-                data_person.drop(["chromosome", "position", "allele2", "allele1"], axis=1, inplace=True)
-            else:
-                raise ValueError('Only 23andMe and Ancestry.com data formats are supported')
-        except Exception as e:
-            logger.warning('{} does not contain valid user genomic data. Skipping user. ' \
-                           'Reason: {}'.format(self.file_path, e))
-            return pd.DataFrame()
+            data_person.columns = ["Rsid", "chromosome", "position", "allele1", "allele2"]
+            data_person["genotype"] = data_person["allele1"] + data_person["allele2"]
+            data_person.drop(["chromosome", "position", "allele2", "allele1"], axis=1, inplace=True)
+        else:
+            raise ValueError('Only 23andMe and Ancestry.com data formats are supported')
 
         data_person.columns = ['Rsid', 'Genotype']
+        return data_person
 
-        # drop public RSIDs. It was found that some genomic files from OpenSNP have duplicate RSID values
-        duplicates = data_person[data_person.duplicated(subset=['Rsid'])].values
-        if len(duplicates) > 0:
-            logger.warning('User {} has duplicate RSID values. The duplicates will be removed.{}{}'\
-                           .format(os.linesep, self.id, duplicates))
-            data_person.drop_duplicates(subset=['Rsid'], inplace=True)
-
-        data = pd.merge(data_person, snp_details[['Rsid', 'Ref', 'Alt']], how=how, on=["Rsid"], right_index=True)
-
-        return data
-
-    def allele_transformation(self, snp_details, how='inner'):
+    def __read_encoded_genome(self):
         """
-        Gets the user genetic data and counts the number of mutations for each gene.
-        :param snp_details: The data frame containing the SNP data
-        :param how: The data frame merge method (i.e. inner)
-        :return: The data frame containing the users genetic data. The data frame has columns Rsid, Gene_info and
-        <user_id>_snp_<phenotype> where <user_id>_snp_<phenotype> is the number of mutations the user has for the gene.
+        Gets the encoded user genomic data, from the genome cache if there is one
+        :return: A tuple of the encoded RSIDs and genotypes. RSIDs that are not dbSNP accession numbers are removed.
         """
-        data = self.__get_data_frame(snp_details, how)
-        if not data.empty:
-            # count the number of mutations for each user SNP
-            data[self.id] = data.apply(self.__count_mutations, axis=1)
-
-            # once mutations are counted the genotype, ref and alt columns are no longer needed
-            data.drop(['Genotype', 'Ref', 'Alt'], axis=1, inplace=True)
+        if self.genome_cache is not None:
+            return self.genome_cache.get(self.file_path, self.__read_genome)
 
-        return data
+        data_person = self.__read_genome()
+        rsids, valid = encode_rsids(data_person['Rsid'])
+        return rsids, encode_genotypes(data_person['Genotype'].values[valid])
 
-    def __count_mutations(self, row):
+    def mutations(self, snp_index):
         """
-        Counts the number of mutations the the user has for each SNP.
-        :param row: A data frame row with columns Genotype, Ref and Alt
-        :return: The number of mutations the user has for the SNP
+        Gets the user genetic data and counts the number of mutations for each SNP of the SNP database.
+        :param snp_index: The join index of the SNP database
+        :return: A tuple of an array with the number of mutations the user has for each SNP, in SNP database order,
+        and the number of user SNPs in the SNP database. The array is None if the user file is not valid. SNPs the user
+        does not have and invalid genotypes are NaN.
         """
         try:
-            genotype = list(row['Genotype'])
-            ref = row['Ref']
-            alt = list(row['Alt'])
-
-            if len(genotype) != 2:
-                return np.nan
-
-            for nucleotide in genotype:
-                if nucleotide != ref and nucleotide not in alt:
-                    return np.nan
+            rsids, genotypes = self.__read_encoded_genome()
+        except Exception as e:
+            logger.warning('{} does not contain valid user genomic data. Skipping user. ' \
+                           'Reason: {}'.format(self.file_path, e))
+            return None, 0
 
-            changes = 0
-            for nucleotide in genotype:
-                if nucleotide != ref:
-                    changes += 1
+        # drop duplicate RSID values. It was found that some genomic files from OpenSNP have duplicate RSID values.
+        # The first genotype of each RSID is used.
+        unique_rsids, first = np.unique(rsids, return_index=True)
+        if len(unique_rsids) < len(rsids):
+            logger.warning('User {} has {} duplicate RSID values. The duplicates will be removed.'
+                           .format(self.id, len(rsids) - len(unique_rsids)))
 
-            return changes
-        except Exception as e:
-            logger.warning('Invalid SNP for user {}. Marking invalid.{}Row: {}.' \
-                           '{}Reason: {}'.format(self.id, os.linesep, row, os.linesep, e))
-            return np.nan
+        return snp_index.mutations(unique_rsids, np.asarray(genotypes)[first])
@@ -0,0 +1,192 @@
+import os
+import json
+import shutil
+import tempfile
+
+import logging
+logger = logging.getLogger('root')
+
+
+class WorkQueue:
+    """
+    A task queue in a directory on a shared filesystem. It lets processes on several machines share work without a
+    scheduler service.
+
+    A coordinator adds the task descriptors and then closes the queue. Workers claim tasks by creating a lock file for
+    the task with O_CREAT | O_EXCL, which is atomic on local filesystems and NFS version 3 and later, so each task is
+    claimed by exactly one worker. A worker writes the task result and then marks the task as done or failed.
+
+    Claims of tasks that did not finish (i.e. the worker was killed) are only released by requeue, which must not be
+    called while workers are running.
+    """
+
+    def __init__(self, queue_dir):
+        """
+        Opens the queue, creating the queue directory if it does not exist
+        :param queue_dir: The queue directory
+        """
+        self.queue_dir = queue_dir
+        self.__dirs = dict((name, os.path.join(queue_dir, name))
+                           for name in ['tasks', 'claims', 'done', 'failed', 'results'])
+        for directory in self.__dirs.values():
+            if not os.path.exists(directory):
+                try:
+                    os.makedirs(directory)
+                except OSError:
+                    # another process created it first
+                    if not os.path.isdir(directory):
+                        raise
+
+    def clear(self):
+        """
+        Removes all tasks, claims and results
+        """
+        for directory in self.__dirs.values():
+            shutil.rmtree(directory)
+            os.makedirs(directory)
+        if self.is_closed():
+            os.remove(self.__closed_path())
+
+    def add(self, task_id, task):
+        """
+        Adds a task to the queue
+        :param task_id: The task id. Tasks are claimed in the order of their ids.
+        :param task: The task descriptor. It must be serializable as JSON.
+        """
+        self.__write_atomic(self.__path('tasks', task_id, '.json'), lambda f: json.dump(task, f))
+
+    def close(self):
+        """
+        Marks that all tasks have been added
+        """
+        self.__write_atomic(self.__closed_path(), lambda f: f.write('closed'))
+
+    def is_closed(self):
+        return os.path.exists(self.__closed_path())
+
+    def task_ids(self):
+        """
+        Gets the ids of all tasks
+        :return: The sorted task ids
+        """
+        return sorted(f[:-len('.json')] for f in os.listdir(self.__dirs['tasks']) if f.endswith('.json'))
+
+    def get(self, task_id):
+        """
+        Gets a task descriptor
+        :param task_id: The task id
+        :return: The task descriptor
+        """
+        with open(self.__path('tasks', task_id, '.json')) as f:
+            return json.load(f)
+
+    def claim(self, worker_id):
+        """
+        Claims the first task that is not claimed by another worker
+        :param worker_id: The id of the worker, which is written in the claim
+        :return: A tuple of the task id and descriptor, or None if all tasks are claimed
+        """
+        for task_id in self.task_ids():
+            if self.is_done(task_id):
+                continue
+
+            try:
+                fd = os.open(self.__path('claims', task_id, '.lock'), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except OSError:
+                # claimed by another worker
+                continue
+
+            with os.fdopen(fd, 'w') as f:
+                f.write(worker_id)
+            return task_id, self.get(task_id)
+
+        return None
+
+    def complete(self, task_id):
+        """
+        Marks a claimed task as done
+        :param task_id: The task id
+        """
+        self.__write_atomic(self.__path('done', task_id, ''), lambda f: f.write('done'))
+
+    def fail(self, task_id, error):
+        """
+        Marks a claimed task as failed. The task is not claimed again until it is requeued.
+        :param task_id: The task id
+        :param error: The error message
+        """
+        self.__write_atomic(self.__path('failed', task_id, '.txt'), lambda f: f.write(error))
+
+    def is_done(self, task_id):
+        return os.path.exists(self.__path('done', task_id, ''))
+
+    def failures(self):
+        """
+        Gets the errors of the failed tasks
+        :return: A dictionary where the key is the task id and the value is the error message
+        """
+        errors = {}
+        for f in os.listdir(self.__dirs['failed']):
+            if f.endswith('.txt'):
+                with open(os.path.join(self.__dirs['failed'], f)) as error_file:
+                    errors[f[:-len('.txt')]] = error_file.read()
+
+        return errors
+
+    def requeue(self):
+        """
+        Releases the claims of all tasks that are not done, so they are claimed again by the next workers
+        :return: The ids of the requeued tasks
+        """
+        requeued = []
+        for task_id in self.task_ids():
+            if self.is_done(task_id):
+                continue
+
+            for path in [self.__path('claims', task_id, '.lock'), self.__path('failed', task_id, '.txt')]:
+                if os.path.exists(path):
+                    os.remove(path)
+            requeued.append(task_id)
+
+        return requeued
+
+    def result_path(self, task_id, extension):
+        """
+        Gets the path of the result file of a task
+        :param task_id: The task id
+        :param extension: The result file extension
+        :return: The path
+        """
+        return self.__path('results', task_id, extension)
+
+    def write_result(self, task_id, extension, write):
+        """
+        Writes the result file of a task atomically
+        :param task_id: The task id
+        :param extension: The result file extension
+        :param write: The function that writes the result to an open file
+        """
+        self.__write_atomic(self.result_path(task_id, extension), write)
+
+    def __path(self, name, task_id, extension):
+        return os.path.join(self.__dirs[name], task_id + extension)
+
+    def __closed_path(self):
+        return os.path.join(self.queue_dir, 'closed')
+
+    @staticmethod
+    def __write_atomic(path, write):
+        """
+        Writes a file atomically so other processes never read partial files
+        :param path: The file path
+        :param write: The function that writes the content to an open file
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                write(f)
+            os.rename(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
@@ -0,0 +1,204 @@
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+
+from util import file_hash, clean_output
+
+import logging
+logger = logging.getLogger('root')
+
+# Files that are not stage results. Logs and profiles describe a single run.
+EXCLUDED_PREFIXES = ['profile_']
+EXCLUDED_SUFFIXES = ['.log', '.tmp']
+
+# The hash of the genopheno source code, calculated once
+_code = {'hash': None}
+
+
+class StageCache:
+    """
+    A content-addressed cache of stage outputs. A stage is identified by a fingerprint of its input files, its
+    parameters and the genopheno source code. The outputs of a stage are stored as objects named by the hash of their
+    content, so identical outputs of different runs are only stored once, and a manifest for the fingerprint lists
+    the objects of each output file. When a stage runs again with the same fingerprint its outputs are hard linked
+    into the output directory instead of being computed.
+
+    Output files are hard links to the cache objects, so outputs must never be modified in place. Stages that reuse an
+    existing output directory must call detach_outputs first.
+    """
+
+    def __init__(self, cache_dir):
+        """
+        Opens the cache, creating the cache directory if it does not exist
+        :param cache_dir: The cache directory
+        """
+        self.cache_dir = cache_dir
+        self.__objects_dir = os.path.join(cache_dir, 'objects')
+        self.__stages_dir = os.path.join(cache_dir, 'stages')
+        self.__hashes_dir = os.path.join(cache_dir, 'hashes')
+        for directory in [self.__objects_dir, self.__stages_dir, self.__hashes_dir]:
+            if not os.path.exists(directory):
+                try:
+                    os.makedirs(directory)
+                except OSError:
+                    # another process created it first
+                    if not os.path.isdir(directory):
+                        raise
+
+    def fingerprint(self, stage, params, inputs):
+        """
+        Calculates the fingerprint of a stage
+        :param stage: The stage name
+        :param params: A dictionary of the stage parameters that affect the outputs. The values must be serializable
+        as JSON.
+        :param inputs: The input files and directories of the stage. Directories are included recursively, except
+        for log and profile files.
+        :return: The fingerprint
+        """
+        sha1 = hashlib.sha1()
+        sha1.update(json.dumps({'stage': stage, 'params': params, 'code': _code_hash()}, sort_keys=True))
+        for input_path in inputs:
+            for file_path in _list_files(input_path):
+                sha1.update('{}\0{}\0'.format(os.path.relpath(file_path, input_path), self.__file_hash(file_path)))
+
+        return '{}_{}'.format(stage, sha1.hexdigest())
+
+    def restore(self, fingerprint, output_dir):
+        """
+        Links the outputs of a stage into the output directory if the stage was already run with the same fingerprint
+        :param fingerprint: The stage fingerprint
+        :param output_dir: The stage output directory. It is cleaned if the outputs are restored.
+        :return: True if the outputs were restored, False if the stage must be run
+        """
+        manifest_path = os.path.join(self.__stages_dir, fingerprint + '.json')
+        if not os.path.exists(manifest_path):
+            return False
+
+        with open(manifest_path) as f:
+            outputs = json.load(f)
+        if not all(os.path.exists(self.__object_path(object_hash)) for object_hash in outputs.values()):
+            return False
+
+        clean_output(output_dir)
+        for relative_path, object_hash in outputs.items():
+            output_path = os.path.join(output_dir, relative_path)
+            if not os.path.exists(os.path.dirname(output_path)):
+                os.makedirs(os.path.dirname(output_path))
+            _link_or_copy(self.__object_path(object_hash), output_path)
+
+        return True
+
+    def store(self, fingerprint, output_dir):
+        """
+        Adds the outputs of a stage to the cache
+        :param fingerprint: The stage fingerprint
+        :param output_dir: The stage output directory
+        """
+        outputs = {}
+        for file_path in _list_files(output_dir):
+            object_hash = file_hash(file_path)
+            object_path = self.__object_path(object_hash)
+            if not os.path.exists(object_path):
+                _link_or_copy(file_path, object_path)
+            outputs[os.path.relpath(file_path, output_dir)] = object_hash
+
+        _write_atomic(os.path.join(self.__stages_dir, fingerprint + '.json'), json.dumps(outputs, sort_keys=True))
+
+    def __object_path(self, object_hash):
+        return os.path.join(self.__objects_dir, object_hash)
+
+    def __file_hash(self, file_path):
+        """
+        Hashes the content of an input file. The hash is stored by the file path, size and modification time so
+        unchanged files are only read once.
+        :param file_path: The file path
+        :return: The hex digest of the file content
+        """
+        stat = os.stat(file_path)
+        key = hashlib.sha1('{}|{}|{!r}'.format(os.path.abspath(file_path), stat.st_size, stat.st_mtime)).hexdigest()
+        key_path = os.path.join(self.__hashes_dir, key)
+        if os.path.exists(key_path):
+            with open(key_path) as f:
+                return f.read().strip()
+
+        content_hash = file_hash(file_path)
+        _write_atomic(key_path, content_hash)
+        return content_hash
+
+
+def detach_outputs(output_dir):
+    """
+    Replaces the output files that are hard links to stage cache objects with copies, so they can be modified in place
+    without modifying the cache
+    :param output_dir: The output directory
+    """
+    for file_path in _list_files(output_dir, False):
+        if os.stat(file_path).st_nlink > 1:
+            tmp_path = file_path + '.tmp'
+            shutil.copy2(file_path, tmp_path)
+            os.rename(tmp_path, file_path)
+
+
+def _list_files(path, stage_files_only=True):
+    """
+    Lists the files in a directory recursively
+    :param path: The file or directory path
+    :param stage_files_only: If True log and profile files are excluded
+    :return: The sorted file paths
+    """
+    if os.path.isfile(path):
+        return [path]
+    if not os.path.isdir(path):
+        return []
+
+    files = []
+    for root, dirs, file_names in os.walk(path):
+        dirs.sort()
+        for file_name in sorted(file_names):
+            if stage_files_only and (any(file_name.startswith(prefix) for prefix in EXCLUDED_PREFIXES) or
+                                     any(file_name.endswith(suffix) for suffix in EXCLUDED_SUFFIXES)):
+                continue
+            files.append(os.path.join(root, file_name))
+
+    return files
+
+
+def _code_hash():
+    """
+    Hashes the genopheno source code, so the stages run again after the code changes
+    :return: The hex digest of the source files
+    """
+    if _code['hash'] is None:
+        sha1 = hashlib.sha1()
+        source_dir = os.path.dirname(os.path.abspath(__file__))
+        for root, dirs, file_names in os.walk(source_dir):
+            # only the python packages are walked, not data directories like resources
+            dirs[:] = sorted(d for d in dirs if os.path.exists(os.path.join(root, d, '__init__.py')))
+            for file_name in sorted(f for f in file_names if f.endswith('.py')):
+                file_path = os.path.join(root, file_name)
+                sha1.update('{}\0{}\0'.format(os.path.relpath(file_path, source_dir), file_hash(file_path)))
+        _code['hash'] = sha1.hexdigest()
+
+    return _code['hash']
+
+
+def _link_or_copy(source, target):
+    """
+    Hard links a file, or copies it if the target is on another filesystem
+    """
+    try:
+        os.link(source, target)
+    except OSError:
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(target), suffix='.tmp')
+        os.close(fd)
+        shutil.copy2(source, tmp_path)
+        os.rename(tmp_path, target)
+
+
+def _write_atomic(path, content):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        f.write(content)
+    os.rename(tmp_path, path)
@@ -1,8 +1,26 @@
 import time
 import os
+import re
+import shutil
+import hashlib
+import cProfile
+import pstats
+from collections import OrderedDict
+from multiprocessing.util import Finalize
 import logging
 logger = logging.getLogger('root')
 
+try:
+    import tracemalloc
+except ImportError:
+    # tracemalloc is only available from Python 3.4
+    tracemalloc = None
+
+# Profiling state shared by timed_invoke. Each stage has its own profile, the stack holds the profiles of the stages
+# that are running. Only the innermost stage is profiled at a time, so a stage's profile does not include the stages
+# nested in it.
+__profiler = {'output_dir': None, 'memory': False, 'stack': [], 'profiles': OrderedDict(), 'worker': None}
+
 
 def setup_logger(output_dir, name):
     output_dir = expand_path(output_dir)
@@ -46,6 +64,47 @@ def setup_logger(output_dir, name):
     logger.setLevel(logging.INFO)
 
 
+def setup_profiler(output_dir, enabled, memory=False):
+    """
+    Enables or disables profiling of the stages invoked with timed_invoke. When enabled, each stage is run with
+    cProfile and the pstats file and a text report of the slowest functions are written to the output directory.
+    Stages with the same profile name share one profile, so repeated stages like the processing of each user are
+    reported together.
+    :param output_dir: The directory to write the profiling reports to
+    :param enabled: If True the stages will be profiled
+    :param memory: If True the memory allocations of each stage will also be traced with tracemalloc
+    """
+    if memory and tracemalloc is None:
+        logger.warning('tracemalloc is not available in this Python version. Memory allocations will not be profiled.')
+        memory = False
+
+    __profiler['output_dir'] = expand_path(output_dir) if enabled else None
+    __profiler['memory'] = memory
+    __profiler['stack'] = []
+    __profiler['profiles'] = OrderedDict()
+    __profiler['worker'] = None
+
+
+def setup_worker_profiler():
+    """
+    Sets up profiling in a forked worker process. The profiles of the parent process stages that were running when
+    the worker was forked are stopped, so the worker does not add to copies that are never written. If profiling is
+    enabled the worker profiles its own stages and writes them, named with its process id, when it exits.
+    """
+    if len(__profiler['stack']) > 0:
+        __profiler['stack'][-1]['profile'].disable()
+        if __profiler['memory']:
+            tracemalloc.stop()
+    __profiler['stack'] = []
+    __profiler['profiles'] = OrderedDict()
+    __profiler['worker'] = None
+
+    if __profiler['output_dir'] is not None:
+        __profiler['worker'] = os.getpid()
+        # the stages of a worker are written once, when it exits, instead of after each task
+        Finalize(None, __write_profiles, exitpriority=10)
+
+
 def expand_path(path):
     """
     Expands a file path. This handles users and environmental variables.
@@ -56,6 +115,21 @@ def expand_path(path):
     return os.path.expandvars(new_path)
 
 
+def file_hash(file_path, block_size=1048576):
+    """
+    Calculates the SHA-1 hash of a file's content
+    :param file_path: The path of the file to hash
+    :param block_size: The number of bytes to read at a time
+    :return: The hex digest of the file content
+    """
+    sha1 = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha1.update(block)
+
+    return sha1.hexdigest()
+
+
 def clean_output(output_dir):
     """
     Creates the output directory if it does not exist and removes old files if it does.
@@ -65,22 +139,104 @@ def clean_output(output_dir):
         os.makedirs(output_dir)
     else:
         for f in os.listdir(output_dir):
-            os.remove(os.path.join(output_dir, f))
+            f = os.path.join(output_dir, f)
+            if os.path.isdir(f):
+                shutil.rmtree(f)
+            else:
+                os.remove(f)
 
 
-def timed_invoke(action, method):
+def timed_invoke(action, method, profile_name=None):
     """
     Invokes a method. Prints the start and finish with the invocation time.
     :param action: The string describing the method action
     :param method: The method to invoke
+    :param profile_name: The name of the profile the stage is added to when profiling is enabled. Stages that repeat,
+                         like the processing of each user, should use a common name. If None the action is the name.
     :return: The return of the method
     """
     logger.info('Started {}...'.format(action))
     start = time.time()
     try:
-        output = method()
+        output = __profiled_invoke(profile_name or action, method)
         logger.info('Finished {} in {} seconds'.format(action, int(time.time() - start)))
         return output
     except Exception:
         logger.info('Exception while {} after {} seconds'.format(action, int(time.time() - start)))
         raise
+
+
+def __profiled_invoke(name, method):
+    """
+    Invokes a method, adding it to the profile with the name if profiling is enabled. The profile of the enclosing
+    stage is paused while the method runs. The reports are written when the outermost stage finishes.
+    :param name: The profile name
+    :param method: The method to invoke
+    :return: The return of the method
+    """
+    if __profiler['output_dir'] is None:
+        return method()
+
+    profiles, stack = __profiler['profiles'], __profiler['stack']
+    if name not in profiles:
+        profiles[name] = {'profile': cProfile.Profile(), 'snapshot': None, 'peak': 0}
+    entry = profiles[name]
+    if entry in stack:
+        # a stage nested in a stage with the same profile is already part of that profile
+        return method()
+
+    memory = __profiler['memory']
+    if memory and len(stack) == 0:
+        tracemalloc.start()
+
+    if len(stack) > 0:
+        stack[-1]['profile'].disable()
+    stack.append(entry)
+    entry['profile'].enable()
+    try:
+        return method()
+    finally:
+        entry['profile'].disable()
+        stack.pop()
+        if memory:
+            entry['snapshot'] = tracemalloc.take_snapshot()
+            entry['peak'] = max(entry['peak'], tracemalloc.get_traced_memory()[1])
+        if len(stack) > 0:
+            stack[-1]['profile'].enable()
+        else:
+            if memory:
+                tracemalloc.stop()
+            if __profiler['worker'] is None:
+                __write_profiles()
+
+
+def __write_profiles():
+    """
+    Writes the pstats file and the reports of each profile to the output directory. The files are numbered in the
+    order the stages first started. The files of a worker process start with its process id.
+    """
+    output_dir = __profiler['output_dir']
+    if output_dir is None or len(__profiler['profiles']) == 0:
+        return
+
+    worker = '' if __profiler['worker'] is None else 'worker{}_'.format(__profiler['worker'])
+    for number, (name, entry) in enumerate(__profiler['profiles'].items(), 1):
+        file_prefix = os.path.join(output_dir, 'profile_{}{:02d}_{}'.format(
+            worker, number, re.sub(r'\W+', '_', name).strip('_').lower()))
+
+        # Save the raw stats for tools like snakeviz and a readable summary of the slowest functions
+        profile = entry['profile']
+        profile.dump_stats(file_prefix + '.pstats')
+        with open(file_prefix + '.txt', 'w') as f:
+            f.write('Profile for {}{}{}'.format(name, os.linesep, os.linesep))
+            pstats.Stats(profile, stream=f).sort_stats('cumulative').print_stats(50)
+
+        snapshot = entry['snapshot']
+        if snapshot is not None:
+            with open(file_prefix + '_memory.txt', 'w') as f:
+                f.write('Memory allocations for {}{}'.format(name, os.linesep))
+                f.write('Peak: {:.1f} MiB{}{}'.format(entry['peak'] / 1048576.0, os.linesep, os.linesep))
+                for stat in snapshot.statistics('lineno')[:30]:
+                    f.write('{}{}'.format(stat, os.linesep))
+
+    logger.info('Profiles of {} stages written to "{}"'.format(len(__profiler['profiles']), output_dir))
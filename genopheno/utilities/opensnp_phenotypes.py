@@ -0,0 +1,160 @@
+import argparse
+import json
+import os
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+import logging
+logger = logging.getLogger('root')
+
+# The rules of each trait. The phenotype of a user is the class with the keyword that is found first in the answer,
+# ignoring case. If keywords of two classes are found at the same position the class listed first is used. Answers
+# without any keyword are unknown and the user is not included. This is the normalization of opensnp_eye_color, where
+# hazel is counted as blue_green and descriptions like green-brown count as the color that is named first.
+DEFAULT_RULES = OrderedDict([
+    ('eye_color', {
+        'column': 'Eye color',
+        'classes': OrderedDict([
+            ('Blue_Green', ['blue', 'green', 'hazel']),
+            ('Brown', ['brown'])
+        ])
+    })
+])
+
+# The column of the openSNP phenotypes dump that identifies the user
+USER_COLUMN = 'user_id'
+
+
+def read_rules(rules_file):
+    """
+    Reads the trait rules from a JSON file with the same structure as DEFAULT_RULES, i.e.
+    {"eye_color": {"column": "Eye color", "classes": {"Blue_Green": ["blue", "green"], "Brown": ["brown"]}}}
+    :param rules_file: The JSON file path
+    :return: An ordered dictionary of the rules of each trait, in the order of the file
+    """
+    with open(rules_file) as f:
+        rules = json.load(f, object_pairs_hook=OrderedDict)
+
+    for trait, rule in rules.items():
+        if 'column' not in rule or len(rule.get('classes', {})) < 2:
+            raise ValueError('The rule of trait "{}" must have a column and at least two classes'.format(trait))
+
+    return rules
+
+
+def normalize(answers, classes):
+    """
+    Classifies free text answers by the keyword of each class that is found first
+    :param answers: A series of answers. Missing answers are unknown.
+    :param classes: An ordered dictionary where the key is the class label and the value is a list of keywords
+    :return: A series of class labels with the index of the answers, NaN for unknown answers
+    """
+    answers = answers.fillna('').astype(str).str.lower()
+    no_match = np.iinfo(np.int64).max
+
+    # the position of the first keyword of each class, a column for each class
+    positions = np.full((len(answers), len(classes)), no_match, dtype=np.int64)
+    for i, keywords in enumerate(classes.values()):
+        for keyword in keywords:
+            found = answers.str.find(keyword.lower()).values
+            matched = found >= 0
+            positions[matched, i] = np.minimum(positions[matched, i], found[matched])
+
+    labels = np.array(list(classes.keys()), dtype=object)
+    first = positions.argmin(axis=1)
+    phenotypes = pd.Series(labels[first], index=answers.index)
+    phenotypes[positions[np.arange(len(answers)), first] == no_match] = np.nan
+    return phenotypes
+
+
+def extract_phenotypes(phenotypes_file, rules, output_dir):
+    """
+    Reads the openSNP phenotypes dump once and writes a known phenotypes file (user_id,phenotype) for each trait
+    :param phenotypes_file: The openSNP phenotypes dump, separated by semicolons
+    :param rules: An ordered dictionary of the rules of each trait, see DEFAULT_RULES
+    :param output_dir: The directory to write the <trait>.csv files to
+    :return: A dictionary where the key is the trait and the value is the known phenotypes data frame
+    """
+    columns = [USER_COLUMN] + [rule['column'] for rule in rules.values()]
+    data = pd.read_csv(phenotypes_file, sep=';', error_bad_lines=False, warn_bad_lines=False, dtype=str,
+                       usecols=lambda column: column in columns)
+    missing = [column for column in columns if column not in data.columns]
+    if len(missing) > 0:
+        raise ValueError('The phenotypes file does not have the columns {}'.format(missing))
+
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    known_phenotypes = {}
+    for trait, rule in rules.items():
+        phenotypes = pd.DataFrame({
+            'user_id': data[USER_COLUMN],
+            'phenotype': normalize(data[rule['column']], rule['classes'])
+        }, columns=['user_id', 'phenotype']).dropna()
+
+        phenotypes.to_csv(os.path.join(output_dir, '{}.csv'.format(trait)), index=False)
+        counts = phenotypes['phenotype'].value_counts()
+        logger.info('{}: {} of {} users classified ({})'.format(
+            trait, len(phenotypes), len(data), ', '.join('{} {}'.format(label, counts.get(label, 0))
+                                                        for label in rule['classes'])))
+        known_phenotypes[trait] = phenotypes
+
+    return known_phenotypes
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='[%(levelname)s]: %(message)s')
+
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter)
+
+    parser.add_argument(
+        "--phenotypes",
+        "-p",
+        metavar="<file path>",
+        required=True,
+        help="The openSNP phenotypes dump (phenotypes_<date>.csv), which is separated by semicolons."
+    )
+
+    parser.add_argument(
+        "--rules",
+        "-r",
+        metavar="<file path>",
+        help="A JSON file with the rules of each trait. The key is the trait name and the value has the dump "
+             "column and the keywords of each class, i.e."
+             '\n{"eye_color": {"column": "Eye color", '
+             '"classes": {"Blue_Green": ["blue", "green", "hazel"], "Brown": ["brown"]}}}'
+             "\nThe phenotype of a user is the class with the keyword found first in the answer. Users whose answer "
+             "has no keyword are not included."
+             "\n\nDefault: eye color"
+    )
+
+    parser.add_argument(
+        "--traits",
+        "-t",
+        metavar="<trait names>",
+        help="A comma separated list of the traits of the rules to extract."
+             "\n\nDefault: all traits"
+    )
+
+    parser.add_argument(
+        "--output",
+        "-o",
+        metavar="<directory path>",
+        default="resources" + os.sep + "data",
+        help="The directory to write a known phenotypes file <trait>.csv for each trait to."
+             "\n\nDefault: resources/data"
+    )
+
+    args = parser.parse_args()
+
+    trait_rules = read_rules(args.rules) if args.rules else DEFAULT_RULES
+    if args.traits:
+        names = [name.strip() for name in args.traits.split(',')]
+        unknown = [name for name in names if name not in trait_rules]
+        if len(unknown) > 0:
+            raise ValueError('Unknown traits {}. The traits are: {}'.format(unknown, ', '.join(trait_rules)))
+        trait_rules = OrderedDict((name, trait_rules[name]) for name in names)
+
+    extract_phenotypes(args.phenotypes, trait_rules, args.output)
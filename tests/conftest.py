@@ -0,0 +1,76 @@
+import os
+import sys
+
+# The application modules are run as scripts from the genopheno directory, so modules in one sub-package import
+# modules in another sub-package relative to that directory. The tests import the application as the genopheno package.
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, os.path.join(ROOT_DIR, 'genopheno'))
+sys.path.insert(0, ROOT_DIR)
+
+import random
+import pytest
+
+PHENOTYPES = ['Blue_Green', 'Brown']
+VCF_HEADER_LINES = 12
+
+
+@pytest.fixture(scope='session')
+def synthetic_data(tmpdir_factory):
+    """
+    Creates a small data set in the format of the application inputs: a dbSNP VCF file with SNPs on two chromosomes,
+    23andMe user files and the known phenotypes. The first SNPs have more mutations for the Brown phenotype, so models
+    can be built from the data.
+    :return: A dictionary with the users_dir, snp_dir and phenotypes_file paths
+    """
+    root = tmpdir_factory.mktemp('synthetic')
+    rng = random.Random(5)
+
+    snps = []
+    for i in range(60):
+        chrom, ref, alt = str(1 + i % 2), 'ACGT'[i % 4], 'ACGT'[(i + 1) % 4]
+        snps.append((chrom, 1000 + 100 * i, 'rs{}'.format(100 + i), ref, alt))
+    signal = set(rsid for _, _, rsid, _, _ in snps[:8])
+
+    snp_dir = root.mkdir('snp')
+    with open(str(snp_dir.join('dbsnp.vcf')), 'w') as f:
+        for _ in range(VCF_HEADER_LINES):
+            f.write('##header\n')
+        for chrom, pos, rsid, ref, alt in snps:
+            f.write('{}\t{}\t{}\t{}\t{}\t.\t.\tRSPOS={};GENEINFO={}:GENE{};VC=snp\n'
+                    .format(chrom, pos, rsid, ref, alt, pos, pos, pos % 7))
+
+    users_dir = root.mkdir('users')
+    phenotypes_file = root.join('known_phenotypes.csv')
+    with open(str(phenotypes_file), 'w') as phenotypes:
+        phenotypes.write('user_id,phenotype\n')
+        for user_id in range(1, 41):
+            phenotype = PHENOTYPES[user_id % 2]
+            phenotypes.write('{},{}\n'.format(user_id, phenotype))
+            with open(str(users_dir.join('user{0}_file{0}_yearofbirth_1970_sex_XY.23andme.txt'.format(user_id))),
+                      'w') as f:
+                f.write('# rsid\tchromosome\tposition\tgenotype\n')
+                for chrom, pos, rsid, ref, alt in snps:
+                    if rng.random() < 0.05:
+                        continue
+                    p_alt = 0.8 if rsid in signal and phenotype == 'Brown' else 0.2
+                    f.write('{}\t{}\t{}\t{}\n'.format(
+                        rsid, chrom, pos, ''.join(alt if rng.random() < p_alt else ref for _ in range(2))))
+
+    return {'users_dir': str(users_dir), 'snp_dir': str(snp_dir), 'phenotypes_file': str(phenotypes_file)}
+
+
+@pytest.fixture(scope='session')
+def synthetic_model(synthetic_data, tmpdir_factory):
+    """
+    Preprocesses the synthetic data and builds an elastic net model without interactions from it
+    :return: The synthetic data paths with the init_dir of the preprocessed files and the model_dir
+    """
+    from genopheno import preprocess, model
+    root = tmpdir_factory.mktemp('synthetic_model')
+    init_dir, model_dir = str(root.join('preprocessed')), str(root.join('model'))
+    preprocess.run(synthetic_data['users_dir'], synthetic_data['snp_dir'], synthetic_data['phenotypes_file'], init_dir)
+    model.run(init_dir, 50, 80, 15, 20, True, None, 20, 'en', 3, model_dir)
+
+    paths = dict(synthetic_data)
+    paths.update({'init_dir': init_dir, 'model_dir': model_dir})
+    return paths
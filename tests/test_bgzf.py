@@ -0,0 +1,26 @@
+import gzip
+import pandas as pd
+from genopheno.preprocessing import bgzf
+
+
+def test_read_rows(tmpdir):
+    """
+    Tests that the file can be read with gzip and that rows are read by RSID and gene, including rows that continue in
+    the next block.
+    """
+    data = pd.DataFrame({
+        'Rsid': ['rs{}'.format(i) for i in range(50)],
+        'Gene_info': ['GENE{}:{}'.format(i % 7, i) for i in range(50)],
+        'value': [float(i) / 3 for i in range(50)],
+        'text': ['x' * (i * 3) for i in range(50)]
+    }, columns=['Rsid', 'Gene_info', 'value', 'text'])
+    path = str(tmpdir.join('data.csv.gz'))
+    bgzf.write_csv(data, path, threads=2, chunk_rows=7, block_size=64)
+
+    with gzip.open(path) as f:
+        assert f.read() == data.to_csv(index=False)
+
+    rows = bgzf.read_rows(path, rsids=['rs45', 'rs3', 'rs17'], genes=['GENE6:6'])
+    assert list(rows['Rsid']) == ['rs3', 'rs6', 'rs17', 'rs45']
+    pd.testing.assert_frame_equal(rows, data.iloc[[3, 6, 17, 45]].reset_index(drop=True),
+                                  check_dtype=False)
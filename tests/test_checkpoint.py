@@ -0,0 +1,56 @@
+import os
+import numpy as np
+from genopheno.preprocessing.checkpoint import Checkpoint
+
+SNPS = Checkpoint.snp_hash(['rs1', 'rs2'])
+
+
+def test_resume(tmpdir):
+    """
+    Tests that the chunks are loaded in order and that chunks after a change in the users are discarded.
+    """
+    checkpoint = Checkpoint(str(tmpdir), 2)
+    checkpoint.save('Brown', ['a', 'b'], [1], np.array([[0], [np.nan]], dtype=np.float32), SNPS)
+    checkpoint.save('Brown', ['c', 'd'], [3, 4], np.array([[1, 2], [2, 0]], dtype=np.float32), SNPS)
+
+    n_processed, user_ids, genotypes = checkpoint.load('Brown', ['a', 'b', 'c', 'd', 'e'], SNPS)
+    assert n_processed == 4
+    assert user_ids == [1, 3, 4]
+    np.testing.assert_array_equal(np.hstack(genotypes), [[0, 1, 2], [np.nan, 2, 0]])
+
+    # user c was removed, so only the first chunk is still valid
+    n_processed, user_ids, _ = checkpoint.load('Brown', ['a', 'b', 'd', 'e'], SNPS)
+    assert (n_processed, user_ids) == (2, [1])
+    assert len(os.listdir(os.path.join(str(tmpdir), 'Brown'))) == 1
+
+    assert checkpoint.load('Blue_Green', ['f'], SNPS) == (0, [], [])
+    assert not checkpoint.is_complete('Brown')
+    checkpoint.complete('Brown')
+    assert checkpoint.is_complete('Brown')
+
+
+def test_snp_order(tmpdir):
+    """
+    Tests that chunks written with another SNP order are discarded, even with the same number of SNPs.
+    """
+    checkpoint = Checkpoint(str(tmpdir), 2)
+    checkpoint.save('Brown', ['a', 'b'], [1, 2], np.array([[0, 1], [2, 1]], dtype=np.float32), SNPS)
+    assert checkpoint.load('Brown', ['a', 'b'], Checkpoint.snp_hash(['rs2', 'rs1'])) == (0, [], [])
+    assert checkpoint.load('Brown', ['a', 'b'], SNPS) == (0, [], [])
+
+
+def test_phenotype_names(tmpdir):
+    """
+    Tests that phenotype labels that are not safe file names get a directory inside the checkpoint directory and that
+    different labels do not share a directory.
+    """
+    checkpoint = Checkpoint(str(tmpdir.join('checkpoints')), 2)
+    for phenotype in ['../Brown', 'Blue/Green', 'Blue_Green', '.cohort']:
+        checkpoint.complete(phenotype)
+
+    names = os.listdir(str(tmpdir.join('checkpoints')))
+    assert len(names) == 4
+    assert 'Blue_Green' in names
+    assert not any(name.startswith('.') for name in names)
+    assert os.listdir(str(tmpdir)) == ['checkpoints']
+    assert checkpoint.is_complete('Blue/Green')
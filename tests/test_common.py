@@ -0,0 +1,63 @@
+import os
+import numpy as np
+import pandas as pd
+import pytest
+from patsy import dmatrix
+from sklearn.linear_model import LogisticRegression
+from genopheno.models import common
+from genopheno.models.common import build_model_desc, design_matrix, prepare_data_set, build_model
+
+
+def test_design_matrix():
+    """
+    Tests that the design matrix has the same columns as the patsy design matrix of the model description, with all
+    pairs, screened pairs and no interactions, and that the float32 matrix has the same values.
+    """
+    snps = ['gene_a_rs1', 'gene_b_rs2', 'gene_c_rs3', 'gene_d_rs4']
+    x = np.random.RandomState(0).randint(0, 3, size=(20, 4)).astype(float)
+
+    for no_interactions, pairs in [(False, None), (False, [('gene_b_rs2', 'gene_d_rs4'), ('gene_a_rs1', 'gene_c_rs3')]),
+                                   (False, []), (True, None)]:
+        expected = np.asarray(dmatrix(build_model_desc(snps, no_interactions, pairs), pd.DataFrame(x, columns=snps)))
+        design = design_matrix(x, snps, no_interactions, pairs)
+        assert design.dtype == np.float64
+        np.testing.assert_array_equal(design, expected)
+
+        design = design_matrix(x.astype(np.float32), snps, no_interactions, pairs, np.float32)
+        assert design.dtype == np.float32
+        np.testing.assert_array_equal(design, expected)
+
+
+def test_shared_training_data(monkeypatch):
+    """
+    Tests that the search gets the training design matrix as a read-only memory-mapped file and that the file is
+    removed after the model is built and when the search fails.
+    """
+    random = np.random.RandomState(0)
+    snps = ['gene_a_rs1', 'gene_b_rs2', 'gene_c_rs3']
+    data_set = pd.DataFrame(random.randint(0, 3, size=(40, 3)).astype(float), columns=snps)
+    data_set['phenotype'] = ['Brown' if i % 2 else 'Blue_Green' for i in range(40)]
+    model_data = prepare_data_set(data_set, 25, None, None, None)
+
+    shared_dirs = []
+    mkdtemp = common.tempfile.mkdtemp
+    monkeypatch.setattr(common.tempfile, 'mkdtemp', lambda **kwargs: shared_dirs.append(mkdtemp(**kwargs)) or
+                        shared_dirs[-1])
+
+    def search(model, param_grid, cross_validation, x_train, y_train, n_jobs):
+        assert isinstance(x_train, np.memmap) and x_train.mode == 'r'
+        assert os.path.dirname(x_train.filename) == shared_dirs[-1]
+        np.testing.assert_array_equal(x_train, design_matrix(model_data['x_train'], snps, False))
+        return model.fit(x_train, y_train), {}
+
+    model_config, metrics = build_model(model_data, False, LogisticRegression(), 2, None, search=search)
+    assert model_config['model'] is not None and 0 <= metrics['accuracy'] <= 1
+    assert len(shared_dirs) == 1 and not os.path.exists(shared_dirs[0])
+
+    def failed_search(*args):
+        search(*args)
+        raise RuntimeError('search failed')
+
+    with pytest.raises(RuntimeError):
+        build_model(model_data, False, LogisticRegression(), 2, None, search=failed_search)
+    assert len(shared_dirs) == 2 and not os.path.exists(shared_dirs[1])
@@ -0,0 +1,91 @@
+import os
+import numpy as np
+import pandas as pd
+import pytest
+from genopheno.preprocessing import genome_cache
+from genopheno.preprocessing.genome_cache import GenomeCache
+
+GENOTYPES = ['AA', 'AG', 'GG', 'CT']
+
+
+def __user_files(tmpdir, n_files):
+    """
+    Writes user files with different content and the same number of SNPs
+    :return: A list of tuples of the file path and the function that parses it
+    """
+    users = []
+    for i in range(n_files):
+        genome = pd.DataFrame({'Rsid': ['rs{}'.format(10 + j) for j in range(4)],
+                               'Genotype': [GENOTYPES[(i >> (2 * j)) & 3] for j in range(4)]})
+        file_path = str(tmpdir.join('user{}.txt'.format(i)))
+        genome.to_csv(file_path, sep='\t', index=False)
+        users.append((file_path, lambda file_path=file_path: pd.read_csv(file_path, sep='\t')))
+
+    return users
+
+
+def __not_parsed():
+    raise AssertionError('The user file was parsed again')
+
+
+def test_evict(tmpdir, monkeypatch):
+    """
+    Tests that the least recently used genomes are evicted together with their key files and that the cache
+    directory is not scanned on every write.
+    """
+    users = __user_files(tmpdir.mkdir('users'), 13)
+    sizing_cache = GenomeCache(str(tmpdir.join('sizing')))
+    sizing_cache.get(*users[0])
+    entry_size = os.path.getsize(os.path.join(str(tmpdir), 'sizing', 'genomes',
+                                              os.listdir(str(tmpdir.join('sizing', 'genomes')))[0]))
+
+    listed = []
+    listdir = os.listdir
+    monkeypatch.setattr(genome_cache.os, 'listdir', lambda path: listed.append(path) or listdir(path))
+
+    cache_dir = str(tmpdir.join('cache'))
+    cache = GenomeCache(cache_dir, int(entry_size * 10.5))
+    for file_path, parse in users[:12]:
+        rsids, genotypes = cache.get(file_path, parse)
+        assert list(rsids) == [10, 11, 12, 13]
+    # users 0 and 1 were evicted and user 2 is used again, so users 3 and 4 are the least recently used genomes
+    cache.get(users[2][0], __not_parsed)
+    cache.get(*users[12])
+
+    genomes_dir = os.path.join(cache_dir, 'genomes')
+    assert len(listdir(genomes_dir)) == 9
+    assert len(listdir(os.path.join(cache_dir, 'keys'))) == 9
+    assert sum(os.path.getsize(os.path.join(genomes_dir, f)) for f in listdir(genomes_dir)) <= entry_size * 10.5
+    assert listed.count(genomes_dir) == 3
+
+    for file_path, _ in users[2:3] + users[5:]:
+        cache.get(file_path, __not_parsed)
+    for file_path, parse in users[:2] + users[3:5]:
+        parsed = []
+        cache.get(file_path, lambda: parsed.append(file_path) or parse())
+        assert parsed == [file_path]
+
+
+def test_atomic_write(tmpdir, monkeypatch):
+    """
+    Tests that a failed write leaves no partial genome in the cache and that the file is parsed again afterwards.
+    """
+    file_path, parse = __user_files(tmpdir.mkdir('users'), 1)[0]
+    cache_dir = str(tmpdir.join('cache'))
+    cache = GenomeCache(cache_dir, 1024 * 1024)
+
+    def savez(f, **arrays):
+        f.write(b'partial genome')
+        raise IOError('No space left on device')
+
+    with monkeypatch.context() as patch:
+        patch.setattr(genome_cache.np, 'savez', savez)
+        with pytest.raises(IOError):
+            cache.get(file_path, parse)
+    assert os.listdir(os.path.join(cache_dir, 'genomes')) == []
+
+    rsids, genotypes = cache.get(file_path, parse)
+    assert list(rsids) == [10, 11, 12, 13]
+    cached_rsids, cached_genotypes = cache.get(file_path, __not_parsed)
+    np.testing.assert_array_equal(cached_rsids, rsids)
+    np.testing.assert_array_equal(cached_genotypes, genotypes)
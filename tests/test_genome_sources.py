@@ -0,0 +1,49 @@
+import os
+import gzip
+import tarfile
+import zipfile
+from contextlib import closing
+import numpy as np
+from genopheno.preprocessing import genome_sources
+from genopheno.preprocessing.users import UserPhenotypes, User
+
+GENOME = '# rsid\tchromosome\tposition\tgenotype\nrs10\t1\t100\tAG\nrs20\t1\t200\tCC\nrs30\t2\t300\t--\n'
+FILES = ['user1_file1_yearofbirth_1970_sex_XY.23andme.txt', 'user2_file2_yearofbirth_1970_sex_XY.23andme.txt.gz']
+
+
+def test_archives(tmpdir):
+    """
+    Tests that user files are listed and read the same from a directory and from zip and tar archives, that gzip
+    compressed files are decompressed and that member names are filtered without their directories.
+    """
+    users_dir = tmpdir.mkdir('users')
+    users_dir.join(FILES[0]).write(GENOME)
+    with gzip.open(str(users_dir.join(FILES[1])), 'wb') as f:
+        f.write(GENOME)
+    users_dir.join('readme.txt').write('not a user file')
+
+    zip_path = str(tmpdir.join('dump.zip'))
+    with zipfile.ZipFile(zip_path, 'w') as archive:
+        for name in FILES + ['readme.txt']:
+            archive.write(str(users_dir.join(name)), 'dump/' + name)
+
+    tar_path = str(tmpdir.join('dump.tar.gz'))
+    with tarfile.open(tar_path, 'w:gz') as archive:
+        for name in FILES:
+            archive.add(str(users_dir.join(name)), name)
+
+    sources = [(str(users_dir), FILES), (zip_path, ['dump/' + name for name in FILES]), (tar_path, FILES)]
+    for source, expected in sources:
+        user_files = UserPhenotypes.get_user_geno_files(source)
+        assert sorted(user_files) == expected
+
+        for user_file in user_files:
+            path = os.path.join(source, user_file)
+            with closing(genome_sources.open_file(path)) as f:
+                assert f.read() == GENOME
+            assert genome_sources.stat(path)[0] > 0
+
+            user = User(source, user_file)
+            assert user.id in [1, 2]
+            rsids, genotypes = user._User__read_encoded_genome()
+            np.testing.assert_array_equal(rsids, [10, 20, 30])
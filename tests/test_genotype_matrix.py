@@ -0,0 +1,93 @@
+import numpy as np
+import pandas as pd
+from genopheno.preprocessing import genotype_matrix
+from genopheno.preprocessing.genotype_matrix import PackedGenotypes, PackedPhenotype, PCT_COLUMNS, calc_snp_percents
+
+
+def __random_genotypes(n_snps, n_users):
+    """
+    Creates a random genotype matrix with about 20% missing calls
+    :param n_snps: The number of SNPs (rows)
+    :param n_users: The number of users (columns)
+    :return: The genotype matrix
+    """
+    rng = np.random.RandomState(1)
+    values = rng.randint(0, 3, size=(n_snps, n_users)).astype(float)
+    values[rng.rand(n_snps, n_users) < 0.2] = np.nan
+    return values
+
+
+def test_round_trip():
+    """
+    Tests that packing and unpacking a genotype matrix does not change it.
+    """
+    values = __random_genotypes(17, 45)
+    np.testing.assert_array_equal(PackedGenotypes.from_array(values).to_array(), values)
+
+
+def test_counts():
+    """
+    Tests the SNP and user counts against counting the unpacked values.
+    """
+    values = __random_genotypes(23, 70)
+    genotypes = PackedGenotypes.from_array(values)
+
+    counts = genotypes.snp_counts()
+    for mutations in range(3):
+        np.testing.assert_array_equal(counts[:, mutations], (values == mutations).sum(axis=1))
+    np.testing.assert_array_equal(counts[:, 3], np.isnan(values).sum(axis=1))
+    np.testing.assert_array_equal(genotypes.user_missing(), np.isnan(values).sum(axis=0))
+
+
+def test_snp_percents():
+    """
+    Tests that the mutation percentages of a selection of the user columns only count the selected users and ignore
+    missing calls.
+    """
+    values = __random_genotypes(19, 40)
+    data = pd.DataFrame(values, columns=[str(i) for i in range(40)])
+    columns = [str(i) for i in range(0, 40, 3)]
+    data = calc_snp_percents(data, columns)
+
+    selected = values[:, ::3]
+    observed = (~np.isnan(selected)).sum(axis=1).astype(float)
+    for column, mutations in zip(PCT_COLUMNS, [2, 0, 1]):
+        expected = np.where(observed == 0, 0, (selected == mutations).sum(axis=1) / np.maximum(observed, 1) * 100)
+        np.testing.assert_allclose(data[column].values, expected)
+
+
+def test_packed_phenotype(tmpdir, monkeypatch):
+    """
+    Tests that a preprocessed file and a genotype matrix are packed in chunks the same as the preprocessed data frame,
+    and that the mutation percentages of the genotype matrix users are calculated.
+    """
+    monkeypatch.setattr(genotype_matrix, 'PACK_ROWS', 7)
+    values = __random_genotypes(30, 40)
+    users = [str(100 + i) for i in range(40)]
+    frame = pd.DataFrame(values, columns=users, index=pd.Index(['rs{}'.format(i) for i in range(30)], name='Rsid'))
+    frame.insert(0, 'Gene_info', ['{}:GENE{}'.format(i, i % 4) for i in range(30)])
+
+    matrix_file = str(tmpdir.join('genotypes.csv.gz'))
+    frame.reset_index().to_csv(matrix_file, index=False, compression='gzip')
+    preprocessed_file = str(tmpdir.join('preprocessed_Brown.csv.gz'))
+    frame = calc_snp_percents(frame, users)
+    frame.reset_index().to_csv(preprocessed_file, index=False, compression='gzip')
+
+    expected = PackedPhenotype.from_frame(frame)
+    np.testing.assert_array_equal(expected.genotypes.words, PackedGenotypes.from_array(values).words)
+    for packed, columns in [(PackedPhenotype.read_csv(preprocessed_file), users),
+                            (PackedPhenotype.read_csv(matrix_file, users[::2]), users[::2])]:
+        assert packed.users == columns
+        assert list(packed.snps.index) == list(frame.index)
+        np.testing.assert_array_equal(packed.user_mutations(['rs3', 'rs29']),
+                                      frame.loc[['rs3', 'rs29'], columns].values)
+        if columns == users:
+            np.testing.assert_array_equal(packed.genotypes.words, expected.genotypes.words)
+            np.testing.assert_allclose(packed.snps[PCT_COLUMNS].values, frame[PCT_COLUMNS].values)
+        else:
+            np.testing.assert_allclose(packed.snps[PCT_COLUMNS].values,
+                                       calc_snp_percents(frame[columns].copy(), columns)[PCT_COLUMNS].values)
+
+    expected.drop_snps(np.arange(30) % 3 == 0)
+    assert len(expected.snps) == expected.genotypes.n_snps == 20
+    np.testing.assert_array_equal(expected.user_mutations(['rs1', 'rs2']), values[1:3])
@@ -0,0 +1,33 @@
+import numpy as np
+import pytest
+from sklearn.preprocessing import Imputer
+from genopheno.models.imputer import GenotypeImputer
+
+
+def test_most_frequent():
+    """
+    Tests that the genotype imputer fills the same values as the scikit-learn most frequent imputer, including ties.
+    """
+    rng = np.random.RandomState(3)
+    x = rng.randint(0, 3, size=(40, 25)).astype(float)
+    x[rng.rand(40, 25) < 0.3] = np.nan
+    x[:, 0] = [0, 1, np.nan, 1, 0] * 8
+
+    expected = Imputer(strategy='most_frequent').fit_transform(x)
+    np.testing.assert_array_equal(GenotypeImputer().fit_transform(x), expected)
+
+    # the fill values are enough to impute new data
+    test = np.full((2, 25), np.nan)
+    np.testing.assert_array_equal(GenotypeImputer(GenotypeImputer().fit(x).fill_values).transform(test),
+                                  Imputer(strategy='most_frequent').fit(x).transform(test))
+
+
+def test_missing_column():
+    """
+    Tests that a SNP column without any data has no fill value.
+    """
+    x = np.array([[0, np.nan], [2, np.nan], [2, np.nan]])
+    assert np.isnan(GenotypeImputer().fit(x).fill_values[1])
+
+    with pytest.raises(ValueError):
+        GenotypeImputer().fit(np.array([[3.0]]))
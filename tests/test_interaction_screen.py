@@ -0,0 +1,27 @@
+import numpy as np
+from genopheno.models.snp_selectors.interaction_screen import screen_interactions
+
+
+def test_screen_interactions():
+    """
+    Tests that a pair that only affects the phenotype through its interaction is selected, that the selection does not
+    depend on the block size and that the pairs are sorted.
+    """
+    random = np.random.RandomState(0)
+    x = random.randint(0, 3, size=(400, 12)).astype(float)
+    y = ((x[:, 3] - 1) * (x[:, 8] - 1) > 0).astype(int)
+
+    pairs, scores = screen_interactions(x, y, 5)
+    assert len(pairs) == 5
+    assert (3, 8) in pairs
+    assert scores[pairs.index((3, 8))] == scores.max()
+    assert pairs == sorted(pairs)
+    assert all(i < j for i, j in pairs)
+
+    for block_pairs in [1, 13, 50]:
+        block_result, block_scores = screen_interactions(x, y, 5, block_pairs)
+        assert block_result == pairs
+        np.testing.assert_allclose(block_scores, scores)
+
+    pairs, _ = screen_interactions(x, y, 100)
+    assert len(pairs) == 12 * 11 // 2
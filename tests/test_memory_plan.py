@@ -0,0 +1,48 @@
+from genopheno.memory_plan import plan_model, plan_predict, plan_preprocess, MB
+
+
+def test_plan_model():
+    """
+    Tests that the model settings are kept when they fit the budget and are lowered in order when they do not: float32
+    design matrices first, then fewer grid search processes and then fewer interactions.
+    """
+    args = (1000, 500, 200, 0, False, None)
+    assert plan_model(10000, *args, float32=False, n_jobs=4, cross_validation=3) == \
+        {'float32': False, 'n_jobs': 4, 'interactions': None}
+
+    plan = plan_model(450, *args, float32=False, n_jobs=4, cross_validation=3)
+    assert plan['float32'] and plan['interactions'] is None and 1 < plan['n_jobs'] < 4
+
+    plan = plan_model(200, *args, float32=False, n_jobs=4, cross_validation=3)
+    assert plan['float32'] and plan['n_jobs'] == 1
+    assert 0 < plan['interactions'] < 200 * 199 // 2
+
+    # the interactions are never raised
+    plan = plan_model(10000, 1000, 500, 200, 0, False, 10, False, 1, 3)
+    assert plan['interactions'] == 10
+
+
+def test_plan_predict():
+    """
+    Tests that the block size is lowered before the number of workers.
+    """
+    assert plan_predict(1000, 100, 5000, 0, 10 * MB, 100, 4) == {'block_size': 100, 'workers': 4}
+
+    plan = plan_predict(50, 1000, 100000, 0, 10 * MB, 100, 4)
+    assert plan['workers'] == 4 and plan['block_size'] < 100
+
+    plan = plan_predict(20, 1000, 100000, 0, 10 * MB, 100, 4)
+    assert plan == {'block_size': 1, 'workers': 1}
+
+
+def test_plan_preprocess():
+    """
+    Tests that the rows written at once, the shard workers and the task size are lowered to fit the budget.
+    """
+    plan = plan_preprocess(10000, 100000, 1000, 0, 10000, workers=4, shard_snps=10000, batch_size=50)
+    assert plan == {'chunk_rows': 10000, 'workers': 4, 'batch_size': 50}
+
+    plan = plan_preprocess(3100, 100000, 1000, 0, 10000, workers=4, shard_snps=40000, batch_size=2000)
+    assert plan['chunk_rows'] < 10000
+    assert plan['workers'] == 2
+    assert plan['batch_size'] < 2000
@@ -0,0 +1,73 @@
+import os
+import pickle
+import numpy as np
+import pandas as pd
+import pytest
+from genopheno import model
+from genopheno.models import common
+
+
+def __build(paths, output_dir, model_ids):
+    """
+    Builds models from the synthetic preprocessed data, training two at a time
+    """
+    model.run(paths['init_dir'], 50, 80, 15, 20, True, None, 20, model_ids, 3, output_dir, n_jobs=2)
+
+
+def __crash(*args, **kwargs):
+    # a process killed while training never reports back
+    os._exit(3)
+
+
+def test_tournament(synthetic_model, tmpdir):
+    """
+    Tests that the models are trained in separate processes, that each model is written and that the comparison lists
+    the models from best to worst.
+    """
+    output_dir = str(tmpdir.join('models'))
+    __build(synthetic_model, output_dir, 'en,rf')
+
+    comparison = pd.read_csv(os.path.join(output_dir, model.COMPARISON_FILE))
+    assert sorted(comparison['model']) == ['en', 'rf']
+    best = comparison.sort_values(by=['accuracy', 'auc'], ascending=False)['model'].iloc[0]
+    assert comparison['model'].iloc[0] == best
+    for model_id in ['en', 'rf']:
+        assert os.path.exists(os.path.join(output_dir, model_id, 'model_config.pkl'))
+
+
+def test_tournament_failure(synthetic_model, tmpdir, monkeypatch):
+    """
+    Tests that a model process that dies is reported as failed instead of waiting for its result, and that the other
+    models are still written and compared.
+    """
+    monkeypatch.setitem(model.MODELS, 'dt', __crash)
+    output_dir = str(tmpdir.join('models'))
+    with pytest.raises(RuntimeError) as error:
+        __build(synthetic_model, output_dir, 'en,dt')
+
+    assert 'dt' in str(error.value)
+    comparison = pd.read_csv(os.path.join(output_dir, model.COMPARISON_FILE))
+    assert list(comparison['model']) == ['en']
+    assert os.path.exists(os.path.join(output_dir, 'en', 'model_config.pkl'))
+
+
+def test_memory_plan_float32(synthetic_model, tmpdir, monkeypatch):
+    """
+    Tests that when the memory plan needs float32 data the training and testing data are imputed as float32, instead
+    of being converted after the float64 data was created.
+    """
+    prepared = []
+    prepare_data_set = common.prepare_data_set
+
+    def record(*args):
+        prepared.append(prepare_data_set(*args))
+        return prepared[-1]
+
+    monkeypatch.setattr(common, 'prepare_data_set', record)
+    output_dir = str(tmpdir.join('model'))
+    model.run(synthetic_model['init_dir'], 50, 80, 15, 20, True, None, 20, 'en', 3, output_dir, max_memory=0)
+
+    assert len(prepared) == 1
+    assert prepared[0]['x_train'].dtype == np.float32 and prepared[0]['x_test'].dtype == np.float32
+    with open(os.path.join(output_dir, 'model_config.pkl'), 'rb') as f:
+        assert pickle.load(f)['dtype'] == 'float32'
@@ -0,0 +1,38 @@
+import pandas as pd
+from genopheno.utilities.opensnp_eye_color import eye_color_normalize
+from genopheno.utilities.opensnp_phenotypes import DEFAULT_RULES, normalize, extract_phenotypes, read_rules
+
+
+def test_eye_color():
+    """
+    Tests that the default eye color rule classifies the answers the same as eye_color_normalize.
+    """
+    answers = pd.Series(['Brown', 'blue', 'Green-Brown', 'brown-green', 'Hazel', 'Dark brown with hazel', '-',
+                         'grey', 'Blue-grey', 'BROWN', 'green/hazel'])
+    expected = [eye_color_normalize(answer) for answer in answers]
+    phenotypes = normalize(answers, DEFAULT_RULES['eye_color']['classes'])
+    assert list(phenotypes.fillna('-')) == expected
+
+
+def test_extract_phenotypes(tmpdir):
+    """
+    Tests that a known phenotypes file is written for each trait from one read of the dump.
+    """
+    dump = tmpdir.join('phenotypes.csv')
+    dump.write('user_id;date_of_birth;Eye color;Hair color;Lactose intolerance\n'
+               '1;1970;Brown;Blonde;Lactose intolerant\n'
+               '2;1980;blue-green;dark brown;-\n'
+               '3;1990;-;Black;lactose tolerant\n')
+    rules = tmpdir.join('rules.json')
+    rules.write('{"eye_color": {"column": "Eye color", "classes": {"Blue_Green": ["blue", "green"], '
+                '"Brown": ["brown"]}},'
+                '"lactose": {"column": "Lactose intolerance", "classes": {"Intolerant": ["intolerant"], '
+                '"Tolerant": ["tolerant"]}}}')
+
+    phenotypes = extract_phenotypes(str(dump), read_rules(str(rules)), str(tmpdir.join('output')))
+    assert list(phenotypes['eye_color']['phenotype']) == ['Brown', 'Blue_Green']
+
+    lactose = pd.read_csv(str(tmpdir.join('output', 'lactose.csv')))
+    assert list(lactose.columns) == ['user_id', 'phenotype']
+    assert list(lactose['user_id']) == [1, 3]
+    assert list(lactose['phenotype']) == ['Intolerant', 'Tolerant']
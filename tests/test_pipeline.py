@@ -0,0 +1,45 @@
+import gzip
+import os
+import pickle
+import pytest
+from genopheno import predict
+from genopheno.pipeline import Pipeline, PREPROCESSED_DIR, MODEL_DIR, PREDICTION_DIR
+
+
+def __read(file_path):
+    with (gzip.open if file_path.endswith('.gz') else open)(file_path, 'rb') as f:
+        return f.read()
+
+
+@pytest.mark.parametrize('cohort,workers', [(False, 1), (True, 2)])
+def test_pipeline(synthetic_model, tmpdir, cohort, workers):
+    """
+    Tests that the pipeline writes the same preprocessed files, model and predictions as the scripts, also when the
+    users are preprocessed as a cohort and predicted with several workers.
+    """
+    script_dir = str(tmpdir.join('script_prediction'))
+    predict.run(synthetic_model['users_dir'], synthetic_model['init_dir'], synthetic_model['model_dir'], script_dir)
+
+    output_dir = str(tmpdir.join('pipeline'))
+    pipeline = Pipeline(output_dir)
+    phenotypes = pipeline.preprocess(synthetic_model['users_dir'], synthetic_model['snp_dir'],
+                                     synthetic_model['phenotypes_file'], cohort=cohort, checkpoint_interval=7)
+    pipeline.build_model('en', 50, 80, 15, 20, True, None, 20, 3)
+    predictions = pipeline.predict(synthetic_model['users_dir'], block_size=7, workers=workers)
+
+    for phenotype in phenotypes:
+        file_name = 'preprocessed_{}.csv.gz'.format(phenotype)
+        assert __read(os.path.join(output_dir, PREPROCESSED_DIR, file_name)) == \
+            __read(os.path.join(synthetic_model['init_dir'], file_name))
+    assert not os.path.exists(os.path.join(output_dir, PREPROCESSED_DIR, 'checkpoints'))
+
+    with open(os.path.join(synthetic_model['model_dir'], 'model_config.pkl'), 'rb') as f:
+        script_config = pickle.load(f)
+    assert list(pipeline.model_config['snps']) == list(script_config['snps'])
+    for file_name in ['confusion_matrix_testing_data.txt', 'confusion_matrix_training_data.txt']:
+        assert __read(os.path.join(output_dir, MODEL_DIR, file_name)) == \
+            __read(os.path.join(synthetic_model['model_dir'], file_name))
+
+    assert len(predictions) == 40
+    assert __read(os.path.join(output_dir, PREDICTION_DIR, predict.PREDICTIONS_FILE)) == \
+        __read(os.path.join(script_dir, predict.PREDICTIONS_FILE))
@@ -0,0 +1,155 @@
+import os
+import pickle
+import shutil
+import numpy as np
+import pandas as pd
+import pytest
+from sklearn.preprocessing import Imputer
+from genopheno import predict
+
+
+def __predict(paths, output_dir, **kwargs):
+    """
+    Predicts the synthetic users with the synthetic model
+    :param paths: The synthetic data and model paths
+    :param output_dir: The output directory
+    :param kwargs: The other prediction settings
+    :return: The predictions and the manifest data frames
+    """
+    predict.run(paths['users_dir'], paths['init_dir'], paths['model_dir'], output_dir, **kwargs)
+    return pd.read_csv(os.path.join(output_dir, predict.PREDICTIONS_FILE)), \
+        pd.read_csv(os.path.join(output_dir, predict.MANIFEST_FILE))
+
+
+def test_blocks(synthetic_model, tmpdir):
+    """
+    Tests that predicting in several blocks writes a row for each user and a manifest entry for each user file, the
+    same as predicting all users at once.
+    """
+    predictions, manifest = __predict(synthetic_model, str(tmpdir.join('blocks')), block_size=7)
+    expected, _ = __predict(synthetic_model, str(tmpdir.join('one_block')), block_size=1000)
+
+    user_files = sorted(os.listdir(synthetic_model['users_dir']))
+    assert list(predictions.columns) == ['user_id', 'prediction']
+    assert len(predictions) == len(user_files)
+    pd.testing.assert_frame_equal(predictions, expected)
+
+    assert list(manifest.columns) == predict.MANIFEST_COLUMNS
+    assert sorted(manifest['file']) == user_files
+    assert manifest['model'].nunique() == 1
+    for _, entry in manifest.iterrows():
+        assert entry['size'] == os.path.getsize(os.path.join(synthetic_model['users_dir'], entry['file']))
+
+
+def test_incremental(synthetic_model, tmpdir):
+    """
+    Tests that an incremental run only predicts new and changed user files and replaces the predictions of changed
+    files.
+    """
+    users_dir = tmpdir.join('users')
+    shutil.copytree(synthetic_model['users_dir'], str(users_dir))
+    paths = dict(synthetic_model, users_dir=str(users_dir))
+    output_dir = str(tmpdir.join('output'))
+    expected, _ = __predict(paths, output_dir)
+
+    new_file = 'user99_file99_yearofbirth_1970_sex_XY.23andme.txt'
+    shutil.copy(str(users_dir.join('user2_file2_yearofbirth_1970_sex_XY.23andme.txt')), str(users_dir.join(new_file)))
+    changed_file = users_dir.join('user5_file5_yearofbirth_1970_sex_XY.23andme.txt')
+    changed_file.write(users_dir.join('user4_file4_yearofbirth_1970_sex_XY.23andme.txt').read() + '\n')
+
+    predictions, manifest = __predict(paths, output_dir, incremental=True)
+    assert sorted(manifest['file'][-2:]) == sorted([changed_file.basename, new_file])
+    assert sorted(predictions['user_id']) == sorted(list(expected['user_id']) + [99])
+    predictions = predictions.set_index('user_id')['prediction']
+    assert predictions[99] == predictions[2]
+    assert predictions[5] == predictions[4]
+
+    # nothing changed since the last run
+    assert __predict(paths, output_dir, incremental=True)[1].shape == manifest.shape
+
+
+def test_incremental_after_crash(synthetic_model, tmpdir):
+    """
+    Tests that users whose predictions were written, but not added to the manifest before a run stopped, are not
+    duplicated by the next incremental run.
+    """
+    output_dir = str(tmpdir.join('output'))
+    expected, _ = __predict(synthetic_model, output_dir, block_size=10)
+
+    # the run stopped after the predictions of the last block were written
+    manifest_path = os.path.join(output_dir, predict.MANIFEST_FILE)
+    with open(manifest_path) as f:
+        lines = f.readlines()
+    with open(manifest_path, 'w') as f:
+        f.writelines(lines[:-10])
+    predictions, manifest = __predict(synthetic_model, output_dir, incremental=True)
+    assert len(manifest) == len(expected)
+    pd.testing.assert_frame_equal(predictions.sort_values('user_id').reset_index(drop=True),
+                                  expected.sort_values('user_id').reset_index(drop=True))
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_watch_model_change(synthetic_model, tmpdir, monkeypatch, workers):
+    """
+    Tests that a model that changes while watching is read again and that all users are predicted with it, also by
+    the worker processes.
+    """
+    model_dir = tmpdir.join('model')
+    shutil.copytree(synthetic_model['model_dir'], str(model_dir))
+    paths = dict(synthetic_model, model_dir=str(model_dir))
+    model_file = str(model_dir.join('model_config.pkl'))
+
+    def sleep(seconds):
+        if len(sleeps) > 0:
+            raise KeyboardInterrupt()
+        sleeps.append(seconds)
+        # the new model predicts the same phenotypes with other labels
+        with open(model_file, 'rb') as f:
+            model_config = pickle.load(f)
+        model_config['pheno_map'] = dict((k, 'new_' + v) for k, v in model_config['pheno_map'].items())
+        with open(model_file, 'wb') as f:
+            pickle.dump(model_config, f)
+
+    sleeps = []
+    # only the watch loop sleeps with the fake, the pool threads use the time module too
+    monkeypatch.setattr(predict, 'time', type('FakeTime', (), {'sleep': staticmethod(sleep)}))
+    predictions, manifest = __predict(paths, str(tmpdir.join('output')), watch=5, workers=workers)
+
+    n_users = len(os.listdir(synthetic_model['users_dir']))
+    assert sleeps == [5]
+    assert len(predictions) == n_users
+    assert predictions['prediction'].str.startswith('new_').all()
+    assert len(manifest) == 2 * n_users
+    assert manifest['model'][:n_users].nunique() == 1
+    assert manifest['model'][n_users:].nunique() == 1
+    assert manifest['model'][0] != manifest['model'][n_users]
+
+
+def test_workers(synthetic_model, tmpdir):
+    """
+    Tests that parsing the user files in worker processes writes the same predictions and manifest entries, in the same
+    order, as a single process.
+    """
+    expected, expected_manifest = __predict(synthetic_model, str(tmpdir.join('one')), block_size=6)
+    predictions, manifest = __predict(synthetic_model, str(tmpdir.join('three')), block_size=6, workers=3)
+    pd.testing.assert_frame_equal(predictions, expected)
+    pd.testing.assert_frame_equal(manifest, expected_manifest)
+
+
+def test_legacy_imputer(synthetic_model):
+    """
+    Tests that models saved with the scikit-learn imputer predict the same as with the genotype imputer.
+    """
+    with open(os.path.join(synthetic_model['model_dir'], 'model_config.pkl'), 'rb') as f:
+        model_config = pickle.load(f)
+    fill_values = getattr(model_config['imputer'], 'fill_values', model_config['imputer'])
+
+    legacy_config = dict(model_config, imputer=Imputer(strategy='most_frequent').fit([fill_values]))
+    legacy_config.pop('dtype', None)
+    legacy_config.pop('scorer', None)
+
+    rng = np.random.RandomState(2)
+    values = rng.randint(0, 3, size=(30, len(fill_values))).astype(float)
+    values[rng.rand(*values.shape) < 0.3] = np.nan
+    mutations = pd.DataFrame(values, columns=model_config['snps'])
+    assert predict.build_predictor(legacy_config)(mutations) == predict.build_predictor(model_config)(mutations)
@@ -0,0 +1,54 @@
+import gzip
+import os
+import pandas as pd
+import pytest
+from genopheno import preprocess
+from genopheno.preprocessing.genotype_matrix import PCT_COLUMNS
+from genopheno.preprocessing.checkpoint import Checkpoint
+
+SNP_DETAILS = pd.DataFrame({'Rsid': ['rs1', 'rs2'], 'Ref': ['A', 'C'], 'Alt': ['G', 'T'], 'Gene_info': ['1:A', '2:B'],
+                            'Chrom': ['1', '1'], 'Pos': [100, 200]},
+                           columns=['Rsid', 'Ref', 'Alt', 'Gene_info', 'Chrom', 'Pos'])
+
+
+def test_phenotype_without_users(tmpdir):
+    """
+    Tests that a phenotype without user files is preprocessed into a data set without user columns, with and without
+    a checkpoint.
+    """
+    for checkpoint in [None, Checkpoint(str(tmpdir), 10)]:
+        data = preprocess.preprocess_phenotype('Brown', [], SNP_DETAILS, checkpoint=checkpoint)
+        assert list(data.index) == ['rs1', 'rs2']
+        assert list(data.columns) == ['Gene_info'] + PCT_COLUMNS
+
+
+def __read_gzip(file_path):
+    with gzip.open(file_path) as f:
+        return f.read()
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_shards(synthetic_model, tmpdir, workers):
+    """
+    Tests that preprocessing the SNPs in shards, also in parallel and after rerunning a shard, writes the same
+    preprocessed files as preprocessing all SNPs at once, with the SNPs in database order.
+    """
+    output_dir = str(tmpdir.join('sharded'))
+    preprocess.run(synthetic_model['users_dir'], synthetic_model['snp_dir'], synthetic_model['phenotypes_file'],
+                   output_dir, shards=True, shard_size=1000, workers=workers)
+    shard_ids = sorted(os.listdir(os.path.join(output_dir, preprocess.SHARDS_DIR)))
+    assert len(shard_ids) > 4
+
+    def assert_same():
+        snp_database = pd.read_csv(os.path.join(output_dir, 'snp_database.csv.gz'))
+        for phenotype in ['Blue_Green', 'Brown']:
+            file_name = 'preprocessed_{}.csv.gz'.format(phenotype)
+            sharded = __read_gzip(os.path.join(output_dir, file_name))
+            assert sharded == __read_gzip(os.path.join(synthetic_model['init_dir'], file_name))
+            rsids = [line.split(',')[0] for line in sharded.splitlines()[1:]]
+            assert rsids == list(snp_database['Rsid'])
+
+    assert_same()
+    preprocess.run(synthetic_model['users_dir'], synthetic_model['snp_dir'], synthetic_model['phenotypes_file'],
+                   output_dir, shard_size=1000, rerun_shards=[shard_ids[1]], workers=workers)
+    assert_same()
@@ -0,0 +1,20 @@
+import numpy as np
+from sklearn.ensemble import RandomForestClassifier
+from genopheno.models import random_forest
+
+
+def test_oob_search():
+    """
+    Tests that the out-of-bag search stops growing the forest once the score plateaus and selects the best parameters.
+    """
+    rng = np.random.RandomState(1)
+    x = rng.randint(0, 3, size=(200, 10)).astype(float)
+    y = (x[:, 0] + x[:, 1] > 2).astype(int)
+
+    param_grid = {'n_estimators': [1000], 'max_depth': [1, None]}
+    model, params = random_forest.oob_search(RandomForestClassifier(random_state=1), param_grid, 3, x, y, 1)
+
+    assert params['max_depth'] is None
+    assert params['n_estimators'] == len(model.estimators_) < 1000
+    assert not model.warm_start
+    assert model.oob_score_ > 0.9
@@ -0,0 +1,55 @@
+import numpy as np
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.linear_model import SGDClassifier
+from sklearn.tree import DecisionTreeClassifier
+from genopheno.models import elastic_net, scorers
+from genopheno.models.common import design_matrix
+
+
+def test_quadratic_scorer():
+    """
+    Tests that the compiled elastic net scorer predicts the same classes as the model from the design matrix, with all
+    interactions, screened interactions and no interactions, and that only the non-zero interactions are kept.
+    """
+    random = np.random.RandomState(0)
+    snps = ['snp{}'.format(i) for i in range(8)]
+    x = random.randint(0, 3, size=(300, len(snps))).astype(float)
+    y = np.where((x[:, 1] - 1) * (x[:, 5] - 1) + x[:, 2] > 1, 'b', 'a')
+    x_new = random.randint(0, 3, size=(1000, len(snps))).astype(float)
+
+    for no_interactions, pairs in [(False, None), (False, [('snp1', 'snp5'), ('snp6', 'snp0')]), (True, None)]:
+        model = SGDClassifier(loss='log', penalty='elasticnet', l1_ratio=0.5, random_state=1, max_iter=1000, tol=1e-3)
+        model.fit(design_matrix(x, snps, no_interactions, pairs), y)
+        scorer = elastic_net.compile_scorer(model, snps, no_interactions, pairs)
+
+        n_interactions = (model.coef_ != 0).sum() - (scorer['main_effects'] != 0).sum()
+        assert len(scorer['weights']) == n_interactions
+        assert np.all(scorer['rows'] < scorer['cols'])
+        np.testing.assert_array_equal(scorers.build(scorer)(x_new),
+                                      model.predict(design_matrix(x_new, snps, no_interactions, pairs)))
+
+
+def test_forest_scorer():
+    """
+    Tests that the flattened trees predict the same classes as the fitted decision tree and random forest, including
+    when the users are walked in several blocks.
+    """
+    random = np.random.RandomState(0)
+    x = random.randint(0, 3, size=(300, 10)).astype(float)
+    y = np.where(x[:, 0] + x[:, 3] * x[:, 7] + random.rand(300) > 2.5, 'b', 'a')
+    x_new = random.randint(0, 3, size=(500, 10)).astype(float)
+    snps = ['snp{}'.format(i) for i in range(10)]
+
+    for model in [DecisionTreeClassifier(random_state=1), RandomForestClassifier(n_estimators=50, random_state=1),
+                  RandomForestClassifier(n_estimators=30, min_samples_leaf=0.01, max_features=0.5, random_state=2)]:
+        model.fit(x, y)
+        scorer = scorers.compile_forest(model, snps, True)
+        assert len(scorer['roots']) == len(getattr(model, 'estimators_', [model]))
+        np.testing.assert_array_equal(scorers.build(scorer)(x_new), model.predict(x_new))
+
+    block_nodes = scorers.BLOCK_NODES
+    try:
+        scorers.BLOCK_NODES = 7 * len(scorer['roots'])
+        np.testing.assert_array_equal(scorers.build(scorer)(x_new), model.predict(x_new))
+    finally:
+        scorers.BLOCK_NODES = block_nodes
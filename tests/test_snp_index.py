@@ -0,0 +1,29 @@
+import numpy as np
+import pandas as pd
+from genopheno.preprocessing.encoding import encode_genotypes
+from genopheno.preprocessing.snp_index import SnpIndex
+
+
+def test_mutations():
+    """
+    Tests that the user RSIDs are joined with the SNP database and that the mutations are counted for valid genotypes
+    only, in SNP database order.
+    """
+    snp_details = pd.DataFrame({
+        'Rsid': ['rs30', 'rs10', 'rs20', 'rs40', 'rs50', 'rs60'],
+        'Ref': ['A', 'C', 'G', 'T', np.nan, 'AT'],
+        'Alt': ['G', 'T,G', np.nan, 'C', 'A', 'A'],
+    }, columns=['Rsid', 'Ref', 'Alt'])
+    index = SnpIndex(snp_details)
+
+    rsids = np.array([10, 20, 30, 40, 50, 60, 70], dtype=np.int64)
+    genotypes = encode_genotypes(['TG', 'GG', 'AG', 'T', 'AA', 'AA', 'CC'])
+    mutations, n_found = index.mutations(rsids, genotypes)
+
+    # rs20 has no alternative alleles, rs40 has one allele, a reference that is not one allele never matches
+    assert n_found == 6
+    np.testing.assert_array_equal(mutations, [1, 2, np.nan, np.nan, 2, 2])
+
+    mutations, n_found = index.mutations(np.array([30, 80], dtype=np.int64), encode_genotypes(['GC', 'AA']))
+    assert n_found == 1
+    np.testing.assert_array_equal(mutations, [np.nan] * 6)
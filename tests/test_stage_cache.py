@@ -0,0 +1,33 @@
+import os
+from genopheno.stage_cache import StageCache, detach_outputs
+
+
+def test_restore(tmpdir):
+    """
+    Tests that the outputs are restored for the same fingerprint and that the fingerprint changes with the inputs.
+    """
+    input_file = tmpdir.join('input.csv')
+    input_file.write('a,b\n1,2\n')
+    output_dir = tmpdir.mkdir('output')
+    output_dir.join('result.csv').write('result')
+    output_dir.join('stage.log').write('log')
+
+    cache = StageCache(str(tmpdir.join('cache')))
+    fingerprint = cache.fingerprint('stage', {'param': 1}, [str(input_file)])
+    assert not cache.restore(fingerprint, str(output_dir))
+    cache.store(fingerprint, str(output_dir))
+
+    assert cache.fingerprint('stage', {'param': 2}, [str(input_file)]) != fingerprint
+    input_file.write('a,b\n1,3\n')
+    assert cache.fingerprint('stage', {'param': 1}, [str(input_file)]) != fingerprint
+
+    restored_dir = tmpdir.join('restored')
+    assert cache.restore(fingerprint, str(restored_dir))
+    assert os.listdir(str(restored_dir)) == ['result.csv']
+    assert restored_dir.join('result.csv').read() == 'result'
+
+    # modifying a detached output does not modify the cache
+    detach_outputs(str(restored_dir))
+    restored_dir.join('result.csv').write('changed')
+    assert cache.restore(fingerprint, str(output_dir))
+    assert output_dir.join('result.csv').read() == 'result'
@@ -0,0 +1,81 @@
+import os
+import pstats
+import pytest
+from multiprocessing import Pool
+from genopheno import util
+
+
+def __work(n):
+    return sum(range(n))
+
+
+def __calls(pstats_file):
+    """
+    Counts the calls of __work in a profile
+    :param pstats_file: The pstats file of the profile
+    :return: The number of calls
+    """
+    stats = pstats.Stats(pstats_file).stats
+    return sum(n_calls for (_, _, function), (_, n_calls, _, _, _) in stats.items() if function == '__work')
+
+
+def test_profile_stages(tmpdir):
+    """
+    Tests that each stage has its own profile, that nested stages are not part of the enclosing stage's profile and
+    that repeated stages share a profile.
+    """
+    util.setup_profiler(str(tmpdir), True)
+    try:
+        util.timed_invoke('outer stage', lambda: [
+            util.timed_invoke('user {}'.format(i), lambda: __work(1000), 'processing users') for i in range(3)])
+    finally:
+        util.setup_profiler(str(tmpdir), False)
+
+    files = sorted(f for f in os.listdir(str(tmpdir)) if f.endswith('.pstats'))
+    assert files == ['profile_01_outer_stage.pstats', 'profile_02_processing_users.pstats']
+
+    assert __calls(str(tmpdir.join('profile_01_outer_stage.pstats'))) == 0
+    assert __calls(str(tmpdir.join('profile_02_processing_users.pstats'))) == 3
+
+
+def __worker_task(n):
+    return util.timed_invoke('worker task {}'.format(n), lambda: __work(1000), 'worker tasks')
+
+
+def test_profile_workers(tmpdir):
+    """
+    Tests that forked workers do not add to the profile of the stage that forked them and write their own profiles
+    when they exit.
+    """
+    util.setup_profiler(str(tmpdir), True)
+    try:
+        def run_workers():
+            pool = Pool(2, util.setup_worker_profiler)
+            pool.map(__worker_task, range(6))
+            pool.close()
+            pool.join()
+        util.timed_invoke('running workers', run_workers)
+    finally:
+        util.setup_profiler(str(tmpdir), False)
+
+    files = os.listdir(str(tmpdir))
+    assert 'profile_01_running_workers.pstats' in files
+    worker_files = [f for f in files if f.startswith('profile_worker') and f.endswith('_01_worker_tasks.pstats')]
+    assert 1 <= len(worker_files) <= 2
+    assert sum(__calls(str(tmpdir.join(f))) for f in worker_files) == 6
+    assert __calls(str(tmpdir.join('profile_01_running_workers.pstats'))) == 0
+
+
+def test_profile_memory_unsupported(tmpdir):
+    """
+    Tests that memory profiling is turned off with a warning when tracemalloc is not available.
+    """
+    if util.tracemalloc is not None:
+        pytest.skip('tracemalloc is available')
+
+    util.setup_profiler(str(tmpdir), True, True)
+    try:
+        assert util.timed_invoke('stage', lambda: __work(10)) == 45
+    finally:
+        util.setup_profiler(str(tmpdir), False)
+    assert not any(f.endswith('_memory.txt') for f in os.listdir(str(tmpdir)))
@@ -0,0 +1,26 @@
+from genopheno.preprocessing.work_queue import WorkQueue
+
+
+def test_claims(tmpdir):
+    """
+    Tests that each task is claimed by one worker and that unfinished tasks are claimed again after a requeue.
+    """
+    queue = WorkQueue(str(tmpdir))
+    for i in range(3):
+        queue.add('{:06d}'.format(i), {'users': [i]})
+    queue.close()
+
+    # workers opening the same queue directory never claim the same task
+    claims = [WorkQueue(str(tmpdir)).claim('worker_{}'.format(i)) for i in range(4)]
+    assert [claim[0] for claim in claims[:3]] == ['000000', '000001', '000002']
+    assert claims[1][1] == {'users': [1]}
+    assert claims[3] is None
+
+    queue.complete('000000')
+    queue.fail('000001', 'error')
+    assert queue.failures() == {'000001': 'error'}
+    assert queue.claim('worker_0') is None
+
+    assert queue.requeue() == ['000001', '000002']
+    assert queue.failures() == {}
+    assert queue.claim('worker_0')[0] == '000001'